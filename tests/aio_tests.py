@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+The tests which need asyncio, they are collected on python 3.7+ only.
+"""
+import asyncio
+import socket
+import unittest
+
+from zbx.exceptions import SenderException
+from zbx.metrics import *
+from zbx.metrics import statsd
+from zbx.metrics.agent import Agent, Unsupported, parse_key
+from zbx.metrics.relay import Relay
+from zbx.metrics.testing import FakeTrapper
+
+from .metrics_tests import RecordingSender
+
+
+class RelayTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.trapper = FakeTrapper()
+
+    def tearDown(self):
+        self.trapper.stop()
+
+    def test_relay(self):
+        upstream = Sender(port=self.trapper.port, max_values=100)
+        buffered = BufferedSender(upstream, batch_size=100, max_age=60)
+        relay = Relay(buffered)
+
+        async def scenario():
+            server = await relay.start('127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            loop = asyncio.get_event_loop()
+            client = Sender(port=port, max_values=3)
+            result = await loop.run_in_executor(None, client.send, [
+                Metric('key', i, host='h') for i in range(5)])
+            client.compress_threshold = 0
+            compressed = await loop.run_in_executor(None, client.send, [
+                Metric('other', 'x', clock=5)])
+            client.pack = lambda payload: pack(b'{"request":"x"}')
+            with self.assertRaises(SenderException):
+                await loop.run_in_executor(None, client.send, [
+                    Metric('key', 1)])
+            server.close()
+            await server.wait_closed()
+            return result, compressed
+
+        result, compressed = asyncio.run(scenario())
+        assert (result.processed, result.batches) == (5, 2)
+        assert compressed.processed == 1
+        assert (relay.requests, relay.values, relay.errors) == (3, 6, 1)
+        assert self.trapper.requests == []
+        buffered.close()
+        data = self.trapper.requests[0]['data']
+        assert len(self.trapper.requests) == 1 and len(data) == 6
+        assert data[-1] == {'host': 'localhost', 'key': 'other',
+                            'value': 'x', 'clock': 5}
+
+
+class StatsdTestCase(unittest.TestCase):
+
+    def test_feed(self):
+        sender = RecordingSender()
+        aggregator = Aggregator(sender, percentiles=(50,), max_keys=5)
+        bridge = statsd.StatsdBridge(aggregator, [
+            statsd.Template(r'^(?P<host>web\d+)\.(?P<name>.+)$',
+                            '{host}', 'statsd[{name}]')])
+        bridge.feed(b'web1.hits:1|c\nweb1.hits:2|c|@0.5\n'
+                    b'load:5|g\nload:-2|g\n'
+                    b'web2.time:100|ms\nweb2.time:300|h\n'
+                    b'users:a|s\nusers:b|s\nusers:a|s\n'
+                    b'bad\nbad:1|x\n')
+        bridge.feed(b'web1.hits:1|c')
+        bridge.feed(b'new:1|c\nmore:1|c')
+        assert (bridge.packets, bridge.lines, bridge.errors) == (3, 14, 2)
+        assert aggregator.dropped == 1
+        aggregator.flush()
+        metrics = dict(((m.host, m.key), m.value) for m in sender.batches[0])
+        assert metrics['web1', 'statsd[hits]'] == 6
+        assert metrics[None, 'load'] == 3
+        assert metrics[None, 'users'] == 2
+        bridge.feed(b'load:+5|g')
+        aggregator.flush()
+        assert [m.value for m in sender.batches[1]
+                if m.key == 'load'] == [8]
+        assert metrics['web2', 'statsd.count[time]'] == 2
+        assert abs(metrics['web2', 'statsd.avg[time]'] - 0.2) < 1e-9
+        assert (None, 'new') in metrics and (None, 'more') not in metrics
+
+    def test_udp(self):
+        aggregator = Aggregator(RecordingSender())
+        bridge = statsd.StatsdBridge(aggregator)
+
+        async def scenario():
+            transport = await bridge.start('127.0.0.1', 0)
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client.sendto(b'hits:1|c', transport.get_extra_info('sockname'))
+            client.close()
+            for _ in range(100):
+                if bridge.packets:
+                    break
+                await asyncio.sleep(0.01)
+            transport.close()
+
+        asyncio.run(scenario())
+        assert [(m.key, m.value) for m in aggregator.collect()] == \
+            [('hits', 1)]
+
+
+class AgentTestCase(unittest.TestCase):
+
+    def test_parse_key(self):
+        assert parse_key('agent.ping') == ('agent.ping', [])
+        assert parse_key('vfs.fs.size[/, "free"]') == ('vfs.fs.size',
+                                                       ['/', 'free'])
+        assert parse_key('k[a,"b,]\\"c" ,[x, "y"],]') == \
+            ('k', ['a', 'b,]"c', ['x', 'y'], ''])
+        for key in ('k[a', 'k["a]', 'k[a]b', 'k["a"b]', 'k[[a,[b]]]'):
+            with self.assertRaises(ValueError):
+                parse_key(key)
+
+    def test_query(self):
+        agent = Agent()
+        calls = []
+
+        @agent.handler('circus.worker.*', ttl=60)
+        async def worker(key, name):
+            calls.append(name)
+            await asyncio.sleep(0.01)
+            return 1.5
+
+        @agent.handler('fail')
+        def fail(key):
+            raise Unsupported('No such worker.')
+
+        async def scenario():
+            values = await asyncio.gather(*[
+                agent.answer('circus.worker.cpu[web]') for _ in range(10)])
+            values.append(await agent.answer('circus.worker.cpu[web]'))
+            values.append(await agent.answer('circus.worker.cpu[db]'))
+            values.append(await agent.answer('fail'))
+            values.append(await agent.answer('unknown'))
+            values.append(await agent.answer('agent.ping[x'))
+            return values
+
+        values = asyncio.run(scenario())
+        assert values[:12] == [b'1.5'] * 12
+        assert values[12] == b'ZBX_NOTSUPPORTED\0No such worker.'
+        assert values[13].startswith(b'ZBX_NOTSUPPORTED\0Unsupported')
+        assert values[14].startswith(b'ZBX_NOTSUPPORTED\0Invalid')
+        assert calls == ['web', 'db']
+        assert (agent.requests, agent.hits, agent.unsupported) == \
+            (15, 10, 3)
+
+    def test_server(self):
+        agent = Agent()
+
+        def request(port, data):
+            client = socket.create_connection(('127.0.0.1', port))
+            try:
+                client.sendall(data)
+                response = b''
+                while True:
+                    chunk = client.recv(4096)
+                    if not chunk:
+                        return response
+                    response += chunk
+            finally:
+                client.close()
+
+        async def scenario():
+            server = await agent.start('127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            loop = asyncio.get_event_loop()
+            framed = await loop.run_in_executor(
+                None, request, port, pack(b'agent.ping'))
+            plain = await loop.run_in_executor(
+                None, request, port, b'agent.ping\n')
+            server.close()
+            await server.wait_closed()
+            return framed, plain
+
+        framed, plain = asyncio.run(scenario())
+        assert framed == plain == pack(b'1')
@@ -10,3 +10,272 @@ class ApiTestCase(unittest.TestCase):
         assert cast(['1', 1]) == [1, 1]
         assert cast({'foo': '1', 'bar': 1}) == {'foo': 1, 'bar': 1}
         assert cast({'foo': ['1']}) == {'foo': [1]}
+
+
+class FakeApi(Api):
+    """Answers requests with handlers instead of http"""
+
+    def __init__(self, **handlers):
+        super(FakeApi, self).__init__('user', 'password', None)
+        self.handlers = handlers
+        self.calls = []
+
+    def _caller(self, method, params, auth_token=None):
+        if method == 'user.login':
+            return 'token'
+        self.calls.append((method, params))
+        return self.handlers[method.replace('.', '_')](params)
+
+
+class SnapshotTestCase(unittest.TestCase):
+
+    def test_poll(self):
+        items = {1: ('10', '1.5'), 2: ('10', '2'), 3: ('0', '')}
+
+        def item_get(params):
+            if 'itemids' not in params:
+                return [{'itemid': str(i)} for i in items]
+            return [{'itemid': str(i), 'lastclock': items[i][0],
+                     'lastvalue': items[i][1]} for i in params['itemids']]
+
+        api = FakeApi(item_get=item_get)
+        snapshot = Snapshot(api=api, page_size=2)
+        changes = snapshot.poll()
+        assert [c.itemid for c in changes] == [1, 2]
+        assert snapshot[1] == (10, '1.5')
+        assert len(api.calls) == 3
+
+        items[2] = ('20', '3')
+        changes = snapshot.poll()
+        assert changes == [Change(2, 20, 3, 2)]
+        assert snapshot.poll() == []
+
+
+class EventStreamTestCase(unittest.TestCase):
+
+    def test_stream(self):
+        events = [{'eventid': str(i), 'clock': '0'} for i in range(1, 8)]
+
+        def event_get(params):
+            if params.get('sortorder') == 'DESC':
+                return events[-1:]
+            found = [e for e in events
+                     if int(e['eventid']) >= params['eventid_from']]
+            return found[:params['limit']]
+
+        api = FakeApi(event_get=event_get)
+        stream = EventStream(api=api, page_size=2, cursor=MemoryCursor(3))
+        it = iter(stream)
+        assert [next(it)['eventid'] for _ in range(4)] == [4, 5, 6, 7]
+        events.append({'eventid': '8', 'clock': '0'})
+        assert next(it)['eventid'] == 8
+        it.close()
+        assert stream.cursor.load() == 7
+        stream.commit(8)
+        assert stream.cursor.load() == 8
+
+    def test_resume_after_failure(self):
+        events = [{'eventid': str(i), 'clock': '0'} for i in range(1, 8)]
+
+        def event_get(params):
+            found = [e for e in events
+                     if int(e['eventid']) >= params['eventid_from']]
+            return found[:params['limit']]
+
+        cursor = MemoryCursor(3)
+        handled = []
+        try:
+            for event in EventStream(api=FakeApi(event_get=event_get),
+                                     cursor=cursor):
+                if event['eventid'] == 5:
+                    raise RuntimeError('handler failed')
+                handled.append(event['eventid'])
+        except RuntimeError:
+            pass
+        assert handled == [4]
+        assert cursor.load() == 4
+
+        it = iter(EventStream(api=FakeApi(event_get=event_get),
+                              cursor=cursor))
+        assert next(it)['eventid'] == 5
+
+    def test_file_cursor(self):
+        import os.path
+        import tempfile
+        path = os.path.join(tempfile.mkdtemp(), 'cursor')
+        cursor = FileCursor(path)
+        assert cursor.load() is None
+        cursor.save(42)
+        assert FileCursor(path).load() == 42
+
+
+class HistoryCacheTestCase(unittest.TestCase):
+
+    def test_history(self):
+        import tempfile
+
+        def history_get(params):
+            assert params['history'] == 0
+            return [{'itemid': str(itemid), 'clock': str(clock),
+                     'value': str(clock / 10.)}
+                    for itemid in params['itemids']
+                    for clock in range(params['time_from'],
+                                       params['time_till'] + 1, 10)]
+
+        api = FakeApi(history_get=history_get)
+        cache = HistoryCache(tempfile.mkdtemp(), api=api, window=50)
+        items = [{'itemid': '1', 'value_type': '0'}, (2, 0)]
+
+        response = cache.history(items, 100, 199)
+        assert response[1][0] == (100, 10.)
+        assert len(response[2]) == 10
+        assert len(api.calls) == 2
+
+        response = cache.history(items, 150, 249)
+        assert [clock for clock, _ in response[1]] == list(range(150, 250, 10))
+        assert [c[1]['time_from'] for c in api.calls[2:]] == [200]
+
+        response = cache.history({1: 0}, 0, 249)
+        assert len(response[1]) == 25
+        assert [c[1]['time_from'] for c in api.calls[3:]] == [0, 50]
+
+        cache = HistoryCache(cache.path, api=api)
+        assert len(cache.history({1: 0}, 0, 249)[1]) == 25
+        assert len(api.calls) == 5
+
+    def test_fetched_again(self):
+        import tempfile
+
+        def history_get(params):
+            return [{'itemid': '1', 'clock': str(clock), 'value': '1'}
+                    for clock in range(params['time_from'],
+                                       params['time_till'] + 1, 10)]
+
+        path = tempfile.mkdtemp()
+        cache = HistoryCache(path, api=FakeApi(history_get=history_get))
+        cache._save_index = lambda: None  # died before saving its index
+        assert len(cache.history({1: 0}, 100, 199)[1]) == 10
+
+        api = FakeApi(history_get=history_get)
+        cache = HistoryCache(path, api=api)
+        assert len(cache.history({1: 0}, 50, 249)[1]) == 20
+        assert len(api.calls) == 1
+
+    def test_float_times(self):
+        import tempfile
+
+        def history_get(params):
+            assert isinstance(params['time_from'], int)
+            return [{'itemid': '1', 'clock': str(params['time_from']),
+                     'value': '1'}]
+
+        api = FakeApi(history_get=history_get)
+        cache = HistoryCache(tempfile.mkdtemp(), api=api, window=60)
+        response = cache.history({1: 0}, 100.5, 219.9)
+        assert [clock for clock, _ in response[1]] == [100, 160]
+
+    def test_numeric_only(self):
+        import tempfile
+        cache = HistoryCache(tempfile.mkdtemp(), api=FakeApi())
+        self.assertRaises(ValueError, cache.history, {1: 4}, 0, 10)
+
+
+class RollupTestCase(unittest.TestCase):
+
+    def check(self, use_numpy):
+        def history_get(params):
+            return [{'itemid': itemid, 'clock': clock, 'value': str(clock)}
+                    for itemid in params['itemids']
+                    for clock in range(params['time_from'],
+                                       params['time_till'] + 1)]
+
+        api = FakeApi(history_get=history_get)
+        result = rollup({2: 0, 1: 3}, 0, 29, 10, percentiles=[50], api=api,
+                        window=7)
+        assert len(api.calls) == 10
+
+        if use_numpy is False:
+            result = Rollup([1, 2], 0, 29, 10, percentiles=[50],
+                            use_numpy=False)
+            for call in api.calls:
+                result.feed(history_get(call[1]))
+
+        assert list(result.matrix('count')[0]) == [10, 10, 10]
+        assert list(result.matrix('min')[1]) == [0, 10, 20]
+        assert list(result.matrix('max')[1]) == [9, 19, 29]
+        assert list(result.matrix('avg')[0]) == [4.5, 14.5, 24.5]
+        for value, expected in zip(result.matrix('p50')[0], [4.5, 14.5, 24.5]):
+            assert abs(value - expected) <= expected * 0.01
+        self.assertRaises(ValueError, result.matrix, 'p99')
+
+    def test_float_times(self):
+        api = FakeApi(history_get=lambda params: [
+            {'itemid': '1', 'clock': params['time_from'], 'value': '1'}])
+        result = rollup({1: 0}, 0.5, 29.9, 10.0, api=api, window=10)
+        assert [call[1]['time_from'] for call in api.calls] == [0, 10, 20]
+        assert result.grid() == [0, 10, 20]
+        assert list(result.matrix('count')[0]) == [1, 1, 1]
+
+    def test_bounded_percentiles(self):
+        result = Rollup([1], 0, 9, 10, percentiles=[99], use_numpy=False)
+        result.feed((1, clock % 10, value) for clock, value
+                    in enumerate(range(1, 100001)))
+        sketch = result._sketches[0]
+        assert sketch.count == 100000
+        assert len(sketch.positive) < 1000
+        assert abs(result.matrix('p99')[0][0] - 99000) <= 990
+
+    def test_array(self):
+        self.check(False)
+
+    def test_numpy(self):
+        try:
+            import numpy  # NOQA
+        except ImportError:
+            raise unittest.SkipTest('numpy is not installed')
+        self.check(True)
+
+
+class QueryTestCase(unittest.TestCase):
+
+    def test_compile(self):
+        query = (Query('item.get', api=FakeApi())
+                 .fields('itemid', 'name')
+                 .where(hostids=[1], status=0, name__icontains='cpu',
+                        lastvalue__gt=10)
+                 .order_by('-name')
+                 .limit(10))
+        params, client = query.compile()
+        assert params == {
+            'hostids': [1],
+            'filter': {'status': 0},
+            'search': {'name': 'cpu'},
+            'output': ['itemid', 'name', 'lastvalue'],
+            'sortfield': ['name'],
+            'sortorder': ['DESC'],
+        }
+        assert client == [('lastvalue', 'gt', 10)]
+
+        params, client = (Query('event.get', api=FakeApi())
+                          .where(eventid__gt=10, name__startswith='CPU')
+                          .limit(5).compile())
+        assert params == {
+            'eventid_from': 11,
+            'search': {'name': 'CPU'},
+            'startSearch': True,
+            'output': 'extend',
+        }
+        assert client == [('name', 'startswith', 'CPU')]
+
+    def test_all(self):
+        def item_get(params):
+            return [{'itemid': 1, 'name': 'CPU load', 'lastvalue': 5},
+                    {'itemid': 2, 'name': 'cpu idle', 'lastvalue': 50},
+                    {'itemid': 3, 'name': 'cpu user', 'lastvalue': 20}]
+
+        api = FakeApi(item_get=item_get)
+        results = (Query('item.get', api=api).fields('itemid')
+                   .where(name__contains='cpu', lastvalue__gt=10)
+                   .limit(1).all())
+        assert results == [{'itemid': 2}]
+        assert 'limit' not in api.calls[0][1]
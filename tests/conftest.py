@@ -0,0 +1,4 @@
+import sys
+
+# the asyncio tests cannot even be compiled by older pythons
+collect_ignore = ['aio_tests.py'] if sys.version_info < (3, 7) else []
@@ -0,0 +1,949 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import unittest
+import zlib
+
+from six.moves import StringIO
+
+from zbx.exceptions import SenderException
+from zbx.metrics import *
+from zbx.metrics.testing import FakeTrapper
+
+
+class SenderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.trapper = FakeTrapper(unsupported=['unknown'])
+
+    def tearDown(self):
+        self.trapper.stop()
+
+    def test_packet(self):
+        packet = pack(b'{}')
+        assert packet == b'ZBXD\x01\x02\x00\x00\x00\x00\x00\x00\x00{}'
+
+    def test_compressed_packet(self):
+        packet = pack(b'{}' * 100, 9)
+        signature, flags, length, reserved = struct.unpack('<4sBII',
+                                                           packet[:13])
+        assert (signature, flags, reserved) == (b'ZBXD', 3, 200)
+        assert zlib.decompress(packet[13:]) == b'{}' * 100
+
+    def test_send_compressed(self):
+        metrics = [Metric('key', 'x' * 100, host='host') for i in range(10)]
+        with Sender(port=self.trapper.port, max_values=5,
+                    compress_threshold=600) as sender:
+            result = sender.send(metrics[:8])
+        assert result.processed == 8
+        flags = sorted(packet[0] for packet in self.trapper.packets)
+        assert flags == [1, 3]
+        assert [length < 200 for flag, length in
+                sorted(self.trapper.packets)] == [False, True]
+
+    def test_parse_info(self):
+        info = parse_info('processed: 1; failed: 2; total: 3; '
+                          'seconds spent: 0.000055')
+        assert info == {'processed': 1, 'failed': 2, 'total': 3,
+                        'seconds': 0.000055}
+        info = parse_info('Processed 1 Failed 0 Total 1 '
+                          'Seconds spent 0.000055')
+        assert info['total'] == 1
+
+    def test_send(self):
+        metrics = [Metric('key', i, clock=1000 + i) for i in range(10)]
+        metrics.append(Metric('unknown', 0, host='foo'))
+        with Sender(port=self.trapper.port, max_values=3,
+                    max_inflight=2) as sender:
+            result = sender.send(metrics)
+        assert (result.processed, result.failed, result.total,
+                result.batches) == (10, 1, 11, 4)
+        data = sorted((d for r in self.trapper.requests for d in r['data']),
+                      key=lambda d: d['clock'])
+        assert data[0] == {'host': 'localhost', 'key': 'key', 'value': '0',
+                           'clock': 1000}
+        assert data[-1]['host'] == 'foo'
+
+    def test_send_text(self):
+        metrics = [Metric('key', u'caf\xe9'), Metric('key', 1.5),
+                   Metric('key', 1 << 60), Metric('key', None)]
+        with Sender(port=self.trapper.port) as sender:
+            result = sender.send(metrics)
+        assert result.processed == 4
+        assert [d['value'] for d in self.trapper.requests[0]['data']] == [
+            u'caf\xe9', '1.5', str(1 << 60), '-']
+
+    def test_max_bytes(self):
+        sender = Sender(max_bytes=100)
+        batches = list(sender.batches([Metric('key', 'x' * 30)] * 5))
+        assert [len(batch) for batch in batches] == [1, 1, 1, 1, 1]
+
+    def test_legacy_trapper(self):
+        with FakeTrapper(compression=False, failure_ratio=0.5,
+                         latency=0.01) as trapper:
+            sender = Sender(port=trapper.port, compress_threshold=0)
+            with self.assertRaises(SenderException):
+                sender.send([Metric('key', 1)])
+            sender.compress_threshold = None
+            result = sender.send([Metric('key', i) for i in range(4)])
+            assert (result.processed, result.failed) == (2, 2)
+            assert trapper.values == 4
+            assert trapper.bytes_received == trapper.packets[-1][1] + 13
+
+    def test_bench(self):
+        from zbx.metrics.bench import run
+        measures = run('batch', 'float', 10, 50, self.trapper)
+        assert measures['values'] == 50
+        assert measures['bytes_per_value'] > 50
+        assert measures['new_blocks'] is None
+
+    def test_bench_legacy_trapper(self):
+        from zbx.metrics.bench import main
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            main(['--values', '20', '--batch-sizes', '10', '--types', 'int',
+                  '--modes', 'sender,compressed', '--no-compression'])
+            lines = sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+        assert [json.loads(line)['mode'] for line in lines] == ['sender']
+
+    def test_unreachable(self):
+        self.trapper.stop()
+        sender = Sender(port=self.trapper.port, timeout=1)
+        with self.assertRaises(SenderException) as context:
+            sender.send([Metric('key', 1)])
+        assert context.exception.result == Result()
+        self.trapper = FakeTrapper()
+
+
+class RecordingSender(object):
+
+    def __init__(self, error=None):
+        self.batches = []
+        self.error = error
+
+    def send(self, metrics):
+        if self.error:
+            raise self.error
+        self.batches.append(list(metrics))
+        return Result(len(self.batches[-1]), 0, len(self.batches[-1]))
+
+
+class BufferedSenderTestCase(unittest.TestCase):
+
+    def test_flush(self):
+        sender = RecordingSender()
+        buffered = BufferedSender(sender, batch_size=3, max_age=60)
+        for i in range(7):
+            assert buffered.submit(Metric('key', i))
+        assert buffered.flush(5)
+        assert [len(batch) for batch in sender.batches] == [3, 3, 1]
+        assert sender.batches[0][0].clock is not None
+        stats = buffered.stats()
+        assert stats['sent'] == 7 and stats['depth'] == 0
+        buffered.close()
+
+    def test_max_age(self):
+        sender = RecordingSender()
+        buffered = BufferedSender(sender, batch_size=100, max_age=0.01)
+        buffered.submit(Metric('key', 1))
+        for _ in range(100):
+            if sender.batches:
+                break
+            threading.Event().wait(0.01)
+        assert len(sender.batches) == 1
+        buffered.close()
+
+    def test_drop_oldest(self):
+        sender = RecordingSender()
+        buffered = BufferedSender(sender, capacity=2, batch_size=100,
+                                  max_age=60)
+        for i in range(5):
+            buffered.submit(Metric('key', i))
+        buffered.close()
+        assert [m.value for m in sender.batches[0]] == [3, 4]
+        assert buffered.dropped == 3
+
+    def test_spill(self):
+        spilled = []
+        buffered = BufferedSender(RecordingSender(SenderException('down')),
+                                  capacity=2, batch_size=100, max_age=60,
+                                  policy='spill', spill=spilled.extend)
+        for i in range(3):
+            buffered.submit(Metric('key', i))
+        buffered.close()
+        assert [m.value for m in spilled] == [2, 0, 1]
+        assert buffered.stats()['failed'] == 2
+
+    def test_retry(self):
+        class FlakySender(RecordingSender):
+            def send(self, metrics):
+                if len(self.batches) < 2:
+                    self.batches.append(None)
+                    raise SenderException('down', undelivered=metrics[1:])
+                return RecordingSender.send(self, metrics)
+
+        sender = FlakySender()
+        buffered = BufferedSender(sender, batch_size=100, max_age=60,
+                                  retries=2, retry_backoff=0.01)
+        for i in range(5):
+            buffered.submit(Metric('key', i))
+        buffered.close()
+        assert [m.value for m in sender.batches[-1]] == [2, 3, 4]
+        stats = buffered.stats()
+        assert (stats['sent'], stats['retried'], stats['failed']) == (5, 7, 0)
+
+        trapper = FakeTrapper()
+        port = trapper.port
+        trapper.stop()
+        with self.assertRaises(SenderException) as context:
+            Sender(port=port, max_values=2).send(
+                [Metric('key', i) for i in range(3)])
+        assert len(context.exception.undelivered) == 3
+
+    def test_closed(self):
+        sender = RecordingSender()
+        buffered = BufferedSender(sender, batch_size=100, max_age=60)
+        buffered.submit(Metric('key', 1))
+        buffered.close()
+        assert not buffered.submit(Metric('key', 2))
+        assert buffered.flush()
+        assert [m.value for m in sender.batches[0]] == [1]
+        assert buffered.stats()['dropped'] == 1
+
+
+class AsyncSenderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            from zbx.metrics.aio import AsyncSender
+        except SyntaxError:
+            raise unittest.SkipTest('asyncio is not available')
+        self.AsyncSender = AsyncSender
+        self.trapper = FakeTrapper()
+
+    def tearDown(self):
+        self.trapper.stop()
+
+    def test_send(self):
+        import asyncio
+        sender = self.AsyncSender(port=self.trapper.port, max_values=2)
+        metrics = [Metric('key', i) for i in range(5)]
+        result = asyncio.run(sender.send(metrics))
+        assert (result.processed, result.total, result.batches) == (5, 5, 3)
+
+    def test_timeout(self):
+        import asyncio
+        silent = socket.socket()
+        silent.bind(('127.0.0.1', 0))
+        silent.listen(5)
+        try:
+            sender = self.AsyncSender(port=silent.getsockname()[1])
+            with self.assertRaises(SenderException):
+                asyncio.run(sender.send([Metric('key', 1)], timeout=0.05))
+        finally:
+            silent.close()
+
+    def test_spool_and_dedup(self):
+        import asyncio
+        import tempfile
+        port = self.trapper.port
+        self.trapper.stop()
+        spool = Spool(tempfile.mkdtemp(), retry_interval=0)
+        sender = self.AsyncSender(port=port, timeout=1, spool=spool,
+                                  dedup=Deduplicator())
+        result = asyncio.run(sender.send([Metric('key', 1, clock=1)]))
+        assert result.spooled == 1
+
+        self.trapper = FakeTrapper(port)
+        result = asyncio.run(sender.send([Metric('key', 2, clock=2),
+                                          Metric('key', 2, clock=3)]))
+        assert result.processed == 1 and not spool.pending
+        clocks = [d['clock'] for r in self.trapper.requests
+                  for d in r['data']]
+        assert clocks == [1, 2]
+        spool.close()
+
+
+class ShardedSenderTestCase(unittest.TestCase):
+
+    def test_ring(self):
+        ring = HashRing(['a', 'b', 'c'])
+        hosts = ['host%d' % i for i in range(1000)]
+        before = dict((host, ring.get(host)) for host in hosts)
+        assert set(before.values()) == set('abc')
+        ring.add('d')
+        moved = [host for host in hosts if ring.get(host) != before[host]]
+        assert all(ring.get(host) == 'd' for host in moved)
+        assert 100 < len(moved) < 400
+        ring.remove('d')
+        assert dict((host, ring.get(host)) for host in hosts) == before
+
+    def test_send(self):
+        trappers = [FakeTrapper(), FakeTrapper(), FakeTrapper()]
+        try:
+            endpoints = ['127.0.0.1:%d' % t.port for t in trappers[:2]]
+            sender = ShardedSender(endpoints, overrides={
+                'special': ('127.0.0.1', trappers[2].port)})
+            metrics = [Metric('key', 1, host='host%d' % i)
+                       for i in range(20)]
+            metrics.append(Metric('key', 1, host='special'))
+            with sender:
+                result = sender.send(metrics)
+            assert result.processed == 21
+            for trapper in trappers[:2]:
+                hosts = set(d['host'] for r in trapper.requests
+                            for d in r['data'])
+                assert hosts and all(sender.route(host)[1] == trapper.port
+                                     for host in hosts)
+            assert trappers[2].requests[0]['data'][0]['host'] == 'special'
+        finally:
+            for trapper in trappers:
+                trapper.stop()
+
+    def test_add_endpoint(self):
+        import tempfile
+        trappers = [FakeTrapper(), FakeTrapper()]
+        try:
+            with self.assertRaises(ValueError):
+                ShardedSender([], spool=Spool(tempfile.mkdtemp()))
+            path = tempfile.mkdtemp()
+            sender = ShardedSender(['127.0.0.1:%d' % trappers[0].port],
+                                   spool=path)
+            metrics = [Metric('key', 1, host='host%d' % i) for i in range(20)]
+            with sender:
+                sender.send(metrics)
+                sender.add_endpoint(('127.0.0.1', trappers[1].port))
+                result = sender.send(metrics)
+                assert sender._workers == 2
+            assert result.processed == 20
+            assert trappers[1].values > 0
+            assert sorted(os.listdir(path)) == sorted(
+                '127.0.0.1-%d' % t.port for t in trappers)
+        finally:
+            for trapper in trappers:
+                trapper.stop()
+
+    def test_remove_endpoint(self):
+        import tempfile
+        down, up = FakeTrapper(), FakeTrapper()
+        down.stop()
+        endpoint = ('127.0.0.1', down.port)
+        sender = ShardedSender([endpoint], spool=tempfile.mkdtemp(),
+                               timeout=1)
+        try:
+            metrics = [Metric('key', i, host='host%d' % i) for i in range(5)]
+            assert sender.send(metrics).spooled == 5
+            with self.assertRaises(SenderException):
+                sender.remove_endpoint(endpoint)
+            assert endpoint in sender.ring and endpoint in sender.senders
+
+            sender.add_endpoint(('127.0.0.1', up.port))
+            sender.remove_endpoint(endpoint)
+            assert endpoint not in sender.ring
+            assert endpoint not in sender.senders
+            assert sorted(d['value'] for r in up.requests
+                          for d in r['data']) == ['0', '1', '2', '3', '4']
+        finally:
+            sender.close()
+            up.stop()
+
+
+class SpoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.path = tempfile.mkdtemp()
+
+    def test_replay(self):
+        with Spool(self.path, segment_size=256) as spool:
+            assert not spool.pending
+            spool.extend([Metric('key', i, host='h', clock=i)
+                          for i in range(20)])
+            assert len(os.listdir(self.path)) > 2
+            batches = []
+            assert spool.replay(batches.append, batch_size=7) == 20
+            assert [len(batch) for batch in batches] == [7, 7, 6]
+            metric = batches[0][1]
+            assert (metric.key, metric.value, metric.host,
+                    metric.clock) == ('key', '1', 'h', 1)
+            assert not spool.pending
+            assert len([n for n in os.listdir(self.path)
+                        if n.endswith('.seg')]) == 1
+
+    def test_recover(self):
+        with Spool(self.path) as spool:
+            spool.extend([Metric('key', 1), Metric('key', 2)])
+
+            def fail(metrics):
+                raise SenderException('down')
+
+            assert spool.replay(fail) == 0
+            assert spool.pending and not spool.ready()
+
+        # a torn record is ignored
+        name = os.path.join(self.path, '%012d.seg' % 0)
+        with open(name, 'r+b') as file:
+            file.seek(60)
+            file.write(b'\x08\x00\x00\x00\x00\x00\x00\x00garbage!')
+
+        with Spool(self.path) as spool:
+            metrics, position = spool.read(10)
+            assert [m.value for m in metrics] == ['1', '2']
+            spool.commit(position)
+        with Spool(self.path) as spool:
+            assert not spool.pending
+
+    def test_evict(self):
+        with Spool(self.path, segment_size=128, max_segments=2) as spool:
+            spool.extend([Metric('key', i) for i in range(20)])
+            assert spool.evicted > 0
+            metrics, _ = spool.read(100)
+            assert metrics[-1].value == '19'
+            assert len(metrics) < 20
+
+    def test_sender(self):
+        trapper = FakeTrapper()
+        port = trapper.port
+        trapper.stop()
+        spool = Spool(self.path, retry_interval=0)
+        sender = Sender(port=port, timeout=1, spool=spool)
+        result = sender.send([Metric('key', 1, clock=1)])
+        assert result.spooled == 1
+        result = sender.send([Metric('key', 2, clock=2)])
+        assert result.spooled == 1
+
+        trapper = FakeTrapper(port)
+        try:
+            result = sender.send([Metric('key', 3, clock=3)])
+            assert result.processed == 1 and not spool.pending
+            clocks = [d['clock'] for r in trapper.requests for d in r['data']]
+            assert clocks == [1, 2, 3]
+        finally:
+            trapper.stop()
+            sender.close()
+            spool.close()
+
+
+class MetricBatchTestCase(unittest.TestCase):
+
+    def test_columns(self):
+        batch = MetricBatch([Metric('a', 1, host='h', clock=10),
+                             Metric('b', 1.5), Metric('a', 'text', host='-'),
+                             Metric('a', 1 << 60), Metric('b', None)])
+        assert len(batch) == 5
+        assert batch.keys == ['a', 'b'] and batch.hosts == [None, 'h']
+        assert [m.value for m in batch] == [1, 1.5, 'text', str(1 << 60), '-']
+        assert batch[0].clock == 10 and batch[1].clock is None
+
+    def test_long_clock_and_text(self):
+        batch = MetricBatch()
+        batch.append('a', 1, clock=1 << 40)
+        batch.append('a', u'caf\xe9')
+        assert [m.clock for m in batch] == [1 << 40, None]
+        assert batch[1].value == u'caf\xe9'
+        packet = list(Sender().batches(batch))[0].packet
+        assert b'"caf\\u00e9"' in bytes(packet)
+
+    def test_encode(self):
+        metrics = [Metric('key', i, host='host%d' % (i % 2)) for i in range(5)]
+        metrics.append(Metric('kéy', 'v"al', clock=10))
+        batch = MetricBatch(metrics)
+        sender = Sender(max_values=4)
+        expected = [json.loads(b.packet[13:].decode('utf-8'))
+                    for b in sender.batches(metrics)]
+        batches = list(sender.batches(batch))
+        assert [len(b) for b in batches] == [4, 2]
+        assert [m.value for m in batches[1].metrics] == [4, 'v"al']
+        for packet, request in zip([b.packet for b in batches], expected):
+            assert struct.unpack('<Q', bytes(packet[5:13]))[0] == \
+                len(packet) - 13
+            assert json.loads(bytes(packet[13:]).decode('utf-8')) == request
+
+        sender = Sender(max_bytes=150)
+        assert [len(b) for b in sender.batches(batch)] == [2, 2, 2]
+
+    def test_send(self):
+        trapper = FakeTrapper()
+        try:
+            with Sender(port=trapper.port, max_values=2) as sender:
+                result = sender.send(MetricBatch([Metric('key', i)
+                                                  for i in range(5)]))
+            assert result.processed == 5 and result.batches == 3
+        finally:
+            trapper.stop()
+
+
+class AggregatorTestCase(unittest.TestCase):
+
+    def test_sketch(self):
+        import random
+        values = [random.expovariate(1) for _ in range(10000)]
+        sketch = QuantileSketch(0.01)
+        for value in values[:5000]:
+            sketch.add(value)
+        other = QuantileSketch(0.01)
+        for value in values[5000:] + [0, -1]:
+            other.add(value)
+        sketch.merge(other)
+        values = sorted(values + [0, -1])
+        for q in (0.5, 0.9, 0.99):
+            exact = values[int(q * (len(values) - 1))]
+            assert abs(sketch.quantile(q) - exact) <= exact * 0.011
+        assert abs(sketch.quantile(0) + 1) <= 0.01
+        assert sketch.count == 10002
+
+    def test_bounded(self):
+        sketch = QuantileSketch(0.01, max_buckets=10)
+        for value in range(1, 10000):
+            sketch.add(value)
+        assert len(sketch.positive) == 10
+        assert abs(sketch.quantile(0.99) - 9900) < 100
+
+    def test_collect(self):
+        sender = RecordingSender()
+        aggregator = Aggregator(sender, percentiles=(50, 99.9))
+        aggregator.incr('hits')
+        aggregator.incr('hits', 2)
+        aggregator.gauge('load', 1.5, host='h')
+        aggregator.gauge('load', 2.5, host='h')
+        for value in (0.1, 0.2, 0.3):
+            aggregator.timing('req.time[api]', value)
+        aggregator.flush()
+        metrics = dict(((m.host, m.key), m.value) for m in sender.batches[0])
+        assert metrics[None, 'hits'] == 3
+        assert metrics['h', 'load'] == 2.5
+        assert metrics[None, 'req.time.count[api]'] == 3
+        assert abs(metrics[None, 'req.time.avg[api]'] - 0.2) < 1e-9
+        assert abs(metrics[None, 'req.time.p50[api]'] - 0.2) < 0.003
+        assert (None, 'req.time.p99.9[api]') in metrics
+        aggregator.flush()
+        assert [(m.host, m.key, m.value) for m in sender.batches[1]] == [
+            ('h', 'load', 2.5)]
+
+    def test_gauge_expiry(self):
+        aggregator = Aggregator(RecordingSender(), gauge_expiry=60)
+        aggregator.gauge('load', 10)
+        aggregator.collect()
+        aggregator.gauge('load', 5, delta=True)
+        assert [m.value for m in aggregator.collect()] == [15]
+        assert aggregator.collect(time.time() + 120) == []
+        aggregator.gauge('load', 5, delta=True)
+        assert [m.value for m in aggregator.collect()] == [5]
+
+    def test_cardinality(self):
+        sketch = CardinalitySketch(max_exact=100)
+        for member in range(50):
+            sketch.add(member)
+            sketch.add(member)
+        assert len(sketch) == 50
+        for member in range(100000):
+            sketch.add('user%d' % member)
+        assert sketch.members is None and len(sketch.registers) == 4096
+        assert abs(len(sketch) - 100050) < 100050 * 0.05
+
+
+class DeduplicatorTestCase(unittest.TestCase):
+
+    def test_filter(self):
+        dedup = Deduplicator(heartbeat=60, tolerances={'load': 0.5})
+        sent = dedup.filter([Metric('version', '1.0', clock=1000),
+                             Metric('load', 1.0, clock=1000)])
+        assert len(sent) == 2
+        sent = dedup.filter([Metric('version', '1.0', clock=1010),
+                             Metric('load', 1.4, clock=1010),
+                             Metric('load', 1.4, host='other', clock=1010)])
+        assert [(m.host, m.key) for m in sent] == [('other', 'load')]
+        sent = dedup.filter([Metric('version', '1.1', clock=1020),
+                             Metric('load', 1.6, clock=1020)])
+        assert len(sent) == 2
+        sent = dedup.filter([Metric('version', '1.1', clock=1080)])
+        assert len(sent) == 1
+        assert dedup.stats() == {'entries': 3, 'passed': 6, 'suppressed': 2,
+                                 'heartbeats': 1, 'evictions': 0}
+
+    def test_bounded(self):
+        dedup = Deduplicator(max_entries=2)
+        dedup.filter([Metric('a', 1), Metric('b', 1)])
+        dedup.filter([Metric('a', 1), Metric('c', 1)])
+        assert len(dedup) == 2 and dedup.evictions == 1
+        assert len(dedup.filter([Metric('a', 1), Metric('b', 1)])) == 1
+
+    def test_sender(self):
+        trapper = FakeTrapper()
+        dedup = Deduplicator()
+        try:
+            with Sender(port=trapper.port, dedup=dedup) as sender:
+                sender.send([Metric('key', 1), Metric('other', 2)])
+                result = sender.send([Metric('key', 1), Metric('other', 3)])
+            assert result.total == 1
+            port = trapper.port
+        finally:
+            trapper.stop()
+        with Sender(port=port, timeout=1, dedup=dedup) as sender:
+            with self.assertRaises(SenderException):
+                sender.send([Metric('key', 2)])
+        assert len(dedup.filter([Metric('key', 2)])) == 1
+
+
+class FlowControlTestCase(unittest.TestCase):
+
+    def test_aimd(self):
+        flow = FlowControl(min_values=10, max_values=100, max_inflight=4,
+                           target_latency=1., step=40)
+        for _ in range(5):
+            flow.completed(Result(10, 0, 10), 0.1)
+        assert (flow.values, flow.inflight, flow.pause()) == (100, 4, 0.)
+        flow.completed(Result(10, 0, 10), 2.)
+        assert (flow.values, flow.inflight) == (50, 2)
+        assert 0 <= flow.pause() <= flow.backoff == 0.05
+        flow.completed(Result(2, 8, 10), 0.1)
+        flow.failed()
+        assert (flow.values, flow.inflight) == (12, 1)
+        assert flow.state()['backoff'] == 0.2
+        assert flow.state()['saturations'] == 3
+        flow.completed(Result(10, 0, 10), 0.8)
+        assert (flow.values, flow.inflight, flow.backoff) == (52, 1, 0.)
+
+    def test_sender(self):
+        trapper = FakeTrapper()
+        flow = FlowControl(min_values=2, max_values=8, step=2)
+        try:
+            with Sender(port=trapper.port, flow=flow) as sender:
+                metrics = [Metric('key', i) for i in range(20)]
+                result = sender.send(metrics)
+        finally:
+            trapper.stop()
+        assert result.processed == 20
+        sizes = [len(request['data']) for request in trapper.requests]
+        assert sorted(sizes)[0] == 2 and max(sizes) > 2
+
+
+class SharedBufferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.path = os.path.join(tempfile.mkdtemp(), 'metrics')
+
+    def fork(self, buffer, count):
+        pid = os.fork()
+        if not pid:
+            for i in range(count):
+                buffer.submit(Metric('child', i, clock=1))
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+    def test_workers(self):
+        from zbx.metrics.shm import Flusher, SharedBuffer
+        buffer = SharedBuffer(self.path, lanes=4, slots=8, slot_size=64)
+        assert buffer.submit(Metric('parent', 1, clock=1))
+        assert not buffer.submit(Metric('parent', 'x' * 100))
+        self.fork(buffer, 10)
+        self.fork(buffer, 3)
+        lanes = dict((lane['lane'], lane) for lane in buffer.stats())
+        assert lanes[0]['pending'] == 1 and lanes[0]['dropped'] == 1
+        assert lanes[1]['pending'] == 8 and lanes[1]['dropped'] == 5
+
+        sender = RecordingSender()
+        flusher = Flusher(SharedBuffer(self.path), sender, batch_size=5)
+        assert flusher.flush() == 9
+        assert [len(batch) for batch in sender.batches] == [5, 4]
+        metrics = sender.batches[0]
+        assert (metrics[0].key, metrics[0].value) == ('parent', '1')
+        assert [m.value for m in metrics[1:]] == ['0', '1', '2', '3']
+        assert buffer.submit(Metric('parent', 2))
+        sender.error = SenderException('down')
+        assert flusher.flush() == 0
+        sender.error = None
+        flusher.close()
+        assert [m.value for m in sender.batches[-1]] == ['2']
+
+
+class DiscoverySenderTestCase(unittest.TestCase):
+
+    def test_payload(self):
+        from zbx.metrics.discovery import discovery_payload
+        payload = discovery_payload([{'worker': 'b', '{#PORT}': 80},
+                                     {'worker': 'a'}, {'worker': 'b',
+                                                       '{#PORT}': 80}])
+        assert payload == '{"data":[{"{#PORT}":"80","{#WORKER}":"b"},' \
+                          '{"{#WORKER}":"a"}]}'
+        assert json.loads(payload)['data'][1] == {'{#WORKER}': 'a'}
+
+    def test_changes(self):
+        from zbx.metrics.discovery import DiscoverySender
+        sender = RecordingSender()
+        discovery = DiscoverySender(sender, keepalive=3600)
+        rows = [{'worker': 'a'}, {'worker': 'b'}]
+        assert discovery.update('circus.discovery', rows) is not None
+        assert discovery.update('circus.discovery', rows[::-1]) is None
+        assert discovery.send([('circus.discovery', rows, None),
+                               ('circus.discovery', rows, 'other')])
+        assert [m.host for m in sender.batches[-1]] == ['other']
+        discovery.keepalive = 0
+        discovery.update('circus.discovery', rows)
+        discovery.keepalive = 3600
+        discovery.update('circus.discovery', rows[:1])
+        assert (discovery.sent, discovery.skipped) == (4, 2)
+        sender.error = SenderException('down')
+        discovery.forget('circus.discovery')
+        with self.assertRaises(SenderException):
+            discovery.update('circus.discovery', rows[:1])
+        sender.error = None
+        assert discovery.update('circus.discovery', rows[:1]) is not None
+
+
+class SchedulerTestCase(unittest.TestCase):
+
+    class Collector(object):
+
+        def __init__(self):
+            self.metrics = []
+
+        def submit(self, metric):
+            self.metrics.append(metric)
+
+    def test_nextcheck(self):
+        from zbx.metrics.scheduler import Check
+        check = Check('key', None, '1m', host='h')
+        nextcheck = check.nextcheck(6000)
+        assert 6000 < nextcheck <= 6060
+        assert nextcheck % 60 == check.seed % 60
+        assert Check('key', None, 60, host='h').nextcheck(6000) == nextcheck
+        flex = Check('key', None, 60,
+                     delay_flex='0/1-7,00:00-24:00;10/1-7,00:00-00:00')
+        with self.assertRaises(ValueError):
+            flex.nextcheck(6000)
+
+    def test_run(self):
+        from zbx.metrics.scheduler import Scheduler
+        collector = self.Collector()
+        scheduler = Scheduler(collector, workers=2)
+        release = threading.Event()
+        calls = []
+        fast = scheduler.register('fast',
+                                  lambda: calls.append(1) or len(calls), 10)
+        slow = scheduler.register('slow', release.wait, 10, host='h',
+                                  args=(5,))
+        failing = scheduler.register('failing', lambda: 1 / 0, 10)
+        now = time.time()
+        assert scheduler.run_pending(now) > now
+        scheduler.run_pending(now + 10)
+        while not (fast.runs and failing.runs):
+            time.sleep(0.001)
+        scheduler.run_pending(now + 40)
+        assert slow.skipped == 3
+        release.set()
+        scheduler.unregister('failing')
+        scheduler.close()
+        assert len(scheduler) == 2 and failing.errors == 2
+        assert sorted(m.value for m in collector.metrics
+                      if m.key == 'fast') == [1, 2]
+        assert [(m.host, m.value) for m in collector.metrics
+                if m.key == 'slow'] == [('h', True)]
+        assert scheduler.stats()['skipped'] == 5
+
+
+class ActiveAgentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            from zbx.metrics.active import ActiveAgent
+        except SyntaxError:
+            raise unittest.SkipTest('asyncio is not available')
+        self.ActiveAgent = ActiveAgent
+
+    def test_checks(self):
+        checks = [{'key': 'py.answer[a, "b"]', 'delay': '30s'},
+                  {'key': 'py.answer[c]', 'delay': 60},
+                  {'key': 'nohandler', 'delay': 60},
+                  {'key': 'macro', 'delay': '{$DELAY}'}]
+        trapper = FakeTrapper(active_checks={'web1': checks})
+        agent = self.ActiveAgent('web1', port=trapper.port,
+                                 host_metadata='linux')
+        agent.register('py.answer', lambda key, *params: ','.join(params))
+        try:
+            assert agent.refresh_checks()
+            assert sorted(agent.checks) == ['py.answer[a, "b"]',
+                                            'py.answer[c]']
+            assert len(agent.scheduler) == 2
+            assert agent.unsupported == set(['nohandler'])
+            checks[1:] = []
+            assert agent.refresh_checks()
+            assert len(agent.scheduler) == 1
+            agent.scheduler.run_pending(time.time() + 60)
+        finally:
+            agent.close()
+            trapper.stop()
+        request = trapper.requests[0]
+        assert request == {'request': 'active checks', 'host': 'web1',
+                           'host_metadata': 'linux'}
+        request = trapper.requests[-1]
+        assert request['request'] == 'agent data'
+        assert [(d['host'], d['key'], d['value']) for d in request['data']] \
+            == [('web1', 'py.answer[a, "b"]', 'a,b')]
+        assert not agent.refresh_checks()
+
+
+class TLSTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        import ssl
+        import subprocess
+        import tempfile
+        try:
+            from shutil import which
+        except ImportError:
+            from distutils.spawn import find_executable as which
+        if not hasattr(ssl, 'PROTOCOL_TLS_CLIENT'):
+            raise unittest.SkipTest('ssl has no client and server contexts')
+        if not which('openssl'):
+            raise unittest.SkipTest('openssl is not available')
+        cls.path = tempfile.mkdtemp()
+        cls.cert = os.path.join(cls.path, 'cert.pem')
+        key = os.path.join(cls.path, 'key.pem')
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.check_call([
+                'openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt',
+                'ec_paramgen_curve:prime256v1', '-nodes', '-days', '1',
+                '-subj', '/CN=localhost', '-keyout', key, '-out', cls.cert],
+                stdout=devnull, stderr=devnull)
+        cls.server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        cls.server_context.load_cert_chain(cls.cert, key)
+
+    def test_resumption(self):
+        trapper = FakeTrapper(ssl_context=self.server_context)
+        try:
+            sender = Sender(port=trapper.port, max_values=1, max_inflight=1,
+                            tls=tls_context(ca_file=self.cert))
+            result = sender.send([Metric('key', i) for i in range(3)])
+            untrusted = Sender(port=trapper.port, tls=tls_context())
+            with self.assertRaises(SenderException):
+                untrusted.send([Metric('key', 1)])
+        finally:
+            trapper.stop()
+        assert (result.processed, result.batches) == (3, 3)
+        stats = sender.tls_stats()
+        assert (stats['handshakes'], stats['resumed']) == (1, 2)
+        assert stats['handshake_seconds'] > 0
+        assert trapper.values == 3
+
+
+class IngestTestCase(unittest.TestCase):
+
+    def test_read_batches(self):
+        lines = ['web1 cpu.load 1.5\n',
+                 '\n',
+                 '- "app[\\"a b\\"]" "two words"\r\n',
+                 'web1 missing\n',
+                 '"web2"\tcpu.load\t3\n']
+        failures = []
+        batches = list(read_batches(lines, batch_size=2, failures=failures))
+        assert [len(batch) for batch in batches] == [2, 1]
+        assert [(m.host, m.key, m.value) for m in batches[0]] == [
+            ('web1', 'cpu.load', '1.5'), (None, 'app["a b"]', 'two words')]
+        assert [m.host for m in batches[1]] == ['web2']
+        assert failures == [
+            Failure(4, 'web1 missing', 'expected host, key and value')]
+        with self.assertRaises(ValueError):
+            list(read_batches(['web1 "key 1\n']))
+
+    def test_read_timestamps_and_json(self):
+        batch, = read_batches(['web1 key 1400000000 1\n'],
+                              with_timestamps=True)
+        assert [m.clock for m in batch] == [1400000000]
+        failures = []
+        batch, = read_batches(['{"host": "web1", "key": "k", "value": 2}',
+                               '{"key": "k", "value": 3, "clock": 1400000000}',
+                               '{"key": "k", "value": 4, "clock": "now"}',
+                               '[1]',
+                               '{"host": 1, "key": "k", "value": 5}',
+                               '{"key": 1, "value": 6}',
+                               '{"key": "k", "value": [7]}'],
+                              ndjson=True, failures=failures)
+        assert [(m.host, m.value, m.clock) for m in batch] == [
+            ('web1', 2, None), (None, 3, 1400000000)]
+        assert [failure.lineno for failure in failures] == [3, 4, 5, 6, 7]
+        assert failures[2].error == 'invalid host 1'
+
+    def test_ingest(self):
+        lines = ['web1 key {}\n'.format(i) for i in range(25)] + ['bad\n']
+        with FakeTrapper(unsupported=['unknown']) as trapper:
+            with Sender(port=trapper.port, max_values=10) as sender:
+                result, failures = ingest(lines, sender, batch_size=20)
+        assert (result.processed, result.batches) == (25, 3)
+        assert [failure.lineno for failure in failures] == [26]
+        assert trapper.values == 25
+
+    def test_ingest_overlaps(self):
+        reading = threading.Event()
+
+        def lines():
+            for i in range(4):
+                if i == 2:
+                    reading.set()
+                yield 'web1 key {}\n'.format(i)
+
+        overlapped = []
+
+        class SlowSender(RecordingSender):
+            def send(self, metrics):
+                # the next lines are read while this batch is sent
+                overlapped.append(reading.wait(2))
+                return RecordingSender.send(self, metrics)
+
+        sender = SlowSender()
+        ingest(lines(), sender, batch_size=2)
+        assert overlapped == [True, True]
+        assert [[m.value for m in batch] for batch in sender.batches] == [
+            ['0', '1'], ['2', '3']]
+
+    def test_cli(self):
+        import tempfile
+        from zbx.cli import main
+
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as values:
+            values.write('- key 1\nweb1 unknown 2\nweb1 key\n')
+            values.flush()
+            with FakeTrapper(unsupported=['unknown']) as trapper:
+                status = main(['send', '-p', str(trapper.port), '-s', 'web2',
+                               '-i', values.name])
+        assert status == 2
+        assert [d['host'] for d in trapper.requests[0]['data']] == [
+            'web2', 'web1']
+        assert main(['send', '-p', '1', '--timeout', '0.5',
+                     '-i', values.name + '.missing']) == 1
+        with tempfile.NamedTemporaryFile('wb', suffix='.txt') as values:
+            values.write(b'- key \xff\n')
+            values.flush()
+            assert main(['send', '-p', '1', '--timeout', '0.5',
+                         '-i', values.name]) == 1
+
+    def test_cli_send_failed(self):
+        import tempfile
+        from zbx.cli import main
+
+        trapper = FakeTrapper()
+        port = trapper.port
+        trapper.stop()
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as values:
+            values.write('web1 key\n- key 1\n')
+            values.flush()
+            stderr, sys.stderr = sys.stderr, StringIO()
+            try:
+                status = main(['send', '-p', str(port), '--timeout', '0.5',
+                               '-v', '-i', values.name])
+                output = sys.stderr.getvalue()
+            finally:
+                sys.stderr = stderr
+        assert status == 1
+        assert 'Sending failed' in output
+        assert 'line 1: expected host, key and value: {!r}'.format(
+            u'web1 key') in output
@@ -8,7 +8,9 @@
 """
 
 __all__ = ['Api', 'RPCException', 'cast',
-           'authenticate', 'request', 'configure']
+           'authenticate', 'request', 'configure',
+           'Change', 'Snapshot', 'EventStream', 'FileCursor', 'MemoryCursor',
+           'HistoryCache', 'Query', 'Rollup', 'rollup']
 
 import json
 import logging
@@ -27,6 +29,11 @@ else:
         return contextlib.closing(urlopen(request))
 
 from zbx.exceptions import RPCException
+from .events import *  # NOQA
+from .history import *  # NOQA
+from .query import *  # NOQA
+from .rollup import *  # NOQA
+from .snapshot import *  # NOQA
 
 logger = logging.getLogger(__name__)
 
@@ -0,0 +1,150 @@
+"""
+    zbx.api.events
+    ~~~~~~~~~~~~~~
+
+    Follow events and problems as they are created.
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['EventStream', 'FileCursor', 'MemoryCursor']
+
+import logging
+import os
+import time
+
+from zbx.util import load
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryCursor(object):
+    """
+    Cursor which lives as long as the process.
+    """
+
+    def __init__(self, value=None):
+        self.value = value
+
+    def load(self):
+        return self.value
+
+    def save(self, value):
+        self.value = value
+
+
+class FileCursor(object):
+    """
+    Cursor persisted into a file, replaced atomically on save.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                return int(file.read().strip())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, value):
+        tmp = '{}.tmp'.format(self.path)
+        with open(tmp, 'w') as file:
+            file.write(str(value))
+        os.rename(tmp, self.path)
+
+
+class EventStream(object):
+    """
+    Endless iterator over ``event.get`` or ``problem.get``.
+
+    Only events newer than the cursor are requested, by pages of page_size,
+    ordered by eventid. The cursor is saved each time the consumer asks for
+    the next event, so a restart resumes after the last handled event.
+    An event is never saved before the consumer moved past it: a consumer
+    which stops after handling an event may commit it, otherwise it is
+    delivered again. Without a saved cursor, the stream starts after the
+    newest event.
+
+    When nothing new comes, the poll interval grows by backoff up to
+    max_interval, and drops back to min_interval as soon as events come.
+
+    Parameters:
+    method -- ``event.get`` or ``problem.get``
+    params -- extra params (source, object, severities...)
+    cursor -- where the last eventid is saved, MemoryCursor by default
+    settle -- hold events younger than this number of seconds, because
+              eventids may be committed out of order by the server
+    """
+
+    def __init__(self, method='event.get', params=None, cursor=None,
+                 api=None, page_size=500, min_interval=1, max_interval=60,
+                 backoff=2, settle=0):
+        self.api = api or load('zbx.api._instance')
+        self.method = method
+        self.params = dict(params or {})
+        self.params.setdefault('output', 'extend')
+        self.cursor = cursor or MemoryCursor()
+        self.page_size = page_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.settle = settle
+
+    def __iter__(self):
+        return self.stream()
+
+    def commit(self, eventid):
+        """Saves the cursor at eventid, once the consumer handled it"""
+        self.cursor.save(int(eventid))
+
+    def latest(self):
+        """Returns the newest eventid, or 0"""
+        params = dict(self.params, output=['eventid'], sortfield='eventid',
+                      sortorder='DESC', limit=1)
+        events = self.api.request(self.method, params)
+        return int(events[0]['eventid']) if events else 0
+
+    def fetch(self, after):
+        """
+        Fetch a page of events with eventid greater than after.
+        """
+        params = dict(self.params, eventid_from=after + 1,
+                      sortfield='eventid', sortorder='ASC',
+                      limit=self.page_size)
+        events = self.api.request(self.method, params) or []
+        events.sort(key=lambda event: int(event['eventid']))
+        if self.settle:
+            horizon = time.time() - self.settle
+            for i, event in enumerate(events):
+                if int(event['clock']) > horizon:
+                    return events[:i]
+        return events
+
+    def stream(self):
+        after = self.cursor.load()
+        if after is None:
+            after = self.latest()
+            self.cursor.save(after)
+        logger.debug('%s stream starts after %s', self.method, after)
+
+        interval = self.min_interval
+        while True:
+            events = self.fetch(after)
+            for event in events:
+                yield event
+                after = int(event['eventid'])
+                self.cursor.save(after)
+
+            if len(events) >= self.page_size:
+                interval = self.min_interval
+                continue
+            if events:
+                interval = self.min_interval
+            else:
+                interval = min(interval * self.backoff, self.max_interval)
+            self.sleep(interval)
+
+    def sleep(self, interval):
+        time.sleep(interval)
@@ -0,0 +1,322 @@
+"""
+    zbx.api.history
+    ~~~~~~~~~~~~~~~
+
+    On-disk cache of history and trends.
+
+    Records of an item are kept ordered by clock into a file of fixed-width
+    binary records, which is read through mmap. An index remembers which
+    intervals of time are already cached, so only the missing ranges are
+    requested to the api.
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['HistoryCache']
+
+from collections import defaultdict
+from heapq import merge as merge_sorted
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+from zbx.util import load
+
+logger = logging.getLogger(__name__)
+
+#: history record layouts by value_type, only numeric values are cached
+HISTORY_LAYOUTS = {
+    0: struct.Struct('<qd'),  # clock, numeric float
+    3: struct.Struct('<qQ'),  # clock, numeric unsigned
+}
+
+#: clock, num, value_min, value_avg, value_max
+TREND_LAYOUT = struct.Struct('<qIddd')
+
+CLOCK = struct.Struct('<q')
+
+
+def missing(intervals, start, end):
+    """Returns the gaps of intervals into [start, end]"""
+    gaps = []
+    for low, high in intervals:
+        if high < start:
+            continue
+        if low > end:
+            break
+        if low > start:
+            gaps.append((start, low - 1))
+        start = max(start, high + 1)
+    if start <= end:
+        gaps.append((start, end))
+    return gaps
+
+
+def covered(intervals, start, end):
+    """Returns intervals plus [start, end], merged"""
+    merged = []
+    for low, high in sorted(list(intervals) + [(start, end)]):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+        else:
+            merged.append((low, high))
+    return merged
+
+
+def normalize(items):
+    """Returns {itemid: value_type} from a mapping, pairs or item dicts"""
+    if isinstance(items, dict):
+        items = items.items()
+    normalized = {}
+    for item in items:
+        if isinstance(item, dict):
+            item = item['itemid'], item['value_type']
+        itemid, value_type = item
+        normalized[int(itemid)] = int(value_type)
+    return normalized
+
+
+class Segment(object):
+    """
+    File of fixed-width records ordered by clock.
+    """
+
+    def __init__(self, path, layout):
+        self.path = path
+        self.layout = layout
+
+    def __len__(self):
+        try:
+            return os.path.getsize(self.path) // self.layout.size
+        except OSError:
+            return 0
+
+    def read(self, start, end):
+        """Returns the records with start <= clock <= end"""
+        size = self.layout.size
+        count = len(self)
+        if not count:
+            return []
+        with open(self.path, 'rb') as file:
+            data = mmap.mmap(file.fileno(), count * size,
+                             access=mmap.ACCESS_READ)
+            try:
+                first = self._bisect(data, count, start)
+                last = self._bisect(data, count, end + 1)
+                if not hasattr(self.layout, 'iter_unpack'):
+                    # python 2
+                    unpack = self.layout.unpack_from
+                    return [unpack(data, offset) for offset
+                            in range(first * size, last * size, size)]
+                view = memoryview(data)[first * size:last * size]
+                try:
+                    return list(self.layout.iter_unpack(view))
+                finally:
+                    view.release()
+            finally:
+                data.close()
+
+    def _bisect(self, data, count, clock):
+        low, high = 0, count
+        size = self.layout.size
+        while low < high:
+            middle = (low + high) // 2
+            if CLOCK.unpack_from(data, middle * size)[0] < clock:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def last_clock(self):
+        count = len(self)
+        if not count:
+            return None
+        with open(self.path, 'rb') as file:
+            file.seek((count - 1) * self.layout.size)
+            return CLOCK.unpack(file.read(CLOCK.size))[0]
+
+    def write(self, records, start=None, end=None):
+        """
+        Stores the records fetched from start to end, which default to the
+        clocks of the first and last records.
+
+        The stored records of this range are replaced, so a range fetched
+        again is not stored twice. Records are appended when they come
+        after the stored ones.
+        """
+        records.sort(key=lambda record: record[0])
+        if records:
+            start = records[0][0] if start is None else start
+            end = records[-1][0] if end is None else end
+        elif start is None:
+            return
+        last = self.last_clock()
+        if last is None or start > last:
+            if records:
+                with open(self.path, 'ab') as file:
+                    file.write(self._pack(records))
+            return
+
+        stored = [record for record in self.read(float('-inf'), float('inf'))
+                  if not start <= record[0] <= end]
+        tmp = '{}.tmp'.format(self.path)
+        with open(tmp, 'wb') as file:
+            file.write(self._pack(merge_sorted(stored, records)))
+        os.rename(tmp, self.path)
+
+    def _pack(self, records):
+        pack = self.layout.pack
+        return b''.join(pack(*record) for record in records)
+
+
+class HistoryCache(object):
+    """
+    Cache of ``history.get`` and ``trend.get`` results.
+
+    Parameters:
+    path -- directory where records are stored
+    window -- maximum number of seconds requested by call
+    horizon -- recent values may still be written by the server, so
+               the last horizon seconds are fetched but never cached
+    """
+
+    def __init__(self, path, api=None, window=86400, horizon=300):
+        self.api = api or load('zbx.api._instance')
+        self.path = path
+        self.window = window
+        self.horizon = horizon
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._index = self._load_index()
+
+    def history(self, items, time_from, time_till):
+        """
+        Returns {itemid: [(clock, value), ...]} of numeric items.
+
+        items is a mapping of itemid to value_type, pairs of them or the
+        item dicts returned by ``item.get``.
+        """
+        items = normalize(items)
+        for itemid, value_type in items.items():
+            if value_type not in HISTORY_LAYOUTS:
+                raise ValueError('Item {} value_type {} cannot be cached'
+                                 .format(itemid, value_type))
+
+        by_value_type = defaultdict(list)
+        for itemid, value_type in items.items():
+            by_value_type[value_type].append(itemid)
+
+        response = {}
+        for value_type, itemids in by_value_type.items():
+            layout = HISTORY_LAYOUTS[value_type]
+            cast = float if value_type == 0 else int
+
+            def fetch(itemids, start, end, value_type=value_type, cast=cast):
+                rows = self.api.request('history.get', {
+                    'history': value_type,
+                    'itemids': itemids,
+                    'time_from': start,
+                    'time_till': end,
+                    'output': ['itemid', 'clock', 'value'],
+                    'sortfield': 'clock',
+                    'sortorder': 'ASC',
+                }) or []
+                for row in rows:
+                    yield int(row['itemid']), (int(row['clock']),
+                                               cast(row['value']))
+
+            response.update(self._cached(
+                'history:{}'.format(value_type), itemids, layout, fetch,
+                time_from, time_till, time.time() - self.horizon))
+        return response
+
+    def trends(self, itemids, time_from, time_till):
+        """
+        Returns {itemid: [(clock, num, min, avg, max), ...]}.
+        """
+
+        def fetch(itemids, start, end):
+            rows = self.api.request('trend.get', {
+                'itemids': itemids,
+                'time_from': start,
+                'time_till': end,
+                'output': ['itemid', 'clock', 'num',
+                           'value_min', 'value_avg', 'value_max'],
+            }) or []
+            for row in rows:
+                yield int(row['itemid']), (
+                    int(row['clock']), int(row['num']),
+                    float(row['value_min']), float(row['value_avg']),
+                    float(row['value_max']))
+
+        # the trend of the running hour is not written yet
+        settled = time.time() - self.horizon - 3600
+        return self._cached('trend', [int(i) for i in itemids], TREND_LAYOUT,
+                            fetch, time_from, time_till, settled)
+
+    def _cached(self, source, itemids, layout, fetch,
+                time_from, time_till, settled):
+        # clocks are whole seconds, time.time() is not
+        time_from, time_till = int(time_from), int(time_till)
+        # items which miss the same ranges are fetched together
+        gaps = defaultdict(list)
+        for itemid in itemids:
+            intervals = self._index.get('{}:{}'.format(source, itemid), [])
+            for gap in missing(intervals, time_from, time_till):
+                gaps[gap].append(itemid)
+
+        pending = defaultdict(list)
+        for (start, end), group in gaps.items():
+            limit = min(end, int(settled))
+            fetched = defaultdict(list)
+            for low in range(start, end + 1, self.window):
+                high = min(low + self.window - 1, end)
+                logger.debug('fetch %s of %s items from %s to %s',
+                             source, len(group), low, high)
+                for itemid, record in fetch(group, low, high):
+                    if record[0] <= limit:
+                        fetched[itemid].append(record)
+                    else:
+                        pending[itemid].append(record)
+            if limit < start:
+                continue
+            for itemid in group:
+                self._segment(source, itemid, layout).write(fetched[itemid],
+                                                            start, limit)
+                key = '{}:{}'.format(source, itemid)
+                self._index[key] = covered(self._index.get(key, []),
+                                           start, limit)
+        if gaps:
+            self._save_index()
+
+        response = {}
+        for itemid in itemids:
+            records = self._segment(source, itemid, layout).read(time_from,
+                                                                 time_till)
+            if pending[itemid]:
+                records = list(merge_sorted(records, sorted(pending[itemid])))
+            response[itemid] = records
+        return response
+
+    def _segment(self, source, itemid, layout):
+        name = '{}.{}.bin'.format(source.replace(':', '.'), itemid)
+        return Segment(os.path.join(self.path, name), layout)
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.path, 'index.json')) as file:
+                index = json.load(file)
+        except (IOError, OSError, ValueError):
+            return {}
+        return dict((key, [tuple(interval) for interval in intervals])
+                    for key, intervals in index.items())
+
+    def _save_index(self):
+        path = os.path.join(self.path, 'index.json')
+        tmp = '{}.tmp'.format(path)
+        with open(tmp, 'w') as file:
+            json.dump(self._index, file, sort_keys=True)
+        os.rename(tmp, path)
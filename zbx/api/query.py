@@ -0,0 +1,204 @@
+"""
+    zbx.api.query
+    ~~~~~~~~~~~~~
+
+    Compile the fields and predicates really used by the caller into the
+    tightest ``output``, ``filter``, ``search`` and ``limit`` params.
+    Predicates the server cannot handle are evaluated client side.
+
+    For example::
+
+        items = (Query('item.get')
+                 .fields('itemid', 'name')
+                 .where(hostids=10084, status=0, name__contains='cpu',
+                        lastvalue__gt=10)
+                 .limit(10)
+                 .all())
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['Query']
+
+import operator
+import re
+
+from six import integer_types
+from six import string_types
+
+from zbx.util import load
+
+#: lookups evaluated client side
+OPERATORS = {
+    'exact': operator.eq,
+    'ne': operator.ne,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'in': lambda value, choices: value in choices,
+    'contains': lambda value, text: text in '{}'.format(value),
+    'icontains': lambda value, text: (
+        text.lower() in '{}'.format(value).lower()),
+    'startswith': lambda value, text: '{}'.format(value).startswith(text),
+    'istartswith': lambda value, text: (
+        '{}'.format(value).lower().startswith(text.lower())),
+    'regex': lambda value, pattern: (
+        re.search(pattern, '{}'.format(value)) is not None),
+    'call': lambda value, func: func(value),
+}
+
+#: lookups which have a dedicated param, by method
+RANGES = {
+    'history.get': {'clock': ('time_from', 'time_till')},
+    'trend.get': {'clock': ('time_from', 'time_till')},
+    'event.get': {'clock': ('time_from', 'time_till'),
+                  'eventid': ('eventid_from', 'eventid_till')},
+    'problem.get': {'clock': ('time_from', 'time_till'),
+                    'eventid': ('eventid_from', 'eventid_till')},
+}
+
+
+def parse_lookup(lookup, value):
+    field, _, name = lookup.partition('__')
+    if not name:
+        name = 'call' if callable(value) else 'exact'
+    if name not in OPERATORS:
+        raise ValueError('{} is not a known lookup'.format(lookup))
+    return field, name
+
+
+class Query(object):
+    """
+    Builder of ``*.get`` requests.
+
+    Lookups are written ``field__operator=value``, operators are exact
+    (the default), in, ne, gt, gte, lt, lte, contains, icontains,
+    startswith, istartswith and regex. A callable value is called with the
+    field value. Names ending with ids, like ``hostids``, are sent as
+    params, other raw params like ``selectHosts`` are given with
+    :meth:`params`.
+    """
+
+    def __init__(self, method, api=None):
+        self.api = api or load('zbx.api._instance')
+        self.method = method
+        self._fields = []
+        self._lookups = []
+        self._order = []
+        self._limit = None
+        self._params = {}
+
+    def fields(self, *names):
+        """Only these fields are returned"""
+        self._fields.extend(names)
+        return self
+
+    def where(self, **lookups):
+        """Keep only the objects which satisfy all lookups"""
+        for lookup, value in sorted(lookups.items()):
+            if lookup.endswith('ids') and '__' not in lookup:
+                self._params[lookup] = value
+                continue
+            field, name = parse_lookup(lookup, value)
+            self._lookups.append((field, name, value))
+        return self
+
+    def order_by(self, *fields):
+        """Sort by fields, prefixed by - for descending order"""
+        self._order.extend(fields)
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def params(self, **params):
+        """Raw params, sent as is"""
+        self._params.update(params)
+        return self
+
+    def compile(self):
+        """
+        Returns the params to send and the lookups left to the client.
+        """
+        params = dict(self._params)
+        filters, search, client = {}, [], []
+        ranges = RANGES.get(self.method, {})
+
+        for field, name, value in self._lookups:
+            if name in ('exact', 'in') and field not in filters:
+                filters[field] = list(value) if name == 'in' else value
+                continue
+
+            if field in ranges and isinstance(value, integer_types):
+                low, high = ranges[field]
+                bound = {'gte': (low, value), 'gt': (low, value + 1),
+                         'lte': (high, value), 'lt': (high, value - 1)}
+                if name in bound and bound[name][0] not in params:
+                    key, value = bound[name]
+                    params[key] = value
+                    continue
+
+            if name in ('contains', 'icontains', 'startswith', 'istartswith') \
+                    and isinstance(value, string_types) \
+                    and field not in [lookup[0] for lookup in search]:
+                search.append((field, name, value))
+                continue
+
+            client.append((field, name, value))
+
+        if filters:
+            params['filter'] = filters
+        if search:
+            # startSearch applies to every field, and the server search is
+            # case insensitive: what it cannot decide alone is checked again
+            start = all(name.endswith('startswith') for _, name, _ in search)
+            params['search'] = dict((field, value)
+                                    for field, _, value in search)
+            if start:
+                params['startSearch'] = True
+            for field, name, value in search:
+                if name != ('istartswith' if start else 'icontains'):
+                    client.append((field, name, value))
+
+        if self._fields:
+            output = list(self._fields)
+            for field, _, _ in client:
+                if field not in output:
+                    output.append(field)
+            params['output'] = output
+        else:
+            params.setdefault('output', 'extend')
+
+        if self._order:
+            params['sortfield'] = [field.lstrip('-') for field in self._order]
+            params['sortorder'] = ['DESC' if field.startswith('-') else 'ASC'
+                                   for field in self._order]
+
+        if self._limit is not None and not client:
+            params['limit'] = self._limit
+        return params, client
+
+    def all(self):
+        params, client = self.compile()
+        results = self.api.request(self.method, params) or []
+        if client:
+            results = [obj for obj in results if all(
+                OPERATORS[name](obj.get(field), value)
+                for field, name, value in client)]
+            if self._limit is not None:
+                results = results[:self._limit]
+            if self._fields:
+                fields = set(self._fields)
+                for obj in results:
+                    for field in set(obj) - fields:
+                        del obj[field]
+        return results
+
+    def first(self):
+        results = self.limit(1).all()
+        return results[0] if results else None
+
+    def __iter__(self):
+        return iter(self.all())
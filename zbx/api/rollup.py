@@ -0,0 +1,271 @@
+"""
+    zbx.api.rollup
+    ~~~~~~~~~~~~~~
+
+    Align history of many items onto a common time grid, and compute
+    count/sum/min/max/avg/percentiles per bucket.
+
+    NumPy is used when it is installed, typed arrays otherwise. Rows are
+    consumed page by page, only the accumulators are kept in memory.
+    Percentiles are estimated by a QuantileSketch per bucket.
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['Rollup', 'rollup']
+
+from array import array
+from collections import defaultdict
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from zbx.api.history import normalize
+from zbx.metrics.aggregate import QuantileSketch
+from zbx.util import load
+
+NAN = float('nan')
+INF = float('inf')
+
+
+def parse_percentile(stat):
+    """Returns 99.9 for 'p99.9'"""
+    try:
+        if stat.startswith('p'):
+            value = float(stat[1:])
+            if 0 <= value <= 100:
+                return value
+    except ValueError:
+        pass
+    raise ValueError('{!r} is not a known stat'.format(stat))
+
+
+def interpolate(sketch, percentile):
+    """Linear interpolation between closest ranks, like numpy"""
+    position = (sketch.count - 1) * percentile / 100.
+    low = sketch.value_at(math.floor(position))
+    high = sketch.value_at(math.ceil(position))
+    return low + (high - low) * (position - math.floor(position))
+
+
+def columns(rows):
+    """Splits rows into itemids, clocks and values"""
+    itemids, clocks, values = [], [], []
+    for row in rows:
+        if isinstance(row, dict):
+            row = row['itemid'], row['clock'], row['value']
+        itemids.append(int(row[0]))
+        clocks.append(int(row[1]))
+        values.append(float(row[2]))
+    return itemids, clocks, values
+
+
+class Rollup(object):
+    """
+    Items x buckets accumulators.
+
+    Bucket n covers ``[time_from + n * step, time_from + (n + 1) * step)``.
+
+    Parameters:
+    itemids -- the rows of the matrix, in this order
+    percentiles -- percentiles to be computed, like ``[50, 99]``
+    relative_accuracy -- of the percentiles
+    """
+
+    def __init__(self, itemids, time_from, time_till, step, percentiles=(),
+                 use_numpy=None, relative_accuracy=0.01):
+        self.itemids = [int(itemid) for itemid in itemids]
+        # clocks are whole seconds, time.time() is not
+        self.time_from = time_from = int(time_from)
+        self.time_till = time_till = int(time_till)
+        self.step = step = int(step)
+        self.buckets = (time_till - time_from) // step + 1
+        self.percentiles = tuple(percentiles)
+        self.relative_accuracy = relative_accuracy
+        self.numpy = numpy is not None if use_numpy is None else use_numpy
+        cells = len(self.itemids) * self.buckets
+
+        self._order = sorted(range(len(self.itemids)),
+                             key=self.itemids.__getitem__)
+        self._sorted = [self.itemids[i] for i in self._order]
+        if self.numpy:
+            self._rows = numpy.array(self._order, dtype=numpy.int64)
+            self._keys = numpy.array(self._sorted, dtype=numpy.int64)
+            self._count = numpy.zeros(cells, dtype=numpy.int64)
+            self._sum = numpy.zeros(cells)
+            self._min = numpy.full(cells, INF)
+            self._max = numpy.full(cells, -INF)
+        else:
+            self._rows = dict((itemid, row)
+                              for row, itemid in enumerate(self.itemids))
+            self._count = array('l', [0]) * cells
+            self._sum = array('d', [0.]) * cells
+            self._min = array('d', [INF]) * cells
+            self._max = array('d', [-INF]) * cells
+        self._sketches = {}
+
+    def grid(self):
+        """Returns the first clock of every bucket"""
+        return [self.time_from + n * self.step for n in range(self.buckets)]
+
+    def feed(self, rows):
+        """
+        Accumulates a page of rows.
+
+        Rows are the dicts returned by ``history.get`` or
+        (itemid, clock, value) tuples. Rows out of the grid are ignored.
+        """
+        if self.numpy:
+            self._feed_numpy(*columns(rows))
+        else:
+            self._feed_array(*columns(rows))
+
+    def _feed_numpy(self, itemids, clocks, values):
+        if not itemids or not len(self._keys):
+            return
+        itemids = numpy.array(itemids, dtype=numpy.int64)
+        clocks = numpy.array(clocks, dtype=numpy.int64)
+        values = numpy.array(values)
+
+        position = numpy.searchsorted(self._keys, itemids)
+        position[position >= len(self._keys)] = 0
+        buckets = (clocks - self.time_from) // self.step
+        mask = ((self._keys[position] == itemids) & (clocks >= self.time_from)
+                & (clocks <= self.time_till))
+        cells = self._rows[position[mask]] * self.buckets + buckets[mask]
+        values = values[mask]
+
+        cells_count = len(self._count)
+        self._count += numpy.bincount(cells, minlength=cells_count)
+        self._sum += numpy.bincount(cells, weights=values,
+                                    minlength=cells_count)
+        numpy.minimum.at(self._min, cells, values)
+        numpy.maximum.at(self._max, cells, values)
+        if self.percentiles:
+            # equal values of a cell are added at once
+            ordering = numpy.lexsort((values, cells))
+            cells, values = cells[ordering], values[ordering]
+            starts = numpy.flatnonzero(numpy.concatenate((
+                [True], (cells[1:] != cells[:-1]) |
+                (values[1:] != values[:-1]))))
+            counts = numpy.diff(numpy.append(starts, len(cells)))
+            for cell, value, count in zip(cells[starts].tolist(),
+                                          values[starts].tolist(),
+                                          counts.tolist()):
+                self._sketch(cell).add(value, count)
+
+    def _feed_array(self, itemids, clocks, values):
+        rows = self._rows
+        count, total = self._count, self._sum
+        minimum, maximum = self._min, self._max
+        for itemid, clock, value in zip(itemids, clocks, values):
+            row = rows.get(itemid)
+            if row is None or not self.time_from <= clock <= self.time_till:
+                continue
+            cell = row * self.buckets + (clock - self.time_from) // self.step
+            count[cell] += 1
+            total[cell] += value
+            if value < minimum[cell]:
+                minimum[cell] = value
+            if value > maximum[cell]:
+                maximum[cell] = value
+            if self.percentiles:
+                self._sketch(cell).add(value)
+
+    def _sketch(self, cell):
+        try:
+            return self._sketches[cell]
+        except KeyError:
+            sketch = self._sketches[cell] = QuantileSketch(
+                self.relative_accuracy)
+            return sketch
+
+    def matrix(self, stat):
+        """
+        Returns the items x buckets matrix of stat.
+
+        stat is one of count, sum, min, max, avg or a percentile like p99.
+        Empty buckets are NaN, except for count and sum.
+        With NumPy it is a 2d array, otherwise a list of arrays.
+        """
+        if stat == 'count':
+            cells = self._count
+        elif stat == 'sum':
+            cells = self._sum
+        elif stat in ('min', 'max', 'avg'):
+            cells = self._reduce(stat)
+        else:
+            percentile = parse_percentile(stat)
+            if percentile not in self.percentiles:
+                raise ValueError('percentile {} was not tracked'
+                                 .format(percentile))
+            cells = self._percentile(percentile)
+
+        if self.numpy:
+            return cells.reshape(len(self.itemids), self.buckets)
+        return [cells[row * self.buckets:(row + 1) * self.buckets]
+                for row in range(len(self.itemids))]
+
+    def _reduce(self, stat):
+        if self.numpy:
+            empty = self._count == 0
+            if stat == 'avg':
+                with numpy.errstate(invalid='ignore', divide='ignore'):
+                    cells = self._sum / self._count
+            else:
+                cells = (self._min if stat == 'min' else self._max).copy()
+            cells[empty] = NAN
+            return cells
+
+        cells = array('d', [NAN]) * len(self._count)
+        for cell, count in enumerate(self._count):
+            if not count:
+                continue
+            if stat == 'avg':
+                cells[cell] = self._sum[cell] / count
+            elif stat == 'min':
+                cells[cell] = self._min[cell]
+            else:
+                cells[cell] = self._max[cell]
+        return cells
+
+    def _percentile(self, percentile):
+        if self.numpy:
+            cells = numpy.full(len(self._count), NAN)
+        else:
+            cells = array('d', [NAN]) * len(self._count)
+        for cell, sketch in self._sketches.items():
+            cells[cell] = interpolate(sketch, percentile)
+        return cells
+
+
+def rollup(items, time_from, time_till, step, percentiles=(), api=None,
+           window=3600):
+    """
+    Fetch the history of items window by window, and returns the Rollup.
+
+    items is a mapping of itemid to value_type, pairs of them or the
+    item dicts returned by ``item.get``.
+    """
+    api = api or load('zbx.api._instance')
+    items = normalize(items)
+    time_from, time_till, step = int(time_from), int(time_till), int(step)
+    response = Rollup(sorted(items), time_from, time_till, step, percentiles)
+
+    by_value_type = defaultdict(list)
+    for itemid, value_type in items.items():
+        by_value_type[value_type].append(itemid)
+
+    for value_type, itemids in sorted(by_value_type.items()):
+        for low in range(time_from, time_till + 1, window):
+            response.feed(api.request('history.get', {
+                'history': value_type,
+                'itemids': itemids,
+                'time_from': low,
+                'time_till': min(low + window - 1, time_till),
+                'output': ['itemid', 'clock', 'value'],
+            }) or [])
+    return response
@@ -0,0 +1,144 @@
+"""
+    zbx.api.snapshot
+    ~~~~~~~~~~~~~~~~
+
+    Keep the latest value of many items, and only report what moved.
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['Change', 'Snapshot']
+
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from zbx.util import load
+
+logger = logging.getLogger(__name__)
+
+#: an item whose lastclock advanced since the previous poll
+Change = namedtuple('Change', 'itemid clock value previous')
+
+try:
+    array('Q')
+except ValueError:
+    # python 2 has no long long arrays, long has 64 bits on LP64 platforms
+    UNSIGNED, SIGNED = 'L', 'l'
+else:
+    UNSIGNED, SIGNED = 'Q', 'q'
+
+
+def chunked(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+class Snapshot(object):
+    """
+    Latest values of items, polled by pages of ``item.get``.
+
+    The store is array backed: sorted itemids and their lastclock are kept
+    into typed arrays, values into a parallel list.
+    The first poll reports every item which has a value, the next ones only
+    the items whose ``lastclock`` advanced.
+
+    Parameters:
+    params -- extra ``item.get`` params (hostids, groupids...)
+    itemids -- watch only these items, otherwise they are discovered
+    page_size -- number of items requested by ``item.get`` call
+    workers -- number of pages requested in parallel
+    """
+
+    output = ['itemid', 'lastclock', 'lastvalue']
+
+    def __init__(self, params=None, itemids=None, api=None,
+                 page_size=1000, workers=4):
+        self.api = api or load('zbx.api._instance')
+        self.params = dict(params or {})
+        self.page_size = page_size
+        self.workers = workers
+        self._itemids = array(UNSIGNED)
+        self._clocks = array(SIGNED)
+        self._values = []
+        if itemids is not None:
+            self._reset(itemids)
+
+    def __len__(self):
+        return len(self._itemids)
+
+    def __contains__(self, itemid):
+        return self._slot(itemid) is not None
+
+    def __getitem__(self, itemid):
+        """Returns (lastclock, lastvalue) of itemid"""
+        slot = self._slot(itemid)
+        if slot is None:
+            raise KeyError(itemid)
+        return self._clocks[slot], self._values[slot]
+
+    def _slot(self, itemid):
+        slot = bisect_left(self._itemids, itemid)
+        if slot < len(self._itemids) and self._itemids[slot] == itemid:
+            return slot
+
+    def _reset(self, itemids):
+        """Watch these itemids, keeping known values"""
+        previous = dict(self.items())
+        self._itemids = array(UNSIGNED, sorted(set(int(i) for i in itemids)))
+        self._clocks = array(SIGNED, [0]) * len(self._itemids)
+        self._values = [None] * len(self._itemids)
+        for slot, itemid in enumerate(self._itemids):
+            if itemid in previous:
+                self._clocks[slot], self._values[slot] = previous[itemid]
+
+    def items(self):
+        """Iterates over (itemid, (lastclock, lastvalue))"""
+        for slot, itemid in enumerate(self._itemids):
+            yield itemid, (self._clocks[slot], self._values[slot])
+
+    def discover(self):
+        """
+        Refresh the watched itemids with those matching params.
+        """
+        params = dict(self.params, output=['itemid'])
+        rows = self.api.request('item.get', params) or []
+        self._reset(row['itemid'] for row in rows)
+        logger.debug('Snapshot watches %s items', len(self._itemids))
+
+    def poll(self):
+        """
+        Fetch the latest values and returns the changes, ordered by itemid.
+        """
+        if not self._itemids:
+            self.discover()
+
+        auth_token = self.api.authenticate()
+        pages = list(chunked(self._itemids.tolist(), self.page_size))
+
+        def fetch(itemids):
+            params = dict(self.params, itemids=itemids, output=self.output)
+            return self.api.request('item.get', params, auth_token) or []
+
+        changes = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for rows in executor.map(fetch, pages):
+                changes.extend(self._merge(rows))
+        changes.sort(key=lambda change: change.itemid)
+        return changes
+
+    def _merge(self, rows):
+        for row in rows:
+            slot = self._slot(int(row['itemid']))
+            if slot is None:
+                continue
+            clock = int(row.get('lastclock') or 0)
+            if clock <= self._clocks[slot]:
+                continue
+            change = Change(self._itemids[slot], clock,
+                            row.get('lastvalue'), self._values[slot])
+            self._clocks[slot] = clock
+            self._values[slot] = change.value
+            yield change
@@ -0,0 +1,120 @@
+"""
+
+    zbx.cli
+    ~~~~~~~
+
+    The ``zbx`` console command::
+
+        zbx send -z zabbix.example.com -i values.txt
+        producer | zbx send -z zabbix.example.com -T -i -
+
+"""
+
+from __future__ import absolute_import, print_function
+
+__all__ = ['main']
+
+import argparse
+import io
+import logging
+import sys
+import time
+
+from zbx.exceptions import SenderException
+from zbx.metrics.ingest import ingest
+from zbx.metrics.sender import Result, Sender
+
+
+def open_input(path):
+    if path == '-':
+        if hasattr(sys.stdin, 'buffer'):
+            return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+        return io.open(sys.stdin.fileno(), encoding='utf-8', closefd=False)
+    return io.open(path, encoding='utf-8', buffering=1 << 20)
+
+
+def send(args):
+    tls = None
+    if args.tls_ca_file or args.tls_cert_file:
+        from zbx.metrics.tls import tls_context
+        tls = tls_context(args.tls_ca_file, args.tls_cert_file,
+                          args.tls_key_file)
+    sender = Sender(args.server, args.port, args.timeout,
+                    max_values=args.batch_size,
+                    max_inflight=args.max_inflight, hostname=args.host,
+                    compress_threshold=args.compress_threshold, tls=tls)
+    started = time.time()
+    status = 0
+    failures = []
+    try:
+        with open_input(args.input) as lines:
+            result, _ = ingest(lines, sender, args.with_timestamps,
+                               args.ndjson, args.read_size, failures)
+    except SenderException as error:
+        print('Sending failed: {}'.format(error), file=sys.stderr)
+        result, status = error.result or Result(), 1
+    except (IOError, OSError, UnicodeDecodeError) as error:
+        print('Cannot read {}: {}'.format(args.input, error),
+              file=sys.stderr)
+        return 1
+    finally:
+        sender.close()
+
+    if args.verbose:
+        for failure in failures:
+            print('line {}: {}: {!r}'.format(failure.lineno, failure.error,
+                                             failure.line), file=sys.stderr)
+    print('Response from "{}:{}": "processed: {}; failed: {}; total: {}; '
+          'seconds spent: {:.6f}"'.format(args.server, args.port,
+                                          result.processed, result.failed,
+                                          result.total, result.seconds))
+    print('sent: {}; skipped: {}; total: {}; seconds: {:.3f}'.format(
+        result.total, len(failures), result.total + len(failures),
+        time.time() - started))
+    if not status and (result.failed or failures):
+        status = 2
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='zbx')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    parser_send = commands.add_parser(
+        'send', help='send values to zabbix, like zabbix_sender -i')
+    parser_send.add_argument('--server', '-z', default='127.0.0.1',
+                             help='zabbix server or proxy')
+    parser_send.add_argument('--port', '-p', type=int, default=10051)
+    parser_send.add_argument('--host', '-s', default='localhost',
+                             help='host of the lines whose host is -')
+    parser_send.add_argument('--input', '-i', default='-',
+                             help='file of values, - for stdin')
+    parser_send.add_argument('--with-timestamps', '-T', action='store_true',
+                             help='lines are host, key, timestamp and value')
+    parser_send.add_argument('--ndjson', action='store_true',
+                             help='lines are json objects')
+    parser_send.add_argument('--timeout', type=float, default=10.)
+    parser_send.add_argument('--batch-size', type=int, default=1000,
+                             help='values per packet')
+    parser_send.add_argument('--read-size', type=int, default=50000,
+                             help='values parsed while the previous ones '
+                                  'are sent')
+    parser_send.add_argument('--max-inflight', type=int, default=4,
+                             help='packets sent concurrently')
+    parser_send.add_argument('--compress-threshold', type=int, default=None,
+                             help='compress payloads of this size')
+    parser_send.add_argument('--tls-ca-file', default=None)
+    parser_send.add_argument('--tls-cert-file', default=None)
+    parser_send.add_argument('--tls-key-file', default=None)
+    parser_send.add_argument('--verbose', '-v', action='store_true',
+                             help='print the lines which cannot be parsed')
+    parser_send.set_defaults(func=send)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
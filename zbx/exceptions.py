@@ -14,3 +14,10 @@ class RPCException(Exception):
         super(RPCException, self).__init__(message)
         self.code = code
         self.data = data
+
+
+class SenderException(Exception):
+    def __init__(self, message, result=None, undelivered=None):
+        super(SenderException, self).__init__(message)
+        self.result = result
+        self.undelivered = undelivered
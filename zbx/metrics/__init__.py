@@ -0,0 +1,30 @@
+"""
+    zbx.metrics
+    ~~~~~~~~~~~
+
+    Push values to trapper items.
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['Aggregator', 'BufferedSender', 'CardinalitySketch',
+           'Deduplicator', 'DiscoverySender', 'Failure', 'FlowControl',
+           'HashRing', 'Metric', 'MetricBatch', 'QuantileSketch', 'Result',
+           'Scheduler', 'Sender', 'ShardedSender', 'Spool', 'configure',
+           'discovery_payload', 'encode', 'ingest', 'pack', 'parse_info',
+           'read_batches', 'recv_packet', 'send', 'tls_context']
+
+from .aggregate import *  # NOQA
+from .bases import *  # NOQA
+from .batch import *  # NOQA
+from .buffered import *  # NOQA
+from .dedup import *  # NOQA
+from .discovery import *  # NOQA
+from .flow import *  # NOQA
+from .ingest import *  # NOQA
+from .protocol import *  # NOQA
+from .scheduler import *  # NOQA
+from .sender import *  # NOQA
+from .sharding import *  # NOQA
+from .spool import *  # NOQA
+from .tls import *  # NOQA
@@ -0,0 +1,159 @@
+"""
+
+    zbx.metrics.active
+    ~~~~~~~~~~~~~~~~~~
+
+    Behave like an active zabbix agent, with python handlers::
+
+        agent = ActiveAgent('web1', server='zabbix.example.com')
+
+        @agent.handler('circus.worker.*')
+        def worker(key, name):
+            return stats(name)[key.rpartition('.')[2]]
+
+        agent.start()
+
+    The agent requests the active checks of its host, runs them at their
+    delay with a :class:`~zbx.metrics.Scheduler`, and pushes their values
+    in batches of 'agent data' requests.
+
+    This module requires python 3.5+, it is not imported by zbx.metrics.
+
+"""
+
+__all__ = ['ActiveAgent']
+
+import json
+import logging
+import threading
+
+from zbx.exceptions import SenderException
+from .agent import Registry, parse_key
+from .buffered import BufferedSender
+from .protocol import pack
+from .scheduler import Scheduler, parse_delay
+from .sender import Sender
+
+logger = logging.getLogger(__name__)
+
+
+class ActiveAgent(Registry):
+    """
+    Runs the active checks of host with the handlers of its registry.
+
+    The list of active checks is cached, and requested again every refresh
+    seconds. It is kept as is while the server cannot be reached. Keys
+    without handler are not scheduled, they are looked up again at the next
+    refresh.
+
+    Parameters:
+    host -- host name, as configured in zabbix
+    host_metadata -- metadata for the auto registration of the host
+    refresh -- seconds between two requests of the active checks
+    workers -- number of threads running the checks
+    """
+
+    def __init__(self, host, server='127.0.0.1', port=10051, timeout=10.,
+                 host_metadata=None, refresh=120., workers=4,
+                 batch_size=1000, max_age=1.):
+        super(ActiveAgent, self).__init__()
+        self.host = host
+        self.host_metadata = host_metadata
+        self.refresh = refresh
+        self.sender = Sender(server, port, timeout, hostname=host)
+        self.sender.request = 'agent data'
+        self.buffered = BufferedSender(self.sender, batch_size=batch_size,
+                                       max_age=max_age)
+        self.scheduler = Scheduler(self.buffered, workers)
+        self.checks = {}
+        self.refreshes = 0
+        self.unsupported = set()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def request_checks(self):
+        """Returns the active checks of the host, from the server"""
+        request = {'request': 'active checks', 'host': self.host}
+        if self.host_metadata is not None:
+            request['host_metadata'] = self.host_metadata
+        response = self.sender.exchange(pack(json.dumps(request)
+                                             .encode('utf-8')))
+        if response.get('response') != 'success':
+            raise SenderException(response.get('info',
+                                               'Error from zabbix server'))
+        return response.get('data') or []
+
+    def refresh_checks(self):
+        """
+        Requests the active checks, and schedules them.
+        Returns False if they could not be requested.
+        """
+        try:
+            checks = self.request_checks()
+        except (SenderException, OSError, ValueError) as error:
+            logger.warning('Cannot refresh active checks: %s', error)
+            return False
+
+        delays = {}
+        for check in checks:
+            key = check['key']
+            try:
+                name, _ = parse_key(key)
+                # ignore the flexible and scheduling intervals
+                delay = parse_delay('{}'.format(check['delay']).split(';')[0])
+            except ValueError as error:
+                logger.warning('Cannot schedule %s: %s', key, error)
+                continue
+            if self.resolve(name) is None:
+                self._unsupported(key)
+                continue
+            delays[key] = delay
+        for key in set(self.checks) - set(delays):
+            self.scheduler.unregister(key, self.host)
+        for key, delay in delays.items():
+            if self.checks.get(key) != delay:
+                self.scheduler.register(key, self.collect, delay, self.host,
+                                        args=(key,))
+        self.checks = delays
+        self.refreshes += 1
+        return True
+
+    def collect(self, key):
+        """Returns the value of key, None if it has no handler"""
+        name, params = parse_key(key)
+        handler = self.resolve(name)
+        if handler is None:
+            self._unsupported(key)
+            return None
+        return handler.func(name, *params)
+
+    def _unsupported(self, key):
+        if key not in self.unsupported:
+            self.unsupported.add(key)
+            logger.warning('No handler for active check %s', key)
+
+    def start(self):
+        """Refreshes the checks and runs them from background threads"""
+        if self._thread is None:
+            self.refresh_checks()
+            self.scheduler.start()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='zbx-active-agent')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def close(self):
+        """Stops the checks, and pushes the last values"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.scheduler.close()
+        self.buffered.close()
+        self.sender.close()
+
+    def _run(self):
+        while not self._stopped.wait(self.refresh):
+            self.refresh_checks()
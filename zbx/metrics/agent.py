@@ -0,0 +1,356 @@
+"""
+
+    zbx.metrics.agent
+    ~~~~~~~~~~~~~~~~~
+
+    Answer the passive checks of zabbix with python handlers::
+
+        agent = Agent()
+
+        @agent.handler('circus.worker.*', ttl=10)
+        def worker(key, name):
+            return stats(name)[key.rpartition('.')[2]]
+
+        python -m zbx.metrics.agent --listen 0.0.0.0:10050 \\
+            --handlers mypackage.checks.register
+
+    Requests are a key, framed by ZBXD or ended by a newline. The response
+    is the value framed by ZBXD, or ``ZBX_NOTSUPPORTED\\0`` and a message.
+
+    This module requires python 3.5+, it is not imported by zbx.metrics.
+
+"""
+
+__all__ = ['Agent', 'Registry', 'Unsupported', 'main', 'parse_key']
+
+import argparse
+import asyncio
+from fnmatch import fnmatchcase
+import logging
+import time
+
+from zbx.util import load
+from .protocol import HEADER, SIGNATURE, pack, unpack_data, unpack_header
+from .sharding import parse_endpoint
+
+logger = logging.getLogger(__name__)
+
+NOT_SUPPORTED = b'ZBX_NOTSUPPORTED\0'
+
+
+class Unsupported(Exception):
+    """Raised by handlers for an unsupported key or parameters"""
+
+
+def skip_spaces(text, index):
+    while index < len(text) and text[index] == ' ':
+        index += 1
+    return index
+
+
+def parse_params(text, index, nested=False):
+    """
+    Parses params from index, after an opening bracket. Returns them and
+    the index after the closing bracket.
+    """
+    params = []
+    while True:
+        index = skip_spaces(text, index)
+        if text.startswith('"', index):
+            value, index = [], index + 1
+            while index < len(text) and text[index] != '"':
+                if text.startswith('\\"', index):
+                    index += 1
+                value.append(text[index])
+                index += 1
+            if index >= len(text):
+                raise ValueError('Unterminated quote in {!r}'.format(text))
+            value = ''.join(value)
+            index = skip_spaces(text, index + 1)
+        elif text.startswith('[', index) and not nested:
+            value, index = parse_params(text, index + 1, True)
+            index = skip_spaces(text, index)
+        else:
+            end = index
+            while end < len(text) and text[end] not in ',]':
+                end += 1
+            value, index = text[index:end].rstrip(' '), end
+        params.append(value)
+        if index >= len(text):
+            raise ValueError('Unterminated params in {!r}'.format(text))
+        if text[index] == ']':
+            return params, index + 1
+        if text[index] != ',':
+            raise ValueError('Unexpected {!r} in {!r}'.format(text[index],
+                                                              text))
+        index += 1
+
+
+def parse_key(text):
+    """
+    Returns the name and params of a key, like
+    ``'vfs.fs.size[/,"free"]'`` is ``('vfs.fs.size', ['/', 'free'])``.
+
+    Quoted params may contain commas and brackets, ``\\"`` is a quote.
+    Params between brackets are lists.
+    """
+    name, bracket, _ = text.partition('[')
+    if not bracket:
+        return text, []
+    params, end = parse_params(text, len(name) + 1)
+    if end != len(text):
+        raise ValueError('Unexpected characters after {!r}'
+                         .format(text[:end]))
+    return name, params
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        value = int(value)
+    elif isinstance(value, float):
+        value = repr(value)
+    if isinstance(value, bytes):
+        return value
+    return '{}'.format(value).encode('utf-8')
+
+
+class Handler(object):
+
+    def __init__(self, pattern, func, ttl=0, blocking=False):
+        self.pattern = pattern
+        self.func = func
+        self.ttl = ttl
+        self.blocking = blocking
+
+
+class Registry(object):
+    """
+    Handlers of keys.
+
+    A handler is called with the key name and its params, it returns the
+    value or raises Unsupported. Patterns are matched against key names,
+    with ``*`` and ``?`` wildcards; exact names are looked up first.
+    """
+
+    def __init__(self):
+        self._names = {}
+        self._patterns = []
+
+    def register(self, pattern, func, ttl=0, blocking=False):
+        """
+        Registers func for the keys of pattern.
+
+        Parameters:
+        ttl -- seconds a value is cached
+        blocking -- True runs func in an executor, out of the event loop
+        """
+        handler = Handler(pattern, func, ttl, blocking)
+        if any(char in pattern for char in '*?['):
+            self._patterns.append(handler)
+        else:
+            self._names[pattern] = handler
+        return func
+
+    def handler(self, pattern, ttl=0, blocking=False):
+        """Decorator which registers a handler"""
+        def decorate(func):
+            return self.register(pattern, func, ttl, blocking)
+        return decorate
+
+    def resolve(self, name):
+        """Returns the Handler of a key name, or None"""
+        try:
+            return self._names[name]
+        except KeyError:
+            pass
+        for handler in self._patterns:
+            if fnmatchcase(name, handler.pattern):
+                return handler
+        return None
+
+    def keys(self):
+        return list(self._names) + [h.pattern for h in self._patterns]
+
+
+class Agent(Registry):
+    """
+    Passive agent, answering the requests of zabbix pollers.
+
+    Values are cached per key for the ttl of their handler. Concurrent
+    requests of a key share a single call of its handler.
+
+    Parameters:
+    allowed -- addresses which may query the agent, None for all
+    max_cache -- number of cached values
+    timeout -- seconds a poller has to send its request, and a handler
+               has to answer
+    """
+
+    def __init__(self, allowed=None, max_cache=10000, timeout=3.,
+                 max_bytes=65536):
+        super(Agent, self).__init__()
+        self.allowed = set(allowed) if allowed else None
+        self.max_cache = max_cache
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.requests = 0
+        self.hits = 0
+        self.unsupported = 0
+        self.errors = 0
+        self._cache = {}
+        self._inflight = {}
+        self.register('agent.ping', lambda key: 1)
+
+    async def start(self, host='0.0.0.0', port=10050):
+        """Listens on host and port, returns the asyncio server"""
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def query(self, key):
+        """Returns the value of key, as bytes"""
+        self.requests += 1
+        try:
+            expires, value = self._cache[key]
+        except KeyError:
+            pass
+        else:
+            if expires > time.time():
+                self.hits += 1
+                return value
+            del self._cache[key]
+
+        try:
+            future = self._inflight[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.get_event_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value, ttl = await self._call(key)
+        except Exception as error:
+            future.set_exception(error)
+            # consumed here, even if nobody waits for it
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            del self._inflight[key]
+        future.set_result(value)
+        if ttl:
+            if len(self._cache) >= self.max_cache:
+                self._evict()
+            self._cache[key] = time.time() + ttl, value
+        return value
+
+    async def _call(self, key):
+        name, params = parse_key(key)
+        handler = self.resolve(name)
+        if handler is None:
+            raise Unsupported('Unsupported item key.')
+        if handler.blocking:
+            loop = asyncio.get_event_loop()
+            value = loop.run_in_executor(None, handler.func, name, *params)
+        else:
+            value = handler.func(name, *params)
+        if asyncio.iscoroutine(value) or asyncio.isfuture(value):
+            value = await asyncio.wait_for(value, self.timeout)
+        return format_value(value), handler.ttl
+
+    def _evict(self):
+        now = time.time()
+        for key, (expires, _) in list(self._cache.items()):
+            if expires <= now:
+                del self._cache[key]
+        if len(self._cache) >= self.max_cache:
+            self._cache.clear()
+
+    async def answer(self, key):
+        """Returns the response to a request of key"""
+        try:
+            return await self.query(key)
+        except Unsupported as error:
+            self.unsupported += 1
+            return NOT_SUPPORTED + str(error).encode('utf-8')
+        except ValueError as error:
+            self.unsupported += 1
+            return NOT_SUPPORTED + 'Invalid item key format: {}'.format(
+                error).encode('utf-8')
+        except Exception as error:
+            self.errors += 1
+            logger.warning('Check %r failed: %r', key, error)
+            return NOT_SUPPORTED + '{}'.format(error).encode('utf-8')
+
+    async def handle(self, reader, writer):
+        """Answers a poller connection"""
+        if self.allowed is not None:
+            peer = writer.get_extra_info('peername')
+            if not peer or peer[0] not in self.allowed:
+                logger.warning('Connection from %s refused', peer)
+                writer.close()
+                return
+        try:
+            key = await asyncio.wait_for(self.read_key(reader), self.timeout)
+            writer.write(pack(await self.answer(key)))
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError,
+                ValueError) as error:
+            logger.debug('Poller connection failed: %r', error)
+        finally:
+            writer.close()
+
+    async def read_key(self, reader):
+        """Reads a request, framed by ZBXD or ended by a newline"""
+        start = await reader.readexactly(len(SIGNATURE))
+        if start == SIGNATURE:
+            flags, length, reserved = unpack_header(
+                start + await reader.readexactly(HEADER.size - len(start)))
+            if max(length, reserved) > self.max_bytes:
+                raise ValueError('Request of {} bytes is too large'
+                                 .format(max(length, reserved)))
+            data = unpack_data(flags, await reader.readexactly(length),
+                               reserved)
+        else:
+            data = start + await reader.readline()
+        return data.decode('utf-8').rstrip('\r\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m zbx.metrics.agent',
+                                     description='Passive zabbix agent')
+    parser.add_argument('--listen', default='0.0.0.0:10050',
+                        help='address of the agent, host:port')
+    parser.add_argument('--allow', action='append', default=None,
+                        help='address allowed to query the agent')
+    parser.add_argument('--handlers', action='append', default=[],
+                        help='path of a function which registers handlers '
+                             'into the agent it receives')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    agent = Agent(args.allow)
+    for path in args.handlers:
+        load(path)(agent)
+    host, port = parse_endpoint(args.listen, 10050)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(agent.start(host, port))
+    logger.info('Serving %s keys on %s:%s', len(agent.keys()), host, port)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+"""
+
+    zbx.metrics.aggregate
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Aggregate counters, gauges, sets and timers before sending them.
+
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['Aggregator', 'CardinalitySketch', 'QuantileSketch']
+
+from contextlib import contextmanager
+from hashlib import md5
+import logging
+import math
+import struct
+import threading
+import time
+
+from .bases import Metric
+from .sender import _instance as default_sender
+
+logger = logging.getLogger(__name__)
+
+POINT = struct.Struct('>Q')
+
+
+def derive(key, suffix):
+    """Returns key.suffix, before the params: ``key.suffix[params]``"""
+    name, bracket, params = key.partition('[')
+    return '{}.{}{}{}'.format(name, suffix, bracket, params)
+
+
+class QuantileSketch(object):
+    """
+    Quantiles of a stream of values, in bounded memory.
+
+    Values are counted into logarithmic buckets, so every quantile is
+    estimated within relative_accuracy. When there are more than
+    max_buckets buckets, the lowest ones are collapsed. Sketches with the
+    same accuracy can be merged.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0.
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, value, count=1):
+        """Adds value, count times"""
+        if value > 0:
+            buckets = self.positive
+        elif value < 0:
+            buckets = self.negative
+        else:
+            self.zeros += count
+            buckets = None
+        if buckets is not None:
+            index = int(math.ceil(math.log(abs(value)) / self._log_gamma))
+            buckets[index] = buckets.get(index, 0) + count
+            if len(buckets) > self.max_buckets:
+                self._collapse(buckets)
+        self.count += count
+        self.sum += value * count
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def _collapse(self, buckets):
+        indexes = sorted(buckets)
+        extra = len(indexes) - self.max_buckets
+        lowest = indexes[extra]
+        for index in indexes[:extra]:
+            buckets[lowest] += buckets.pop(index)
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError('Cannot merge sketches of different accuracy')
+        for mine, theirs in ((self.positive, other.positive),
+                             (self.negative, other.negative)):
+            for index, count in theirs.items():
+                mine[index] = mine.get(index, 0) + count
+            if len(mine) > self.max_buckets:
+                self._collapse(mine)
+        self.zeros += other.zeros
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def avg(self):
+        return self.sum / self.count if self.count else None
+
+    def quantile(self, q):
+        """Returns the estimated q quantile, q is between 0 and 1"""
+        if not self.count:
+            return None
+        return self.value_at(q * (self.count - 1))
+
+    def value_at(self, rank):
+        """Returns the estimated value of rank, 0 is the lowest value"""
+        if not self.count:
+            return None
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return self._clamp(-self._value(index))
+        seen += self.zeros
+        if seen > rank:
+            return 0.
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._clamp(self._value(index))
+        return self.max
+
+    def _value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def _clamp(self, value):
+        return min(max(value, self.min), self.max)
+
+
+class CardinalitySketch(object):
+    """
+    Number of distinct members of a stream, in bounded memory.
+
+    Members are counted exactly up to max_exact of them, then by a
+    HyperLogLog of ``2 ** precision`` registers, whose standard error is
+    ``1.04 / sqrt(2 ** precision)``.
+    """
+
+    def __init__(self, precision=12, max_exact=1024):
+        self.precision = precision
+        self.max_exact = max_exact
+        self.members = set()
+        self.registers = None
+
+    def __len__(self):
+        if self.registers is None:
+            return len(self.members)
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2. ** -register
+                                             for register in self.registers)
+        zeros = self.registers.count(b'\0')
+        if estimate <= 2.5 * size and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = size * math.log(float(size) / zeros)
+        return int(round(estimate))
+
+    def add(self, member):
+        if self.registers is not None:
+            self._add(member)
+            return
+        self.members.add(member)
+        if len(self.members) > self.max_exact:
+            self.registers = bytearray(1 << self.precision)
+            for known in self.members:
+                self._add(known)
+            self.members = None
+
+    def _add(self, member):
+        point = POINT.unpack_from(md5(
+            '{}'.format(member).encode('utf-8')).digest())[0]
+        bits = 64 - self.precision
+        index = point >> bits
+        rank = bits - (point & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+
+class Aggregator(object):
+    """
+    Aggregates values per (host, key) over a flush interval.
+
+    On flush, counters emit their sum, gauges their last value, sets their
+    number of distinct members, and timers emit ``key.count``,
+    ``key.min``, ``key.max``, ``key.avg`` and ``key.pNN`` for each
+    percentile. Call :meth:`start` to flush every interval from a
+    background thread.
+
+    Like statsd, gauges keep their value across flushes, and are emitted
+    by every flush until they are not set for gauge_expiry seconds.
+
+    Parameters:
+    max_keys -- values of new keys are dropped when max_keys keys are
+                aggregated, None for no limit
+    gauge_expiry -- seconds after which a gauge which is not set is
+                    forgotten
+    """
+
+    def __init__(self, sender=None, interval=60., percentiles=(50, 90, 99),
+                 relative_accuracy=0.01, max_keys=None, gauge_expiry=3600.):
+        self.sender = sender or default_sender
+        self.interval = interval
+        self.percentiles = percentiles
+        self.relative_accuracy = relative_accuracy
+        self.max_keys = max_keys
+        self.gauge_expiry = gauge_expiry
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._timers = {}
+        self._sets = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _full(self, table, name):
+        """True if name is a new key which cannot be aggregated"""
+        if self.max_keys is None or name in table:
+            return False
+        if len(self._counters) + len(self._gauges) + len(self._timers) + \
+                len(self._sets) < self.max_keys:
+            return False
+        self.dropped += 1
+        return True
+
+    def incr(self, key, value=1, host=None):
+        name = host, key
+        with self._lock:
+            if not self._full(self._counters, name):
+                self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, key, value, host=None, delta=False):
+        """Sets a gauge, or adds value to it if delta is true"""
+        name = host, key
+        with self._lock:
+            if not self._full(self._gauges, name):
+                if delta:
+                    value += self._gauges.get(name, (0, None))[0]
+                self._gauges[name] = value, time.time()
+
+    def timing(self, key, value, host=None):
+        """Adds a duration, in seconds"""
+        name = host, key
+        with self._lock:
+            try:
+                sketch = self._timers[name]
+            except KeyError:
+                if self._full(self._timers, name):
+                    return
+                sketch = self._timers[name] = QuantileSketch(
+                    self.relative_accuracy)
+            sketch.add(value)
+
+    def unique(self, key, member, host=None):
+        """
+        Adds member to a set, which counts its distinct members with a
+        CardinalitySketch
+        """
+        name = host, key
+        with self._lock:
+            try:
+                members = self._sets[name]
+            except KeyError:
+                if self._full(self._sets, name):
+                    return
+                members = self._sets[name] = CardinalitySketch()
+            members.add(member)
+
+    @contextmanager
+    def timer(self, key, host=None):
+        """Times the block"""
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.timing(key, time.time() - started, host)
+
+    def collect(self, clock=None):
+        """
+        Returns the metrics aggregated so far, and resets them, except the
+        gauges which did not expire at clock
+        """
+        clock = clock or time.time()
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            timers, self._timers = self._timers, {}
+            sets, self._sets = self._sets, {}
+            horizon = clock - self.gauge_expiry
+            self._gauges = dict((name, gauge)
+                                for name, gauge in self._gauges.items()
+                                if gauge[1] >= horizon)
+            gauges = list(self._gauges.items())
+
+        clock = int(clock)
+        metrics = []
+        for (host, key), value in counters.items():
+            metrics.append(Metric(key, value, host, clock))
+        for (host, key), (value, _) in gauges:
+            metrics.append(Metric(key, value, host, clock))
+        for (host, key), members in sets.items():
+            metrics.append(Metric(key, len(members), host, clock))
+        for (host, key), sketch in timers.items():
+            metrics.append(Metric(derive(key, 'count'), sketch.count, host,
+                                  clock))
+            metrics.append(Metric(derive(key, 'min'), sketch.min, host, clock))
+            metrics.append(Metric(derive(key, 'max'), sketch.max, host, clock))
+            metrics.append(Metric(derive(key, 'avg'), sketch.avg, host, clock))
+            for percentile in self.percentiles:
+                metrics.append(Metric(derive(key, 'p{:g}'.format(percentile)),
+                                      sketch.quantile(percentile / 100.),
+                                      host, clock))
+        return metrics
+
+    def flush(self):
+        """Sends the aggregated metrics"""
+        metrics = self.collect()
+        if metrics:
+            return self.sender.send(metrics)
+
+    def start(self):
+        """Flushes every interval from a background thread"""
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='zbx-aggregator')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def close(self):
+        """Stops the background thread and flushes one last time"""
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as error:
+                logger.warning('Cannot flush aggregates: %s', error)
@@ -0,0 +1,177 @@
+"""
+
+    zbx.metrics.aio
+    ~~~~~~~~~~~~~~~
+
+    Send metrics from an asyncio event loop.
+
+    This module requires python 3.5+, it is not imported by zbx.metrics.
+
+"""
+
+__all__ = ['AsyncSender']
+
+import asyncio
+import logging
+import time
+
+from zbx.exceptions import SenderException
+from .protocol import HEADER, decode, unpack_data, unpack_header
+from .sender import Result, Sender
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSender(Sender):
+    """
+    Sends metrics over asyncio streams.
+
+    Batches are split like :class:`~zbx.metrics.Sender` does, and up to
+    max_inflight of them are sent concurrently.
+
+    Each batch uses its own connection, which is never reused. When a batch
+    is cancelled or times out, its connection is aborted: a packet which
+    was not fully written is discarded, never flushed afterwards. A batch
+    cancelled while waiting for its response may have been processed.
+    """
+
+    async def send(self, metrics, timeout=None):
+        """
+        Sends metrics, and returns the Result aggregated over batches.
+
+        timeout applies to every batch, it defaults to the sender timeout.
+        Raises SenderException when a batch cannot be delivered, after the
+        other batches in flight are done.
+
+        The spool and the dedup behave like with
+        :meth:`Sender.send <zbx.metrics.Sender.send>`.
+        """
+        if self.dedup is not None:
+            metrics = self.dedup.filter(metrics)
+
+        if self.spool is None:
+            if self.dedup is None:
+                return await self.deliver(metrics, timeout=timeout)
+            undelivered = []
+            try:
+                return await self.deliver(metrics, undelivered, timeout)
+            except SenderException:
+                self.dedup.forget(undelivered)
+                raise
+
+        now = time.time()
+        if self.spool.ready():
+            await self.replay(timeout)
+        if self.spool.pending:
+            # keep the order, behind the spooled metrics
+            return Result(spooled=self.spool.extend(metrics, now))
+
+        undelivered = []
+        try:
+            return await self.deliver(metrics, undelivered, timeout)
+        except SenderException as error:
+            self.spool.extend(undelivered, now)
+            self.spool.failed()
+            result = error.result
+            result.spooled = len(undelivered)
+            return result
+
+    async def deliver(self, metrics, undelivered=None, timeout=None):
+        """
+        Sends metrics, and raises SenderException when a batch fails.
+        Metrics which were not delivered are added to undelivered.
+        """
+        batches = self.batches(metrics)
+        results, errors = [], []
+
+        async def worker():
+            for batch in batches:
+                if errors:
+                    # do not send the remaining batches
+                    if undelivered is not None:
+                        undelivered.extend(batch.metrics)
+                    continue
+                try:
+                    results.append(await self.send_batch(batch, timeout))
+                except (SenderException, OSError, EOFError,
+                        asyncio.TimeoutError, ValueError) as error:
+                    logger.warning('Batch failed: %r', error)
+                    errors.append(error)
+                    if undelivered is not None:
+                        undelivered.extend(batch.metrics)
+
+        workers = self.inflight_limit()
+        await asyncio.gather(*[worker() for _ in range(workers)])
+        result = sum(results, Result())
+        if errors:
+            raise SenderException(str(errors[0]) or repr(errors[0]), result)
+        return result
+
+    async def replay(self, timeout=None, batch_size=10000):
+        """
+        Sends the spooled metrics in order, like
+        :meth:`Spool.replay <zbx.metrics.Spool.replay>`.
+        Returns the number of replayed metrics.
+        """
+        replayed = 0
+        while True:
+            metrics, position = self.spool.read(batch_size)
+            if not metrics:
+                break
+            try:
+                await self.deliver(metrics, timeout=timeout)
+            except SenderException as error:
+                logger.warning('Replay of %s metrics failed: %s',
+                               len(metrics), error)
+                self.spool.failed()
+                break
+            self.spool.commit(position)
+            replayed += len(metrics)
+        self.spool.replayed += replayed
+        return replayed
+
+    async def send_batch(self, batch, timeout=None):
+        """Delivers a batch, and returns its Result"""
+        if timeout is None:
+            timeout = self.timeout
+        if self.flow is None:
+            response = await asyncio.wait_for(self.exchange(batch.packet),
+                                              timeout)
+            return self.result(response)
+        await asyncio.sleep(self.flow.pause())
+        started = time.time()
+        try:
+            response = await asyncio.wait_for(self.exchange(batch.packet),
+                                              timeout)
+            result = self.result(response)
+        except Exception:
+            self.flow.failed()
+            raise
+        self.flow.completed(result, time.time() - started)
+        return result
+
+    async def exchange(self, packet):
+        """Sends a packet and returns the decoded response"""
+        reader, writer = await self.connect()
+        try:
+            writer.write(packet)
+            await writer.drain()
+            flags, length, reserved = unpack_header(
+                await reader.readexactly(HEADER.size))
+            response = decode(unpack_data(
+                flags, await reader.readexactly(length), reserved))
+        except BaseException:
+            # drop what may be left into the write buffer
+            writer.transport.abort()
+            raise
+        writer.close()
+        return response
+
+    async def connect(self):
+        if self.tls is None:
+            return await asyncio.open_connection(self.server, self.port)
+        # asyncio does not resume TLS sessions
+        self.handshakes += 1
+        return await asyncio.open_connection(
+            self.server, self.port, ssl=self.tls,
+            server_hostname=self.tls_hostname or self.server)
@@ -0,0 +1,31 @@
+"""
+
+    zbx.metrics.bases
+    ~~~~~~~~~~~~~~~~~
+
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['Metric']
+
+
+class Metric(object):
+    """
+    A value of a trapper item.
+
+    host defaults to the hostname of the sender, clock to the time the
+    metric is sent.
+    """
+
+    __slots__ = ('key', 'value', 'host', 'clock')
+
+    def __init__(self, key, value, host=None, clock=None):
+        self.key = key
+        self.value = value
+        self.host = host
+        self.clock = clock
+
+    def __repr__(self):
+        return '<Metric({!r}, {!r}, host={!r}, clock={!r})>'.format(
+            self.key, self.value, self.host, self.clock)
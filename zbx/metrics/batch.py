@@ -0,0 +1,196 @@
+"""
+
+    zbx.metrics.batch
+    ~~~~~~~~~~~~~~~~~
+
+    Columnar storage of many metrics.
+
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['MetricBatch']
+
+from array import array
+from json.encoder import encode_basestring_ascii as quote
+
+from six import integer_types, string_types, text_type
+
+from .bases import Metric
+from .protocol import FLAG_PROTOCOL, HEADER, SIGNATURE
+
+#: kinds of values
+INTEGER, FLOAT, TEXT = 0, 1, 2
+
+#: integers which are exact as doubles
+MAX_EXACT = 1 << 53
+
+try:
+    array('q')
+except ValueError:
+    # python 2 has no long long arrays, long has 64 bits on LP64 platforms
+    SIGNED = 'l'
+else:
+    SIGNED = 'q'
+
+
+class MetricBatch(object):
+    """
+    Metrics stored by columns.
+
+    Hosts and keys are interned into tables, clocks and numeric values are
+    kept into typed arrays, so a batch costs a few bytes per metric instead
+    of an object and its dict. The sender encodes it straight from the
+    columns.
+    """
+
+    def __init__(self, metrics=()):
+        self.hosts = [None]
+        self.keys = []
+        self._host_index = {None: 0}
+        self._key_index = {}
+        self._quoted_hosts = [None]
+        self._quoted_keys = []
+        self._hosts = array('I')
+        self._keys = array('I')
+        self._clocks = array(SIGNED)
+        self._kinds = array('b')
+        self._numbers = array('d')
+        self._texts = []
+        self.extend(metrics)
+
+    def __len__(self):
+        return len(self._clocks)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        return Metric(self.keys[self._keys[index]], self.value(index),
+                      self.hosts[self._hosts[index]],
+                      self._clocks[index] or None)
+
+    def append(self, key, value, host=None, clock=None):
+        if host == '-':
+            host = None
+        try:
+            host_index = self._host_index[host]
+        except KeyError:
+            host_index = self._host_index[host] = len(self.hosts)
+            self.hosts.append(host)
+            self._quoted_hosts.append(quote(host).encode('ascii'))
+        try:
+            key_index = self._key_index[key]
+        except KeyError:
+            key_index = self._key_index[key] = len(self.keys)
+            self.keys.append(key)
+            self._quoted_keys.append(quote(key).encode('ascii'))
+
+        if isinstance(value, float):
+            self._kinds.append(FLOAT)
+            self._numbers.append(value)
+        elif isinstance(value, integer_types) and \
+                not isinstance(value, bool) and \
+                -MAX_EXACT <= value <= MAX_EXACT:
+            self._kinds.append(INTEGER)
+            self._numbers.append(value)
+        else:
+            self._kinds.append(TEXT)
+            self._numbers.append(len(self._texts))
+            if value is None:
+                value = '-'
+            elif not isinstance(value, string_types):
+                value = text_type(value)
+            self._texts.append(value)
+
+        self._hosts.append(host_index)
+        self._keys.append(key_index)
+        self._clocks.append(int(clock or 0))
+
+    def extend(self, metrics):
+        append = self.append
+        for metric in metrics:
+            append(metric.key, metric.value, metric.host, metric.clock)
+
+    def value(self, index):
+        kind, number = self._kinds[index], self._numbers[index]
+        if kind == INTEGER:
+            return int(number)
+        if kind == FLOAT:
+            return number
+        return self._texts[int(number)]
+
+    def slice(self, start, stop):
+        """Lazy view of metrics[start:stop]"""
+        return BatchView(self, start, stop)
+
+    def encode(self, start, hostname, clock, max_values, max_bytes,
+               request='sender data'):
+        """
+        Encodes metrics from start into a packet, until max_values or
+        max_bytes are reached.
+
+        The payload is written after a reserved header into a single
+        bytearray, the header is filled at last. Returns the packet and the
+        index of the first metric left.
+        """
+        clock = int(clock)
+        hosts = self._quoted_hosts
+        default_host = quote(hostname).encode('ascii')
+        keys = self._quoted_keys
+        host_column, key_column = self._hosts, self._keys
+        clocks, kinds = self._clocks, self._kinds
+        numbers, texts = self._numbers, self._texts
+
+        prefixes = {}
+        packet = bytearray(HEADER.size)
+        packet += b'{"request":'
+        packet += quote(request).encode('ascii')
+        packet += b',"data":['
+        opening = len(packet)
+        limit = max_bytes + opening
+        stop = min(len(self), start + max_values)
+        index = start
+        while index < stop:
+            kind = kinds[index]
+            if kind == INTEGER:
+                value = b'"%d"' % numbers[index]
+            elif kind == FLOAT:
+                value = b'"' + repr(numbers[index]).encode('ascii') + b'"'
+            else:
+                value = quote(texts[int(numbers[index])]).encode('ascii')
+            pair = host_column[index], key_column[index]
+            try:
+                prefix = prefixes[pair]
+            except KeyError:
+                prefix = prefixes[pair] = b'{"host":%s,"key":%s,"value":' % (
+                    hosts[pair[0]] or default_host, keys[pair[1]])
+            row = b'%s%s,"clock":%d}' % (prefix, value,
+                                         clocks[index] or clock)
+            if index > start:
+                if len(packet) + len(row) + 1 > limit:
+                    break
+                packet += b','
+            packet += row
+            index += 1
+        packet += b'],"clock":%d}' % clock
+        HEADER.pack_into(packet, 0, SIGNATURE, FLAG_PROTOCOL,
+                         len(packet) - HEADER.size, 0)
+        return packet, index
+
+
+class BatchView(object):
+    """Metrics of a MetricBatch between start and stop"""
+
+    def __init__(self, batch, start, stop):
+        self.batch = batch
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        for index in range(self.start, self.stop):
+            yield self.batch[index]
@@ -0,0 +1,175 @@
+"""
+
+    zbx.metrics.bench
+    ~~~~~~~~~~~~~~~~~
+
+    Benchmark the senders against a fake trapper::
+
+        python -m zbx.metrics.bench --values 100000 --batch-sizes 250,1000
+
+    Every run prints a JSON line with:
+
+    :values_per_second: values delivered per wall clock second
+    :bytes_per_value: bytes received by the trapper per value
+    :cpu_per_value: microseconds of process time per value
+    :new_blocks: memory blocks allocated by zbx during the run and still
+                 alive at its end, as counted by tracemalloc, or null
+                 without --trace. Freed blocks are not subtracted and the
+                 fake trapper is not counted.
+    :peak_bytes: peak memory traced during the run, trapper included, or
+                 null
+
+"""
+
+from __future__ import absolute_import, print_function
+
+__all__ = ['run', 'main']
+
+import argparse
+import gc
+import json
+import sys
+import time
+
+from .batch import MetricBatch
+from .bases import Metric
+from .buffered import BufferedSender
+from . import testing
+from .sender import Sender
+from .testing import FakeTrapper
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+process_time = getattr(time, 'process_time', None) or time.clock
+
+MODES = ('sender', 'batch', 'buffered', 'async', 'compressed')
+
+TYPES = ('int', 'float', 'text')
+
+
+def make_value(kind, i):
+    if kind == 'int':
+        return i
+    if kind == 'float':
+        return i / 7.
+    return 'value {}'.format(i)
+
+
+def make_metrics(kind, count, hosts=10, keys=100):
+    return [Metric('bench.key[{}]'.format(i % keys), make_value(kind, i),
+                   'host{}'.format(i % hosts)) for i in range(count)]
+
+
+def deliver(mode, metrics, port, batch_size):
+    """Sends metrics with a sender of mode"""
+    if mode == 'async':
+        import asyncio
+        from .aio import AsyncSender
+        sender = AsyncSender(port=port, max_values=batch_size)
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(sender.send(metrics))
+        finally:
+            loop.close()
+        return
+
+    options = {}
+    if mode == 'compressed':
+        options['compress_threshold'] = 0
+    with Sender(port=port, max_values=batch_size, **options) as sender:
+        if mode == 'batch':
+            sender.send(MetricBatch(metrics))
+        elif mode == 'buffered':
+            buffered = BufferedSender(sender, capacity=len(metrics),
+                                      batch_size=batch_size)
+            for metric in metrics:
+                buffered.submit(metric)
+            buffered.close()
+        else:
+            sender.send(metrics)
+
+
+def run(mode, kind, batch_size, values, trapper, trace=False):
+    """Returns the measures of a run"""
+    metrics = make_metrics(kind, values)
+    trapper.reset()
+    gc.collect()
+    if trace:
+        # deep enough to tell the trapper threads from the senders
+        tracemalloc.start(32)
+        before = tracemalloc.take_snapshot()
+    started, cpu = time.time(), process_time()
+    deliver(mode, metrics, trapper.port, batch_size)
+    seconds, cpu = time.time() - started, process_time() - cpu
+    blocks = peak = None
+    if trace:
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        ignored = [tracemalloc.Filter(False, tracemalloc.__file__),
+                   tracemalloc.Filter(False, testing.__file__,
+                                      all_frames=True)]
+        blocks = sum(max(stat.count_diff, 0) for stat in
+                     after.filter_traces(ignored).compare_to(
+                         before.filter_traces(ignored), 'lineno'))
+    return {
+        'mode': mode,
+        'type': kind,
+        'batch_size': batch_size,
+        'values': trapper.values,
+        'seconds': seconds,
+        'values_per_second': trapper.values / seconds if seconds else None,
+        'bytes_per_value': trapper.bytes_received / float(values),
+        'cpu_per_value': cpu * 1e6 / values,
+        'new_blocks': blocks,
+        'peak_bytes': peak,
+    }
+
+
+def csv(value):
+    return [item for item in value.split(',') if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m zbx.metrics.bench',
+                                     description='Benchmark zbx.metrics')
+    parser.add_argument('--values', type=int, default=20000)
+    parser.add_argument('--batch-sizes', type=csv, default=['250', '1000'])
+    parser.add_argument('--types', type=csv, default=list(TYPES))
+    parser.add_argument('--modes', type=csv, default=list(MODES))
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='seconds the trapper waits before answering')
+    parser.add_argument('--failure-ratio', type=float, default=0.)
+    parser.add_argument('--no-compression', dest='compression',
+                        action='store_false',
+                        help='the trapper refuses compressed packets')
+    parser.add_argument('--trace', action='store_true',
+                        help='count allocations with tracemalloc')
+    args = parser.parse_args(argv)
+    if args.trace and tracemalloc is None:
+        parser.error('--trace requires tracemalloc')
+    if 'async' in args.modes and sys.version_info < (3, 5):
+        args.modes.remove('async')
+    if 'compressed' in args.modes and not args.compression:
+        args.modes.remove('compressed')
+
+    with FakeTrapper(latency=args.latency, failure_ratio=args.failure_ratio,
+                     compression=args.compression) as trapper:
+        for mode in args.modes:
+            if mode not in MODES:
+                parser.error('unknown mode {}'.format(mode))
+            for kind in args.types:
+                if kind not in TYPES:
+                    parser.error('unknown type {}'.format(kind))
+                for batch_size in args.batch_sizes:
+                    measures = run(mode, kind, int(batch_size), args.values,
+                                   trapper, args.trace)
+                    print(json.dumps(measures, sort_keys=True))
+                    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
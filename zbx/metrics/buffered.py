@@ -0,0 +1,249 @@
+"""
+
+    zbx.metrics.buffered
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Submit metrics without waiting for the network.
+
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['BufferedSender']
+
+import atexit
+from collections import deque
+import logging
+import threading
+import time
+
+from .sender import _instance as default_sender
+
+logger = logging.getLogger(__name__)
+
+#: what to do with a metric submitted when the buffer is full
+DROP_OLDEST, BLOCK, SPILL = 'drop_oldest', 'block', 'spill'
+
+
+class BufferedSender(object):
+    """
+    Buffers metrics, and sends them from a background thread.
+
+    The buffer is flushed when batch_size metrics are waiting, when the
+    oldest one waits for max_age seconds, or when :meth:`flush` is called.
+    It is flushed one last time at interpreter exit.
+
+    When capacity metrics are waiting, policy decides:
+
+    :drop_oldest: the oldest metric is dropped
+    :block: submit waits for room
+    :spill: the new metric is given to spill, like unsent batches
+
+    A batch which cannot be sent is retried, with an exponential backoff,
+    before it is given to spill or dropped. Only its undelivered metrics
+    are retried when the sender tells them.
+
+    Parameters:
+    sender -- Sender which delivers the batches
+    spill -- callable which receives a list of metrics
+    retries -- number of retries of a batch
+    retry_backoff -- seconds before the first retry, doubled by retry up
+                     to max_backoff
+    """
+
+    def __init__(self, sender=None, capacity=100000, batch_size=1000,
+                 max_age=1., policy=DROP_OLDEST, spill=None, retries=0,
+                 retry_backoff=1., max_backoff=30.):
+        if policy not in (DROP_OLDEST, BLOCK, SPILL):
+            raise ValueError('{} is not a known policy'.format(policy))
+        if policy == SPILL and spill is None:
+            raise ValueError('spill policy requires a spill callable')
+        self.sender = sender or default_sender
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.policy = policy
+        self.spill = spill
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+
+        self.dropped = 0
+        self.spilled = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.flushes = 0
+        self.flush_latency = 0.
+        self.max_flush_latency = 0.
+
+        self._queue = deque()
+        self._since = None
+        self._closed = False
+        self._requests = deque()
+        self._wakeup = threading.Event()
+        self._room = threading.Condition()
+        self._overflow_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run,
+                                        name='zbx-buffered-sender')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    @property
+    def depth(self):
+        """Number of metrics waiting"""
+        return len(self._queue)
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'flushes': self.flushes,
+            'flush_latency': self.flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+        }
+
+    def submit(self, metric):
+        """
+        Enqueues metric and returns immediately, unless the policy is block
+        and the buffer is full. Returns False if the metric was spilled, or
+        dropped because the sender is closed.
+
+        The clock of the metric is set to now if it was not.
+        """
+        if self._closed:
+            with self._overflow_lock:
+                self.dropped += 1
+            return False
+        if metric.clock is None:
+            metric.clock = int(time.time())
+        queue = self._queue
+        if len(queue) >= self.capacity and not self._overflow(metric):
+            return False
+        if not queue:
+            self._since = time.time()
+        queue.append(metric)
+        if len(queue) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def _overflow(self, metric):
+        if self.policy == DROP_OLDEST:
+            with self._overflow_lock:
+                try:
+                    self._queue.popleft()
+                    self.dropped += 1
+                except IndexError:
+                    pass
+            return True
+        if self.policy == BLOCK:
+            with self._room:
+                while len(self._queue) >= self.capacity and not self._closed:
+                    self._wakeup.set()
+                    self._room.wait(self.max_age)
+            return True
+        with self._overflow_lock:
+            self.spilled += 1
+        self.spill([metric])
+        return False
+
+    def flush(self, timeout=None):
+        """
+        Waits until the metrics submitted so far are sent.
+        Returns False on timeout.
+        """
+        done = threading.Event()
+        self._requests.append(done)
+        self._wakeup.set()
+        if self._closed:
+            # the thread may have stopped before it saw this request
+            self._thread.join(timeout)
+            return done.is_set() or not self._thread.is_alive()
+        return done.wait(timeout)
+
+    def close(self, timeout=None):
+        """Sends the pending metrics and stops the background thread"""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout)
+        try:
+            atexit.unregister(self.close)
+        except AttributeError:
+            pass
+
+    def _run(self):
+        queue = self._queue
+        while True:
+            if queue and self._since is not None:
+                timeout = max(0, self._since + self.max_age - time.time())
+            else:
+                timeout = self.max_age
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+            requests = len(self._requests)
+            closed = self._closed
+            if requests or closed or len(queue) >= self.batch_size or (
+                    queue and time.time() - (self._since or 0) >=
+                    self.max_age):
+                self._drain()
+            for _ in range(requests):
+                self._requests.popleft().set()
+            if closed and not queue:
+                break
+
+    def _drain(self):
+        queue = self._queue
+        while queue:
+            batch = []
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(queue.popleft())
+            except IndexError:
+                pass
+            self._since = time.time() if queue else None
+            with self._room:
+                self._room.notify_all()
+            self._send(batch)
+
+    def _send(self, batch):
+        started = time.time()
+        attempt = 0
+        while True:
+            try:
+                self.sender.send(batch)
+            except Exception as error:
+                undelivered = getattr(error, 'undelivered', None)
+                if undelivered is not None:
+                    self.sent += len(batch) - len(undelivered)
+                    batch = undelivered
+                if attempt < self.retries:
+                    delay = min(self.retry_backoff * 2 ** attempt,
+                                self.max_backoff)
+                    attempt += 1
+                    self.retried += len(batch)
+                    logger.info('Cannot send %s metrics, retry in %.2fs: %s',
+                                len(batch), delay, error)
+                    time.sleep(delay)
+                    continue
+                logger.warning('Cannot send %s metrics: %s', len(batch),
+                               error)
+                self.failed += len(batch)
+                if self.spill is not None:
+                    with self._overflow_lock:
+                        self.spilled += len(batch)
+                    self.spill(batch)
+            else:
+                self.sent += len(batch)
+            break
+        self.flushes += 1
+        self.flush_latency = time.time() - started
+        self.max_flush_latency = max(self.max_flush_latency,
+                                     self.flush_latency)
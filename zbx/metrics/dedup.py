@@ -0,0 +1,103 @@
+"""
+
+    zbx.metrics.dedup
+    ~~~~~~~~~~~~~~~~~
+
+    Send values only when they change.
+
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['Deduplicator']
+
+from collections import OrderedDict
+import threading
+import time
+
+from six import integer_types
+
+NUMBERS = integer_types + (float,)
+
+
+def is_number(value):
+    return isinstance(value, NUMBERS) and not isinstance(value, bool)
+
+
+class Deduplicator(object):
+    """
+    Suppresses the values which did not change since they were last sent.
+
+    The last sent value of every (host, key) is remembered, up to
+    max_entries in least recently used order. An unchanged value is still
+    sent every heartbeat seconds, so nodata() triggers keep working.
+
+    Parameters:
+    tolerance -- numeric values which differ by at most tolerance from the
+                 last sent one are unchanged
+    tolerances -- mapping of key to tolerance, overriding tolerance
+    """
+
+    def __init__(self, max_entries=100000, heartbeat=300., tolerance=0,
+                 tolerances=None):
+        self.max_entries = max_entries
+        self.heartbeat = heartbeat
+        self.tolerance = tolerance
+        self.tolerances = dict(tolerances or {})
+        self.passed = 0
+        self.suppressed = 0
+        self.heartbeats = 0
+        self.evictions = 0
+        self._last = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._last)
+
+    def stats(self):
+        return {
+            'entries': len(self),
+            'passed': self.passed,
+            'suppressed': self.suppressed,
+            'heartbeats': self.heartbeats,
+            'evictions': self.evictions,
+        }
+
+    def unchanged(self, key, value, previous):
+        if is_number(value) and is_number(previous):
+            return abs(value - previous) <= self.tolerances.get(
+                key, self.tolerance)
+        return '{}'.format(value) == '{}'.format(previous)
+
+    def filter(self, metrics):
+        """Returns the metrics which have to be sent"""
+        now = time.time()
+        selected = []
+        last = self._last
+        with self._lock:
+            for metric in metrics:
+                name = metric.host, metric.key
+                clock = metric.clock or now
+                entry = last.pop(name, None)
+                if entry is not None:
+                    value, sent = entry
+                    if clock - sent < self.heartbeat and \
+                            self.unchanged(metric.key, metric.value, value):
+                        last[name] = entry
+                        self.suppressed += 1
+                        continue
+                    if clock - sent >= self.heartbeat:
+                        self.heartbeats += 1
+                last[name] = metric.value, clock
+                self.passed += 1
+                selected.append(metric)
+            while len(last) > self.max_entries:
+                last.popitem(last=False)
+                self.evictions += 1
+        return selected
+
+    def forget(self, metrics):
+        """Forgets metrics which were not delivered"""
+        with self._lock:
+            for metric in metrics:
+                self._last.pop((metric.host, metric.key), None)
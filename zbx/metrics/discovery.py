@@ -0,0 +1,124 @@
+"""
+
+    zbx.metrics.discovery
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Feed low level discovery rules of type trapper, like the
+    ``circus.discovery`` rule of examples/circus.py::
+
+        discovery = DiscoverySender(keepalive=3600)
+        discovery.update('circus.discovery',
+                         [{'worker': name} for name in watchers])
+
+    The discovery is sent again only when its rows change, or after
+    keepalive seconds, so the server does not process every prototype at
+    each cycle.
+
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['DiscoverySender', 'discovery_payload']
+
+from hashlib import sha1
+import json
+import threading
+import time
+
+from .bases import Metric
+from .sender import _instance as default_sender
+
+
+def macro(name):
+    """Returns the macro of name, ``worker`` is ``{#WORKER}``"""
+    if name.startswith('{#'):
+        return name
+    return '{{#{}}}'.format(name.upper())
+
+
+def discovery_payload(rows):
+    """
+    Returns the canonical json of a discovery.
+
+    rows are mappings of names or macros to values. The payload does not
+    depend on the order of rows, duplicate rows are removed.
+    """
+    encoded = set()
+    for row in rows:
+        row = dict((macro(name), '{}'.format(value))
+                   for name, value in row.items())
+        encoded.add(json.dumps(row, sort_keys=True, separators=(',', ':')))
+    return '{{"data":[{}]}}'.format(','.join(sorted(encoded)))
+
+
+def fingerprint(payload):
+    return sha1(payload.encode('utf-8')).hexdigest()
+
+
+class DiscoverySender(object):
+    """
+    Sends discoveries when they change.
+
+    The fingerprint and send time of the last discovery delivered are kept
+    per (host, key).
+
+    Parameters:
+    sender -- Sender which delivers the discoveries
+    keepalive -- seconds after which an unchanged discovery is sent again
+    """
+
+    def __init__(self, sender=None, keepalive=3600.):
+        self.sender = sender or default_sender
+        self.keepalive = keepalive
+        self.sent = 0
+        self.skipped = 0
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def changed(self, key, payload, host=None, now=None):
+        """True if payload has to be sent"""
+        state = self._state.get((host, key))
+        if state is None:
+            return True
+        digest, sent = state
+        now = time.time() if now is None else now
+        return digest != fingerprint(payload) or now - sent >= self.keepalive
+
+    def send(self, discoveries):
+        """
+        Sends the discoveries which changed, in one go.
+
+        discoveries are (key, rows, host) tuples. Returns the Result of
+        the sender, or None if nothing changed. When zabbix reports failed
+        values, all of them are sent again next time.
+        """
+        now = time.time()
+        metrics, digests = [], []
+        with self._lock:
+            for key, rows, host in discoveries:
+                payload = discovery_payload(rows)
+                if not self.changed(key, payload, host, now):
+                    self.skipped += 1
+                    continue
+                metrics.append(Metric(key, payload, host, int(now)))
+                digests.append(((host, key), fingerprint(payload)))
+        if not metrics:
+            return None
+        result = self.sender.send(metrics)
+        if result.failed:
+            # zabbix refused some, which ones is unknown
+            return result
+        with self._lock:
+            for name, digest in digests:
+                self._state[name] = digest, now
+            self.sent += len(metrics)
+        return result
+
+    def update(self, key, rows, host=None):
+        """Sends a discovery if it changed"""
+        return self.send([(key, rows, host)])
+
+    def forget(self, key, host=None):
+        """Sends the discovery of (host, key) next time"""
+        with self._lock:
+            self._state.pop((host, key), None)
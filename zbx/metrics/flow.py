@@ -0,0 +1,105 @@
+"""
+
+    zbx.metrics.flow
+    ~~~~~~~~~~~~~~~~
+
+    Tune batch sizes and concurrency from the responses of zabbix.
+
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['FlowControl']
+
+import random
+import threading
+
+
+class FlowControl(object):
+    """
+    Additive increase, multiplicative decrease of batch size and in-flight
+    batches.
+
+    Every batch answered within target_latency grows the batch size by
+    step values, and the in-flight batches by one when it was answered
+    within half of it. Zabbix is saturated when a batch fails, times out,
+    is answered after target_latency, or when more than max_failed_ratio
+    of its values failed: both settings are then multiplied by decrease,
+    and the next batches are delayed by an exponential backoff with full
+    jitter.
+
+    Parameters:
+    values -- initial batch size, defaults to min_values
+    inflight -- initial in-flight batches, defaults to min_inflight
+    max_failed_ratio -- None to ignore the failed values
+    """
+
+    def __init__(self, min_values=50, max_values=5000, min_inflight=1,
+                 max_inflight=16, target_latency=1., max_failed_ratio=0.5,
+                 values=None, inflight=None, step=50, decrease=0.5,
+                 min_backoff=0.05, max_backoff=30.):
+        self.min_values = min_values
+        self.max_values = max_values
+        self.min_inflight = min_inflight
+        self.max_inflight = max_inflight
+        self.target_latency = target_latency
+        self.max_failed_ratio = max_failed_ratio
+        self.step = step
+        self.decrease = decrease
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.values = values or min_values
+        self.inflight = inflight or min_inflight
+        self.backoff = 0.
+        self.latency = None
+        self.saturations = 0
+        self._lock = threading.Lock()
+
+    def state(self):
+        """Returns the current settings"""
+        return {
+            'values': self.values,
+            'inflight': self.inflight,
+            'backoff': self.backoff,
+            'latency': self.latency,
+            'saturations': self.saturations,
+        }
+
+    def completed(self, result, elapsed):
+        """Accounts a batch answered after elapsed seconds"""
+        with self._lock:
+            if self.latency is None:
+                self.latency = elapsed
+            else:
+                self.latency += (elapsed - self.latency) * 0.2
+            if elapsed > self.target_latency or self._overloaded(result):
+                self._saturated()
+                return
+            self.backoff = 0.
+            self.values = min(self.max_values, self.values + self.step)
+            if elapsed <= self.target_latency / 2:
+                self.inflight = min(self.max_inflight, self.inflight + 1)
+
+    def failed(self):
+        """Accounts a batch which failed or timed out"""
+        with self._lock:
+            self._saturated()
+
+    def pause(self):
+        """Returns the seconds to wait before the next batch"""
+        if not self.backoff:
+            return 0.
+        return random.uniform(0, self.backoff)
+
+    def _overloaded(self, result):
+        if self.max_failed_ratio is None or not result.total:
+            return False
+        return result.failed > result.total * self.max_failed_ratio
+
+    def _saturated(self):
+        self.saturations += 1
+        self.values = max(self.min_values, int(self.values * self.decrease))
+        self.inflight = max(self.min_inflight,
+                            int(self.inflight * self.decrease))
+        self.backoff = min(self.max_backoff,
+                           max(self.min_backoff, self.backoff * 2))
@@ -0,0 +1,176 @@
+"""
+
+    zbx.metrics.ingest
+    ~~~~~~~~~~~~~~~~~~
+
+    Read values from the input files of ``zabbix_sender -i``, or from
+    newline delimited json, and send them.
+
+    Input files have a value per line::
+
+        <host> <key> <value>
+        <host> <key> <timestamp> <value>
+
+    The second form is read with_timestamps, like ``zabbix_sender -T``.
+    Fields are separated by spaces or tabs, and may be quoted, where ``\\"``
+    and ``\\\\`` are escaped. A host ``-`` is the hostname of the sender.
+
+    Json lines are objects with key, value, and optionally host and clock.
+
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['Failure', 'ingest', 'read_batches']
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import json
+
+from six import integer_types, string_types
+
+from zbx.exceptions import SenderException
+from .batch import MetricBatch
+from .sender import Result
+
+#: a line which cannot be parsed
+Failure = namedtuple('Failure', 'lineno line error')
+
+
+def split_fields(line):
+    """Splits a line into fields, which may be quoted"""
+    if '"' not in line:
+        return line.split()
+    fields, index, length = [], 0, len(line)
+    while True:
+        while index < length and line[index] in ' \t':
+            index += 1
+        if index >= length:
+            return fields
+        if line[index] == '"':
+            value, index = [], index + 1
+            while index < length and line[index] != '"':
+                if line[index] == '\\' and line[index + 1:index + 2] in \
+                        ('"', '\\'):
+                    index += 1
+                value.append(line[index])
+                index += 1
+            if index >= length:
+                raise ValueError('unterminated quoted field')
+            index += 1
+            if index < length and line[index] not in ' \t':
+                raise ValueError('missing space after quoted field')
+            fields.append(''.join(value))
+        else:
+            end = index
+            while end < length and line[end] not in ' \t':
+                end += 1
+            fields.append(line[index:end])
+            index = end
+
+
+def parse_line(line, with_timestamps=False):
+    """Returns host, key, clock and value of an input line"""
+    fields = split_fields(line)
+    if with_timestamps:
+        if len(fields) != 4:
+            raise ValueError('expected host, key, timestamp and value')
+        host, key, clock, value = fields
+        try:
+            clock = int(clock)
+        except ValueError:
+            raise ValueError('invalid timestamp {!r}'.format(clock))
+        return host, key, clock, value
+    if len(fields) != 3:
+        raise ValueError('expected host, key and value')
+    host, key, value = fields
+    return host, key, None, value
+
+
+def parse_json(line):
+    """Returns host, key, clock and value of a json line"""
+    data = json.loads(line)
+    if not isinstance(data, dict):
+        raise ValueError('expected an object')
+    host, key = data.get('host'), data.get('key')
+    if not isinstance(key, string_types) or 'value' not in data:
+        raise ValueError('expected key and value')
+    if host is not None and not isinstance(host, string_types):
+        raise ValueError('invalid host {!r}'.format(host))
+    value = data['value']
+    if not isinstance(value, string_types + integer_types + (float,)) or \
+            isinstance(value, bool):
+        raise ValueError('invalid value {!r}'.format(value))
+    clock = data.get('clock')
+    if clock is not None and (not isinstance(clock, integer_types) or
+                              isinstance(clock, bool)):
+        raise ValueError('invalid clock {!r}'.format(clock))
+    return host, key, clock, value
+
+
+def read_batches(lines, with_timestamps=False, ndjson=False,
+                 batch_size=50000, failures=None):
+    """
+    Yields MetricBatch of at most batch_size values read from lines.
+
+    Blank lines are skipped. Lines which cannot be parsed are appended to
+    failures as Failure, or raise ValueError if failures is None.
+    """
+    batch = MetricBatch()
+    append = batch.append
+    for lineno, line in enumerate(lines, 1):
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            continue
+        try:
+            if ndjson:
+                host, key, clock, value = parse_json(line)
+            else:
+                host, key, clock, value = parse_line(line, with_timestamps)
+        except ValueError as error:
+            if failures is None:
+                raise ValueError('line {}: {}'.format(lineno, error))
+            failures.append(Failure(lineno, line, str(error)))
+            continue
+        append(key, value, host, clock)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = MetricBatch()
+            append = batch.append
+    if len(batch):
+        yield batch
+
+
+def ingest(lines, sender, with_timestamps=False, ndjson=False,
+           batch_size=50000, failures=None):
+    """
+    Sends the values read from lines, returns the Result and the list of
+    Failure of lines which cannot be parsed, appended to failures when it
+    is given.
+
+    The next batch_size lines are parsed while the previous ones are sent,
+    batches are sent in order.
+
+    Raises SenderException when zabbix cannot be reached, the Result of
+    the values sent so far is attached. The failures read so far are kept
+    into failures.
+    """
+    result = Result()
+    if failures is None:
+        failures = []
+    executor = ThreadPoolExecutor(1)
+    pending = None
+    try:
+        for batch in read_batches(lines, with_timestamps, ndjson, batch_size,
+                                  failures):
+            if pending is not None:
+                result += pending.result()
+            pending = executor.submit(sender.send, batch)
+        if pending is not None:
+            result += pending.result()
+    except SenderException as error:
+        error.result = result + (error.result or Result())
+        raise
+    finally:
+        executor.shutdown()
+    return result, failures
@@ -0,0 +1,141 @@
+"""
+
+    zbx.metrics.protocol
+    ~~~~~~~~~~~~~~~~~~~~
+
+    ZBXD framing, as described here:
+    https://www.zabbix.com/documentation/2.2/manual/appendix/protocols/header_datalen
+
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['encode', 'pack', 'parse_info', 'recv_packet']
+
+import re
+import struct
+import zlib
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from json.encoder import encode_basestring_ascii as quote
+
+from six import string_types, text_type
+
+from zbx.exceptions import SenderException
+
+#: protocol signature
+SIGNATURE = b'ZBXD'
+
+#: flag of the protocol version
+FLAG_PROTOCOL = 0x01
+
+#: flag of zlib compressed data
+FLAG_COMPRESSION = 0x02
+
+#: signature, flags, data length, reserved (uncompressed length)
+HEADER = struct.Struct('<4sBII')
+
+INFO_PATTERN = re.compile(r'processed:?\s*(?P<processed>\d+);?\s*'
+                          r'failed:?\s*(?P<failed>\d+);?\s*'
+                          r'total:?\s*(?P<total>\d+);?\s*'
+                          r'seconds spent:?\s*(?P<seconds>[\d.]+)', re.I)
+
+METRIC_FORMAT = '{"host":%s,"key":%s,"value":%s,"clock":%d}'
+
+
+def pack(payload, compress_level=None):
+    """
+    Frames payload bytes into a packet.
+
+    The payload is compressed when compress_level is given, which requires
+    zabbix 4.0+ on the other side.
+    """
+    if compress_level is None:
+        return HEADER.pack(SIGNATURE, FLAG_PROTOCOL, len(payload), 0) + payload
+    data = zlib.compress(payload, compress_level)
+    return HEADER.pack(SIGNATURE, FLAG_PROTOCOL | FLAG_COMPRESSION,
+                       len(data), len(payload)) + data
+
+
+def recv_all(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise SenderException('Connection closed by zabbix')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def unpack_header(header):
+    """Returns the flags, data length and reserved of a packet header"""
+    signature, flags, length, reserved = HEADER.unpack(header)
+    if signature != SIGNATURE or not flags & FLAG_PROTOCOL:
+        raise SenderException('Wrong zabbix response')
+    return flags, length, reserved
+
+
+def unpack_data(flags, data, reserved):
+    """Returns the payload of packet data, decompressed if needed"""
+    if not flags & FLAG_COMPRESSION:
+        return data
+    try:
+        payload = zlib.decompress(data)
+    except zlib.error as error:
+        raise SenderException('Wrong zabbix response: {}'.format(error))
+    if len(payload) != reserved:
+        raise SenderException('Wrong zabbix response length')
+    return payload
+
+
+def recv_packet(sock):
+    """Reads a packet from sock, and returns its payload bytes"""
+    flags, length, reserved = unpack_header(recv_all(sock, HEADER.size))
+    return unpack_data(flags, recv_all(sock, length), reserved)
+
+
+def encode_metric(metric, hostname, clock):
+    """Returns the json of a metric, as bytes"""
+    host = metric.host
+    if host in (None, '-'):
+        host = hostname
+    value = metric.value
+    if value is None:
+        value = '-'
+    elif not isinstance(value, string_types):
+        value = text_type(value)
+    return (METRIC_FORMAT % (
+        quote(host), quote(metric.key), quote(value),
+        int(metric.clock or clock),
+    )).encode('ascii')
+
+
+def encode(fragments, clock, request='sender data'):
+    """Joins metrics encoded by encode_metric into a request payload"""
+    return b''.join([
+        b'{"request":', quote(request).encode('ascii'), b',"data":[',
+        b','.join(fragments),
+        b'],"clock":', str(int(clock)).encode('ascii'), b'}',
+    ])
+
+
+def decode(payload):
+    return json.loads(payload.decode('utf-8'))
+
+
+def parse_info(info):
+    """
+    Parses the info of a response, like
+    ``processed: 1; failed: 0; total: 1; seconds spent: 0.000055``
+    """
+    match = INFO_PATTERN.search(info or '')
+    if not match:
+        raise SenderException('Cannot parse zabbix info {!r}'.format(info))
+    response = match.groupdict()
+    for key in ('processed', 'failed', 'total'):
+        response[key] = int(response[key])
+    response['seconds'] = float(response['seconds'])
+    return response
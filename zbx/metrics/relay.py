@@ -0,0 +1,179 @@
+"""
+
+    zbx.metrics.relay
+    ~~~~~~~~~~~~~~~~~
+
+    Relay trapper packets of many clients upstream, in large batches::
+
+        python -m zbx.metrics.relay --listen 127.0.0.1:10051 \\
+            --server zabbix.example.com --compress-threshold 1024
+
+    Clients, like zabbix_sender, are answered as soon as their values are
+    buffered, their ack means that the relay took the values in charge.
+    Batches which cannot be sent upstream are retried with a backoff, and
+    kept into --spool when it is given.
+
+    This module requires python 3.5+, it is not imported by zbx.metrics.
+
+"""
+
+__all__ = ['Relay', 'main']
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+from zbx.exceptions import SenderException
+from .bases import Metric
+from .buffered import BLOCK, BufferedSender
+from .protocol import FLAG_COMPRESSION, HEADER, decode, pack
+from .protocol import unpack_data, unpack_header
+from .sender import Sender
+from .sharding import parse_endpoint
+
+logger = logging.getLogger(__name__)
+
+
+class Relay(object):
+    """
+    Accepts 'sender data' requests, and submits their values to buffered.
+
+    The block policy of BufferedSender would stall every client, it is
+    refused.
+
+    Parameters:
+    buffered -- BufferedSender which forwards the values upstream
+    max_bytes -- larger packets are refused
+    timeout -- seconds a client has to send its packet
+    """
+
+    def __init__(self, buffered, max_bytes=16 << 20, timeout=10.):
+        if buffered.policy == BLOCK:
+            raise ValueError('Relay cannot use the block policy')
+        self.buffered = buffered
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.requests = 0
+        self.values = 0
+        self.errors = 0
+
+    async def start(self, host='127.0.0.1', port=10051):
+        """Listens on host and port, returns the asyncio server"""
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def handle(self, reader, writer):
+        """Answers a client connection"""
+        compress_level = None
+        try:
+            try:
+                flags, length, reserved = unpack_header(
+                    await asyncio.wait_for(reader.readexactly(HEADER.size),
+                                           self.timeout))
+                if flags & FLAG_COMPRESSION:
+                    compress_level = 6
+                if max(length, reserved) > self.max_bytes:
+                    raise SenderException('Packet of {} bytes is too large'
+                                          .format(max(length, reserved)))
+                data = await asyncio.wait_for(reader.readexactly(length),
+                                              self.timeout)
+                response = self.receive(decode(unpack_data(flags, data,
+                                                           reserved)))
+            except (SenderException, ValueError, KeyError, TypeError,
+                    AttributeError) as error:
+                self.errors += 1
+                response = {'response': 'failed', 'info': str(error)}
+            writer.write(pack(json.dumps(response).encode('utf-8'),
+                              compress_level))
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                OSError) as error:
+            self.errors += 1
+            logger.debug('Client connection failed: %r', error)
+        finally:
+            writer.close()
+
+    def receive(self, request):
+        """Submits the values of a request, and returns the response"""
+        started = time.time()
+        if request.get('request') != 'sender data':
+            raise ValueError('Unsupported request {!r}'
+                             .format(request.get('request')))
+        clock = request.get('clock')
+        processed = failed = 0
+        for data in request['data']:
+            metric = Metric(data['key'], data.get('value'), data.get('host'),
+                            data.get('clock', clock))
+            if self.buffered.submit(metric):
+                processed += 1
+            else:
+                failed += 1
+        self.requests += 1
+        self.values += processed
+        return {
+            'response': 'success',
+            'info': 'processed: %d; failed: %d; total: %d; '
+                    'seconds spent: %.6f' % (processed, failed,
+                                             processed + failed,
+                                             time.time() - started),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m zbx.metrics.relay',
+                                     description='Relay trapper packets')
+    parser.add_argument('--listen', default='127.0.0.1:10051',
+                        help='address of the relay, host:port')
+    parser.add_argument('--server', '-z', default='127.0.0.1',
+                        help='upstream zabbix server or proxy')
+    parser.add_argument('--port', '-p', type=int, default=10051)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--max-age', type=float, default=1.)
+    parser.add_argument('--capacity', type=int, default=1000000)
+    parser.add_argument('--max-inflight', type=int, default=4)
+    parser.add_argument('--compress-threshold', type=int, default=None,
+                        help='compress upstream payloads of this size')
+    parser.add_argument('--spool', default=None,
+                        help='directory keeping undeliverable values')
+    parser.add_argument('--retries', type=int, default=5,
+                        help='retries of a batch which cannot be sent')
+    parser.add_argument('--retry-backoff', type=float, default=1.,
+                        help='seconds before the first retry, doubled by '
+                             'retry')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    spool = None
+    if args.spool:
+        from .spool import Spool
+        spool = Spool(args.spool)
+    sender = Sender(args.server, args.port, max_values=args.batch_size,
+                    max_inflight=args.max_inflight,
+                    compress_threshold=args.compress_threshold, spool=spool)
+    buffered = BufferedSender(sender, capacity=args.capacity,
+                              batch_size=args.batch_size,
+                              max_age=args.max_age, retries=args.retries,
+                              retry_backoff=args.retry_backoff)
+    relay = Relay(buffered)
+    host, port = parse_endpoint(args.listen)
+
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(relay.start(host, port))
+    logger.info('Relaying %s:%s to %s:%s', host, port, args.server,
+                args.port)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        buffered.close()
+        sender.close()
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
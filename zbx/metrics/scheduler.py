@@ -0,0 +1,278 @@
+"""
+
+    zbx.metrics.scheduler
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Run python collectors at the delay of their items, like zabbix
+    schedules its checks.
+
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['Check', 'Scheduler']
+
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import itertools
+import logging
+import re
+import threading
+import time
+from zlib import crc32
+
+from zbx.util import parse_timeperiod
+from .bases import Metric
+
+logger = logging.getLogger(__name__)
+
+SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+PERIOD_PATTERN = re.compile(r'^(?P<first>[1-7])(?:-(?P<last>[1-7]))?,'
+                            r'(?P<start>\d{1,2}):(?P<start_min>\d\d)-'
+                            r'(?P<end>\d{1,2}):(?P<end_min>\d\d)$')
+
+
+def parse_delay(value):
+    """Returns the seconds of a delay like ``60``, ``'30s'`` or ``'5m'``"""
+    period, resolution = parse_timeperiod(value)
+    return period * SECONDS[resolution]
+
+
+def parse_delay_flex(value):
+    """
+    Parses flexible intervals, like ``'10/1-5,09:00-18:00;0/6-7,00:00-24:00'``
+
+    Returns (seconds, first day, last day, start minute, end minute)
+    tuples, days are from 1, monday, to 7.
+    """
+    intervals = []
+    for interval in (value or '').split(';'):
+        if not interval.strip():
+            continue
+        delay, _, period = interval.strip().partition('/')
+        match = PERIOD_PATTERN.match(period)
+        if match is None:
+            raise ValueError('{!r} is not a flexible interval'
+                             .format(interval))
+        first = int(match.group('first'))
+        last = int(match.group('last') or first)
+        start = int(match.group('start')) * 60 + int(match.group('start_min'))
+        end = int(match.group('end')) * 60 + int(match.group('end_min'))
+        intervals.append((parse_delay(delay), first, last, start, end))
+    return intervals
+
+
+class Check(object):
+    """
+    A collector, run every delay seconds.
+
+    Checks of a same delay are spread over the delay by an offset derived
+    from their host and key, the same at every start.
+    """
+
+    def __init__(self, key, func, delay, host=None, delay_flex=None,
+                 args=()):
+        self.key = key
+        self.func = func
+        self.host = host
+        self.delay = parse_delay(delay)
+        self.delay_flex = parse_delay_flex(delay_flex)
+        self.args = args
+        self.seed = crc32('{}:{}'.format(host or '', key).encode('utf-8')) \
+            & 0xffffffff
+        self.cancelled = False
+        self.running = False
+        self.runs = 0
+        self.errors = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.duration = None
+
+    def __repr__(self):
+        return '<Check({!r}, host={!r}, delay={!r})>'.format(
+            self.key, self.host, self.delay)
+
+    def current_delay(self, clock):
+        """Returns the delay at clock, 0 when there is no check"""
+        if not self.delay_flex:
+            return self.delay
+        moment = time.localtime(clock)
+        day, minute = moment.tm_wday + 1, moment.tm_hour * 60 + moment.tm_min
+        for delay, first, last, start, end in self.delay_flex:
+            if first <= day <= last and start <= minute < end:
+                return delay
+        return self.delay
+
+    def nextcheck(self, now):
+        """Returns the first check time after now"""
+        clock = now
+        # a flexible interval of 0 disables checks, up to a week long
+        for _ in range(7 * 24 * 60):
+            delay = self.current_delay(clock)
+            if delay:
+                break
+            clock = (clock // 60 + 1) * 60
+        else:
+            raise ValueError('{!r} is never checked'.format(self))
+        nextcheck = delay * (clock // delay) + self.seed % delay
+        while nextcheck <= now:
+            nextcheck += delay
+        return nextcheck
+
+
+class Scheduler(object):
+    """
+    Runs checks into a bounded pool, and submits their values.
+
+    Checks are kept into a heap ordered by their next check. A value
+    returned by a check is submitted as a Metric of its key and host,
+    clocked at its scheduled time; None is not submitted.
+
+    A check which is still running at its next check time skips it. A run
+    lasting longer than the delay is an overrun. Check times missed while
+    the scheduler was late are skipped too.
+
+    Parameters:
+    sender -- BufferedSender which batches the values
+    workers -- size of the thread pool, unless executor is given
+    executor -- executor of checks, a ProcessPoolExecutor requires
+                picklable functions
+    """
+
+    def __init__(self, sender=None, workers=4, executor=None):
+        if sender is None:
+            from .buffered import BufferedSender
+            sender = BufferedSender()
+        self.sender = sender
+        self.executor = executor or ThreadPoolExecutor(workers)
+        self._checks = {}
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._checks)
+
+    def register(self, key, func, delay=60, host=None, delay_flex=None,
+                 args=()):
+        """Runs func(*args) every delay seconds, returns its Check"""
+        check = Check(key, func, delay, host, delay_flex, args)
+        with self._lock:
+            previous = self._checks.pop((host, key), None)
+            if previous is not None:
+                previous.cancelled = True
+            self._checks[host, key] = check
+            self._schedule(check, check.nextcheck(time.time()))
+        self._wakeup.set()
+        return check
+
+    def register_item(self, item, func, host=None, args=()):
+        """Registers func with the key, delay and delay_flex of an Item"""
+        return self.register(item.key, func, item.delay or 60, host,
+                             item.delay_flex, args)
+
+    def unregister(self, key, host=None):
+        with self._lock:
+            check = self._checks.pop((host, key), None)
+            if check is not None:
+                check.cancelled = True
+
+    def _schedule(self, check, clock):
+        heapq.heappush(self._heap, (clock, next(self._counter), check))
+
+    def stats(self):
+        checks = list(self._checks.values())
+        return {
+            'checks': len(checks),
+            'runs': sum(check.runs for check in checks),
+            'errors': sum(check.errors for check in checks),
+            'overruns': sum(check.overruns for check in checks),
+            'skipped': sum(check.skipped for check in checks),
+        }
+
+    def run_pending(self, now=None):
+        """
+        Starts the checks due at now, and returns the time of the next
+        one, or None.
+        """
+        now = time.time() if now is None else now
+        due = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                clock, _, check = heapq.heappop(heap)
+                if check.cancelled:
+                    continue
+                due.append((clock, check))
+                delay = check.current_delay(clock) or check.delay
+                if delay:
+                    check.skipped += int((now - clock) // delay)
+                self._schedule(check, check.nextcheck(now))
+            while heap and heap[0][2].cancelled:
+                heapq.heappop(heap)
+            following = heap[0][0] if heap else None
+
+        for clock, check in due:
+            if check.running:
+                check.skipped += 1
+                continue
+            check.running = True
+            started = time.time()
+            try:
+                future = self.executor.submit(check.func, *check.args)
+            except RuntimeError:
+                # the executor is shut down
+                check.running = False
+                break
+            future.add_done_callback(
+                lambda future, check=check, clock=clock, started=started:
+                    self._done(check, clock, started, future))
+        return following
+
+    def _done(self, check, clock, started, future):
+        check.running = False
+        check.runs += 1
+        check.duration = time.time() - started
+        if check.duration > check.delay:
+            check.overruns += 1
+        try:
+            value = future.result()
+        except Exception as error:
+            check.errors += 1
+            logger.warning('Check %r failed: %s', check, error)
+            return
+        if value is not None:
+            self.sender.submit(Metric(check.key, value, check.host,
+                                      int(clock)))
+
+    def start(self):
+        """Runs the checks from a background thread"""
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='zbx-scheduler')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def close(self):
+        """Stops the scheduler, and waits for the running checks"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.executor.shutdown()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            following = self.run_pending()
+            timeout = None
+            if following is not None:
+                timeout = max(0, following - time.time())
+            self._wakeup.wait(timeout)
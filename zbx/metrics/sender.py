@@ -0,0 +1,374 @@
+"""
+
+    zbx.metrics.sender
+    ~~~~~~~~~~~~~~~~~~
+
+    Send metrics to zabbix trapper, as described here:
+    http://zabbix.org/wiki/Docs/protocols/zabbix_sender/2.0
+
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['Result', 'Sender', 'configure', 'send']
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import logging
+import socket
+import threading
+import time
+
+from zbx.exceptions import SenderException
+from .batch import MetricBatch
+from .protocol import HEADER, decode, encode, encode_metric, pack
+from .protocol import parse_info, recv_packet
+
+logger = logging.getLogger(__name__)
+
+
+class Result(object):
+    """
+    Counts returned by zabbix, aggregated over batches.
+    """
+
+    def __init__(self, processed=0, failed=0, total=0, seconds=0.,
+                 batches=0, spooled=0):
+        self.processed = processed
+        self.failed = failed
+        self.total = total
+        self.seconds = seconds
+        self.batches = batches
+        self.spooled = spooled
+
+    def __add__(self, other):
+        return Result(self.processed + other.processed,
+                      self.failed + other.failed,
+                      self.total + other.total,
+                      self.seconds + other.seconds,
+                      self.batches + other.batches,
+                      self.spooled + other.spooled)
+
+    def __eq__(self, other):
+        return isinstance(other, Result) and vars(self) == vars(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return ('<Result(processed={}, failed={}, total={}, '
+                'seconds={}, batches={}, spooled={})>').format(
+            self.processed, self.failed, self.total, self.seconds,
+            self.batches, self.spooled)
+
+
+class Batch(object):
+    """Metrics and their encoded packet"""
+
+    def __init__(self, metrics, packet):
+        self.metrics = metrics
+        self.packet = packet
+
+    def __len__(self):
+        return len(self.metrics)
+
+
+class Sender(object):
+    """
+    Sends metrics to a zabbix server or proxy.
+
+    Metrics are split into batches of at most max_values values and
+    max_bytes bytes. Zabbix closes the connection after each response,
+    so up to max_inflight batches are sent at once, each over its own
+    connection.
+
+    Parameters:
+    hostname -- host of metrics which do not define it
+    compress_threshold -- compress payloads of at least this number of
+                          bytes, which requires zabbix 4.0+
+    compress_level -- zlib compression level
+    spool -- Spool which keeps the metrics that cannot be delivered
+    dedup -- Deduplicator which suppresses the unchanged values
+    flow -- FlowControl which tunes the batch size and in-flight batches,
+            instead of max_values and max_inflight
+    tls -- ssl.SSLContext which encrypts the connections, see
+           :func:`~zbx.metrics.tls_context`. The TLS session is resumed
+           by the next connections
+    tls_hostname -- name checked against the certificate, defaults to
+                    server
+    """
+
+    #: request of the packets, active agents send 'agent data'
+    request = 'sender data'
+
+    def __init__(self, server='127.0.0.1', port=10051, timeout=10.,
+                 max_values=250, max_bytes=1 << 20, max_inflight=4,
+                 hostname='localhost', compress_threshold=None,
+                 compress_level=6, spool=None, dedup=None,
+                 flow=None, tls=None, tls_hostname=None):
+        self.server = server
+        self.port = port
+        self.timeout = timeout
+        self.max_values = max_values
+        self.max_bytes = max_bytes
+        self.max_inflight = max_inflight
+        self.hostname = hostname
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.spool = spool
+        self.dedup = dedup
+        self.flow = flow
+        self.tls = tls
+        self.tls_hostname = tls_hostname
+        self.handshakes = 0
+        self.resumed = 0
+        self.handshake_seconds = 0.
+        self._session = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._executor:
+                self._executor.shutdown()
+                self._executor = None
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                workers = self.max_inflight
+                if self.flow is not None:
+                    workers = self.flow.max_inflight
+                self._executor = ThreadPoolExecutor(workers)
+            return self._executor
+
+    def send(self, metrics):
+        """
+        Sends metrics, and returns the Result aggregated over batches.
+
+        Raises SenderException when a batch cannot be delivered, after the
+        other batches in flight are done. The partial Result and the
+        undelivered metrics are attached to the exception.
+
+        With a spool, undelivered metrics are spooled instead of raising,
+        and the spooled ones are replayed before the new ones as soon as
+        zabbix answers again.
+
+        With a dedup, unchanged values are not sent. Those which were
+        neither delivered nor spooled are forgotten, so they are sent again
+        next time.
+        """
+        if self.dedup is not None:
+            metrics = self.dedup.filter(metrics)
+
+        if self.spool is None:
+            undelivered = []
+            try:
+                return self.deliver(metrics, undelivered)
+            except SenderException as error:
+                if self.dedup is not None:
+                    self.dedup.forget(undelivered)
+                error.undelivered = undelivered
+                raise
+
+        now = time.time()
+        if self.spool.ready():
+            self.spool.replay(self.deliver)
+        if self.spool.pending:
+            # keep the order, behind the spooled metrics
+            return Result(spooled=self.spool.extend(metrics, now))
+
+        undelivered = []
+        try:
+            return self.deliver(metrics, undelivered)
+        except SenderException as error:
+            self.spool.extend(undelivered, now)
+            self.spool.failed()
+            result = error.result
+            result.spooled = len(undelivered)
+            return result
+
+    def deliver(self, metrics, undelivered=None):
+        """
+        Sends metrics, and raises SenderException when a batch fails.
+        Metrics which were not delivered are added to undelivered.
+        """
+        result, error = Result(), None
+        inflight = {}
+        batches = self.batches(metrics)
+        while True:
+            for batch in batches:
+                if self.flow is not None:
+                    time.sleep(self.flow.pause())
+                future = self.executor.submit(self.send_batch, batch)
+                inflight[future] = batch
+                if len(inflight) >= self.inflight_limit():
+                    break
+            if not inflight:
+                break
+            done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = inflight.pop(future)
+                try:
+                    result += future.result()
+                except Exception as exc:
+                    logger.warning('Batch failed: %s', exc)
+                    error = error or exc
+                    if undelivered is not None:
+                        undelivered.extend(batch.metrics)
+                        for batch in batches:
+                            undelivered.extend(batch.metrics)
+                    # do not send the remaining batches
+                    batches = iter(())
+        if error:
+            raise SenderException(str(error), result)
+        return result
+
+    def batch_limit(self):
+        """Returns the number of values of the next batch"""
+        if self.flow is None:
+            return self.max_values
+        return self.flow.values
+
+    def inflight_limit(self):
+        """Returns the number of batches to send at once"""
+        if self.flow is None:
+            return self.max_inflight
+        return self.flow.inflight
+
+    def batches(self, metrics):
+        """Splits metrics, or a MetricBatch, into encoded batches"""
+        if isinstance(metrics, MetricBatch):
+            return self._columnar_batches(metrics)
+        return self._batches(metrics)
+
+    def _columnar_batches(self, metrics):
+        clock = time.time()
+        start = 0
+        while start < len(metrics):
+            packet, stop = metrics.encode(start, self.hostname, clock,
+                                          self.batch_limit(), self.max_bytes,
+                                          self.request)
+            if self.compress_threshold is not None and \
+                    len(packet) - HEADER.size >= self.compress_threshold:
+                packet = self.pack(bytes(packet[HEADER.size:]))
+            yield Batch(metrics.slice(start, stop), packet)
+            start = stop
+
+    def _batches(self, metrics):
+        clock = time.time()
+        selected, fragments, size = [], [], 0
+        limit = self.batch_limit()
+        for metric in metrics:
+            fragment = encode_metric(metric, self.hostname, clock)
+            if fragments and (len(fragments) >= limit or
+                              size + len(fragment) > self.max_bytes):
+                yield self._batch(selected, fragments, clock)
+                selected, fragments, size = [], [], 0
+                limit = self.batch_limit()
+            selected.append(metric)
+            fragments.append(fragment)
+            size += len(fragment) + 1
+        if fragments:
+            yield self._batch(selected, fragments, clock)
+
+    def _batch(self, metrics, fragments, clock):
+        return Batch(metrics, self.pack(encode(fragments, clock,
+                                               self.request)))
+
+    def pack(self, payload):
+        """Frames payload, compressed if it is large enough"""
+        if self.compress_threshold is not None and \
+                len(payload) >= self.compress_threshold:
+            return pack(payload, self.compress_level)
+        return pack(payload)
+
+    def send_batch(self, batch):
+        """Delivers a batch, and returns its Result"""
+        if self.flow is None:
+            return self.result(self.exchange(batch.packet))
+        started = time.time()
+        try:
+            result = self.result(self.exchange(batch.packet))
+        except Exception:
+            self.flow.failed()
+            raise
+        self.flow.completed(result, time.time() - started)
+        return result
+
+    def result(self, response):
+        """Returns the Result of a decoded response"""
+        if response.get('response') != 'success':
+            raise SenderException(response.get('info',
+                                               'Error from zabbix server'))
+        info = parse_info(response.get('info'))
+        return Result(info['processed'], info['failed'], info['total'],
+                      info['seconds'], 1)
+
+    def exchange(self, packet):
+        """Sends a packet and returns the decoded response"""
+        sock = self.connect()
+        try:
+            sock.sendall(packet)
+            response = decode(recv_packet(sock))
+            if self.tls is not None:
+                # TLS 1.3 tickets are received after the handshake
+                self._session = getattr(sock, 'session', None)
+            return response
+        finally:
+            sock.close()
+
+    def connect(self):
+        sock = socket.create_connection((self.server, self.port),
+                                        self.timeout)
+        if self.tls is None:
+            return sock
+        options = {'server_hostname': self.tls_hostname or self.server}
+        if self._session is not None:
+            options['session'] = self._session
+        started = time.time()
+        try:
+            sock = self.tls.wrap_socket(sock, **options)
+        except Exception:
+            sock.close()
+            raise
+        with self._lock:
+            self.handshake_seconds += time.time() - started
+            if getattr(sock, 'session_reused', False):
+                self.resumed += 1
+            else:
+                self.handshakes += 1
+        return sock
+
+    def tls_stats(self):
+        """Returns the number and cost of TLS handshakes"""
+        return {
+            'handshakes': self.handshakes,
+            'resumed': self.resumed,
+            'handshake_seconds': self.handshake_seconds,
+        }
+
+
+_instance = Sender()
+
+#: send with the global sender instance
+send = _instance.send
+
+
+def configure(**attrs):
+    """
+    Configure the global sender instance.
+
+    """
+    for attr, value in attrs.items():
+        if attr in ('server', 'port', 'timeout', 'max_values', 'max_bytes',
+                    'max_inflight', 'hostname', 'compress_threshold',
+                    'compress_level', 'spool', 'dedup',
+                    'flow', 'tls', 'tls_hostname'):
+            setattr(_instance, attr, value)
@@ -0,0 +1,264 @@
+"""
+
+    zbx.metrics.sharding
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Route the metrics of a host always to the same server or proxy.
+
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['HashRing', 'ShardedSender']
+
+from bisect import bisect
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+import logging
+import os.path
+import struct
+import threading
+
+from six import string_types
+
+from zbx.exceptions import SenderException
+from .sender import Result, Sender
+from .spool import Spool
+
+logger = logging.getLogger(__name__)
+
+POINT = struct.Struct('>Q')
+
+
+def parse_endpoint(endpoint, default_port=10051):
+    """Returns (host, port) of 'host:port', 'host' or (host, port)"""
+    if isinstance(endpoint, string_types):
+        host, _, port = endpoint.rpartition(':')
+        if not host or not port.isdigit():
+            return endpoint, default_port
+        return host, int(port)
+    host, port = endpoint
+    return host, int(port)
+
+
+def hash_point(value):
+    return POINT.unpack_from(md5(value.encode('utf-8')).digest())[0]
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys over nodes.
+
+    Each node owns replicas points of the ring, a key belongs to the node
+    of the next point. Adding or removing a node only moves the keys of
+    its points.
+    """
+
+    def __init__(self, nodes=(), replicas=160):
+        self.replicas = replicas
+        self._points = []
+        self._owners = {}
+        self._nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def add(self, node):
+        self._nodes.add(node)
+        for i in range(self.replicas):
+            point = hash_point('{}-{}'.format(node, i))
+            if point not in self._owners:
+                self._owners[point] = node
+        self._points = sorted(self._owners)
+
+    def remove(self, node):
+        self._nodes.discard(node)
+        self._owners = dict((point, owner)
+                            for point, owner in self._owners.items()
+                            if owner != node)
+        self._points = sorted(self._owners)
+
+    def get(self, key):
+        """Returns the node of key"""
+        if not self._points:
+            raise LookupError('Hash ring is empty')
+        index = bisect(self._points, hash_point(key)) % len(self._points)
+        return self._owners[self._points[index]]
+
+
+class ShardedSender(object):
+    """
+    Sends metrics to several servers or proxies, partitioned by host.
+
+    A host goes to its entry of overrides, otherwise to its endpoint on a
+    consistent hash ring. Partitions are sent in parallel.
+
+    Every endpoint has its own spool, so replayed metrics still go to the
+    proxy of their host. A Spool instance cannot be shared.
+
+    Parameters:
+    endpoints -- like ``['proxy1:10051', ('proxy2', 10051)]``
+    overrides -- mapping of host to endpoint
+    spool -- directory of the spools, one subdirectory per endpoint, or
+             a callable which returns the Spool of an endpoint
+    options -- given to the Sender of every endpoint
+    """
+
+    def __init__(self, endpoints, overrides=None, replicas=160, spool=None,
+                 **options):
+        if spool is not None and not (isinstance(spool, string_types) or
+                                      callable(spool)):
+            raise ValueError('A spool cannot be shared by endpoints, give '
+                             'a directory or a callable')
+        self.spool = spool
+        self.options = options
+        self.hostname = options.get('hostname', 'localhost')
+        self.senders = {}
+        self.ring = HashRing(replicas=replicas)
+        self.overrides = dict((host, parse_endpoint(endpoint))
+                              for host, endpoint in (overrides or {}).items())
+        self._routes = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._workers = 0
+        for endpoint in endpoints:
+            self.add_endpoint(endpoint)
+
+    def add_endpoint(self, endpoint):
+        endpoint = parse_endpoint(endpoint)
+        with self._lock:
+            if endpoint not in self.ring:
+                if endpoint not in self.senders:
+                    self.senders[endpoint] = self._sender(endpoint)
+                self.ring.add(endpoint)
+                self._routes = {}
+
+    def remove_endpoint(self, endpoint):
+        """
+        Removes endpoint from the ring.
+
+        The metrics still spooled for it are sent again through the
+        remaining endpoints. When some of them cannot be delivered nor
+        spooled elsewhere, the endpoint is kept and SenderException is
+        raised.
+        """
+        endpoint = parse_endpoint(endpoint)
+        with self._lock:
+            self.ring.remove(endpoint)
+            self._routes = {}
+            sender = None
+            if endpoint not in self.overrides.values():
+                sender = self.senders.get(endpoint)
+        spool = getattr(sender, 'spool', None)
+        if spool is not None and spool.pending:
+            spool.replay(self.send)
+            if spool.pending:
+                with self._lock:
+                    self.ring.add(endpoint)
+                    self._routes = {}
+                raise SenderException('{}:{} has spooled metrics which '
+                                      'cannot be sent elsewhere'.format(
+                                          *endpoint))
+        with self._lock:
+            if sender is not None and endpoint not in self.ring:
+                self.senders.pop(endpoint, None)
+                self._close(sender)
+
+    def route(self, host):
+        """Returns the endpoint of host"""
+        try:
+            return self._routes[host]
+        except KeyError:
+            pass
+        endpoint = self.overrides.get(host)
+        if endpoint is None:
+            endpoint = self.ring.get(host)
+        self._routes[host] = endpoint
+        return endpoint
+
+    def partition(self, metrics):
+        """Returns {endpoint: metrics}"""
+        partitions = {}
+        route = self.route
+        for metric in metrics:
+            host = metric.host
+            if host in (None, '-'):
+                host = self.hostname
+            partitions.setdefault(route(host), []).append(metric)
+        return partitions
+
+    def send(self, metrics):
+        """
+        Sends metrics, and returns the Result aggregated over endpoints.
+
+        Raises SenderException when a partition cannot be delivered, after
+        the others are done. The partial Result is attached to the
+        exception.
+        """
+        partitions = self.partition(metrics)
+        with self._lock:
+            workers = max(len(self.senders), len(partitions), 1)
+            if workers > self._workers:
+                # endpoints were added, the running sends may complete
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                self._executor = ThreadPoolExecutor(workers)
+                self._workers = workers
+            futures = dict((endpoint, self._executor.submit(
+                self._send_partition, endpoint, partition))
+                for endpoint, partition in partitions.items())
+
+        result, errors = Result(), []
+        for endpoint, future in futures.items():
+            try:
+                result += future.result()
+            except SenderException as error:
+                logger.warning('Cannot send to %s:%s: %s',
+                               endpoint[0], endpoint[1], error)
+                errors.append('{}:{}: {}'.format(endpoint[0], endpoint[1],
+                                                 error))
+                result += error.result or Result()
+        if errors:
+            raise SenderException('; '.join(errors), result)
+        return result
+
+    def _send_partition(self, endpoint, metrics):
+        with self._lock:
+            sender = self.senders.get(endpoint)
+            if sender is None:
+                # overrides may point outside of the ring
+                sender = self.senders[endpoint] = self._sender(endpoint)
+        return sender.send(metrics)
+
+    def _sender(self, endpoint):
+        spool = self.spool
+        if isinstance(spool, string_types):
+            spool = Spool(os.path.join(spool, '{}-{}'.format(*endpoint)))
+        elif spool is not None:
+            spool = spool(endpoint)
+        return Sender(endpoint[0], endpoint[1], spool=spool, **self.options)
+
+    def _close(self, sender):
+        sender.close()
+        if sender.spool is not None:
+            sender.spool.close()
+
+    def close(self):
+        with self._lock:
+            if self._executor:
+                self._executor.shutdown()
+                self._executor = None
+                self._workers = 0
+            for sender in self.senders.values():
+                self._close(sender)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,290 @@
+"""
+
+    zbx.metrics.shm
+    ~~~~~~~~~~~~~~~
+
+    Share a metric buffer between the workers of a pre-fork server.
+
+    The buffer is a memory mapped file, /dev/shm is a good place for it.
+    It is split into lanes, every worker process claims its own lane with
+    a lock on the file, which is released when the process dies. A lane is
+    a ring of fixed size slots with a single writer, the worker, and a
+    single reader, the flusher, so writing needs no lock between
+    processes. Metrics left by a dead worker are still flushed, and its
+    lane is claimed again by the next worker.
+
+    Every lane has a header of two cache lines, one written by the worker::
+
+        head, pid, dropped
+
+    and one written by the flusher::
+
+        tail
+
+    This module requires fcntl, it is not imported by zbx.metrics.
+
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['Flusher', 'SharedBuffer']
+
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from .sender import _instance as default_sender
+from .spool import decode_body, encode_body
+
+logger = logging.getLogger(__name__)
+
+#: magic, lanes, slots per lane, slot size
+HEADER = struct.Struct('<8sIII')
+MAGIC = b'ZBXSHM01'
+HEADER_SIZE = 64
+
+#: head, pid, dropped
+WRITER = struct.Struct('<QqQ')
+#: tail
+READER = struct.Struct('<Q')
+CACHE_LINE = 64
+LANE_HEADER_SIZE = 2 * CACHE_LINE
+
+#: length of a record in a slot
+SLOT = struct.Struct('<H')
+
+#: byte locked by the flusher
+FLUSHER_LOCK = 1
+
+
+def try_lock(fd, offset):
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+    except (IOError, OSError) as error:
+        if error.errno in (errno.EACCES, errno.EAGAIN):
+            return False
+        raise
+    return True
+
+
+class SharedBuffer(object):
+    """
+    Ring buffers of metrics, in a file shared by processes.
+
+    The first process creates the file, the others use its geometry.
+    :meth:`submit` claims a lane for the current process, again after a
+    fork. Metrics are dropped when the lane is full or when they do not
+    fit into a slot.
+
+    Parameters:
+    path -- file of the buffer
+    lanes -- number of lanes, at least the number of worker processes
+    slots -- number of metrics per lane
+    slot_size -- maximal size of an encoded metric, plus 2 bytes
+    """
+
+    def __init__(self, path, lanes=64, slots=4096, slot_size=256):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, 0)
+        try:
+            size = os.fstat(self._fd).st_size
+            if size < HEADER_SIZE:
+                size = HEADER_SIZE + lanes * (LANE_HEADER_SIZE +
+                                              slots * slot_size)
+                os.ftruncate(self._fd, size)
+                os.write(self._fd, HEADER.pack(MAGIC, lanes, slots,
+                                               slot_size))
+            self._map = mmap.mmap(self._fd, size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 0)
+
+        magic, lanes, slots, slot_size = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError('{} is not a metric buffer'.format(path))
+        self.lanes = lanes
+        self.slots = slots
+        self.slot_size = slot_size
+        self.lane_size = LANE_HEADER_SIZE + slots * slot_size
+
+        self._pid = None
+        self._lane = None
+        self._offset = None
+        self._head = 0
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            os.close(self._fd)
+
+    def offset(self, lane):
+        return HEADER_SIZE + lane * self.lane_size
+
+    @property
+    def lane(self):
+        """Lane of the current process, claimed on first use"""
+        if self._pid != os.getpid():
+            self._claim()
+        return self._lane
+
+    def _claim(self):
+        for lane in range(self.lanes):
+            offset = self.offset(lane)
+            if try_lock(self._fd, offset):
+                head, pid, dropped = WRITER.unpack_from(self._map, offset)
+                self._head, self._dropped = head, dropped
+                self._lane, self._pid = lane, os.getpid()
+                self._offset = offset
+                WRITER.pack_into(self._map, offset, head, self._pid, dropped)
+                return
+        raise RuntimeError('All {} lanes of {} are claimed'
+                           .format(self.lanes, self.path))
+
+    def submit(self, metric):
+        """
+        Writes metric into the lane of the current process.
+        Returns False if it was dropped.
+        """
+        body = encode_body(metric, time.time())
+        with self._lock:
+            if self._pid != os.getpid():
+                self._claim()
+            offset = self._offset
+            head = self._head
+            tail = READER.unpack_from(self._map, offset + CACHE_LINE)[0]
+            if head - tail >= self.slots or \
+                    SLOT.size + len(body) > self.slot_size:
+                self._dropped += 1
+                WRITER.pack_into(self._map, offset, head, self._pid,
+                                 self._dropped)
+                return False
+            start = offset + LANE_HEADER_SIZE + \
+                (head % self.slots) * self.slot_size
+            SLOT.pack_into(self._map, start, len(body))
+            start += SLOT.size
+            self._map[start:start + len(body)] = body
+            # publish the slot
+            self._head = head + 1
+            WRITER.pack_into(self._map, offset, self._head, self._pid,
+                             self._dropped)
+        return True
+
+    def read(self, limit):
+        """
+        Returns up to limit metrics from all lanes, and the positions to
+        commit once they are delivered.
+        """
+        metrics, positions = [], {}
+        for lane in range(self.lanes):
+            offset = self.offset(lane)
+            head = WRITER.unpack_from(self._map, offset)[0]
+            tail = READER.unpack_from(self._map, offset + CACHE_LINE)[0]
+            stop = min(head, tail + limit - len(metrics))
+            for position in range(tail, stop):
+                start = offset + LANE_HEADER_SIZE + \
+                    (position % self.slots) * self.slot_size
+                length = SLOT.unpack_from(self._map, start)[0]
+                start += SLOT.size
+                metrics.append(decode_body(self._map[start:start + length]))
+            if stop > tail:
+                positions[lane] = stop
+            if len(metrics) >= limit:
+                break
+        return metrics, positions
+
+    def commit(self, positions):
+        """Frees the slots read up to positions"""
+        for lane, tail in positions.items():
+            READER.pack_into(self._map, self.offset(lane) + CACHE_LINE, tail)
+
+    def stats(self):
+        """Returns pid, pending and dropped metrics of the used lanes"""
+        lanes = []
+        for lane in range(self.lanes):
+            offset = self.offset(lane)
+            head, pid, dropped = WRITER.unpack_from(self._map, offset)
+            if not pid:
+                continue
+            tail = READER.unpack_from(self._map, offset + CACHE_LINE)[0]
+            lanes.append({'lane': lane, 'pid': pid, 'pending': head - tail,
+                          'dropped': dropped})
+        return lanes
+
+
+class Flusher(object):
+    """
+    Sends the metrics of a SharedBuffer.
+
+    Only one flusher may run per buffer, usually in the master process or
+    in a dedicated one. Metrics are freed once the sender delivered them,
+    they are read again after a failure.
+    """
+
+    def __init__(self, buffer, sender=None, interval=1., batch_size=10000):
+        if not try_lock(buffer._fd, FLUSHER_LOCK):
+            raise RuntimeError('{} is already flushed by another process'
+                               .format(buffer.path))
+        self.buffer = buffer
+        self.sender = sender or default_sender
+        self.interval = interval
+        self.batch_size = batch_size
+        self.sent = 0
+        self.failed = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def flush(self):
+        """Sends all pending metrics, returns their number"""
+        sent = 0
+        while True:
+            metrics, positions = self.buffer.read(self.batch_size)
+            if not metrics:
+                break
+            try:
+                self.sender.send(metrics)
+            except Exception as error:
+                logger.warning('Cannot flush %s metrics: %s',
+                               len(metrics), error)
+                self.failed += 1
+                break
+            self.buffer.commit(positions)
+            sent += len(metrics)
+        self.sent += sent
+        return sent
+
+    def run(self):
+        """Flushes every interval until :meth:`close` is called"""
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+    def start(self):
+        """Flushes every interval from a background thread"""
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self.run,
+                                            name='zbx-flusher')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def close(self):
+        """Stops flushing, after one last flush"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
@@ -0,0 +1,287 @@
+"""
+
+    zbx.metrics.spool
+    ~~~~~~~~~~~~~~~~~
+
+    Keep undeliverable metrics on disk, and replay them later.
+
+    Records are appended into preallocated segment files through mmap.
+    Each record is its body length and crc32, followed by the body::
+
+        clock, host length, key length, value length, host, key, value
+
+    The header is written after the body, so a record is either complete or
+    discarded when the spool is opened again after a crash.
+
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['Spool']
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from zlib import crc32
+
+from .bases import Metric
+
+logger = logging.getLogger(__name__)
+
+#: body length, crc32 of body
+RECORD = struct.Struct('<II')
+
+#: clock, host length, key length, value length
+BODY = struct.Struct('<qHHI')
+
+
+def scan(data, offset, end):
+    """Yields (offset, body) of the valid records of data"""
+    while offset + RECORD.size <= end:
+        length, checksum = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size
+        if not length or start + length > end:
+            return
+        body = data[start:start + length]
+        if crc32(body) & 0xffffffff != checksum:
+            return
+        yield offset, body
+        offset = start + length
+
+
+def encode_body(metric, clock):
+    host = (metric.host or '').encode('utf-8')
+    key = metric.key.encode('utf-8')
+    value = metric.value
+    value = ('-' if value is None else '{}'.format(value)).encode('utf-8')
+    return b''.join([BODY.pack(int(metric.clock or clock), len(host),
+                               len(key), len(value)), host, key, value])
+
+
+def decode_body(body):
+    clock, host_size, key_size, value_size = BODY.unpack_from(body)
+    start = BODY.size
+    host = body[start:start + host_size].decode('utf-8')
+    start += host_size
+    key = body[start:start + key_size].decode('utf-8')
+    start += key_size
+    value = body[start:start + value_size].decode('utf-8')
+    return Metric(key, value, host or None, clock)
+
+
+class Spool(object):
+    """
+    Disk backed ring buffer of metrics.
+
+    At most max_segments files of segment_size bytes are kept, the oldest
+    segment is evicted when a new one is needed.
+
+    Parameters:
+    path -- directory of segment files
+    retry_interval -- seconds to wait before replaying after a failure
+    sync -- msync segments after every write
+    """
+
+    def __init__(self, path, segment_size=16 << 20, max_segments=64,
+                 retry_interval=30., sync=False):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.retry_interval = retry_interval
+        self.sync = sync
+        self.next_retry = 0.
+        self.appended = 0
+        self.replayed = 0
+        self.evicted = 0
+        self._lock = threading.RLock()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._segments = sorted(int(name[:-4]) for name in os.listdir(path)
+                                if name.endswith('.seg'))
+        if not self._segments:
+            self._create(0)
+        self._map = self._open(self._segments[-1])
+        self._offset = 0
+        for offset, body in scan(self._map, 0, self.segment_size):
+            self._offset = offset + RECORD.size + len(body)
+
+        self._cursor = self._load_cursor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def pending(self):
+        """True if some metrics wait to be replayed"""
+        return self._cursor != (self._segments[-1], self._offset)
+
+    def ready(self):
+        """True if metrics are pending and the retry interval elapsed"""
+        return self.pending and time.time() >= self.next_retry
+
+    def failed(self):
+        """Postpones the next replay"""
+        self.next_retry = time.time() + self.retry_interval
+
+    def extend(self, metrics, clock=None):
+        """
+        Appends metrics, those without clock get clock or now.
+        Returns the number of appended metrics.
+        """
+        clock = int(clock or time.time())
+        count = 0
+        with self._lock:
+            for metric in metrics:
+                self._append(metric, clock)
+                count += 1
+            if self.sync:
+                self._map.flush()
+        return count
+
+    def append(self, metric, clock=None):
+        self.extend([metric], clock)
+
+    def _append(self, metric, clock):
+        body = encode_body(metric, clock)
+        size = RECORD.size + len(body)
+        if size > self.segment_size:
+            raise ValueError('Metric {!r} does not fit into a segment'
+                             .format(metric))
+        if self._offset + size > self.segment_size:
+            self._roll()
+        offset = self._offset
+        self._map[offset + RECORD.size:offset + size] = body
+        RECORD.pack_into(self._map, offset, len(body),
+                         crc32(body) & 0xffffffff)
+        self._offset += size
+        self.appended += 1
+
+    def read(self, limit):
+        """
+        Returns up to limit metrics from the cursor, and the position to
+        commit once they are delivered.
+        """
+        with self._lock:
+            metrics = []
+            segment, offset = self._cursor
+            for segment in self._segments:
+                if segment < self._cursor[0]:
+                    continue
+                if segment != self._cursor[0]:
+                    offset = 0
+                records = self._records(segment, offset)
+                try:
+                    for offset, body in records:
+                        if len(metrics) >= limit:
+                            return metrics, (segment, offset)
+                        metrics.append(decode_body(body))
+                        offset += RECORD.size + len(body)
+                finally:
+                    records.close()
+            return metrics, (segment, offset)
+
+    def _records(self, segment, offset):
+        if segment == self._segments[-1]:
+            for record in scan(self._map, offset, self._offset):
+                yield record
+            return
+        with open(self._filename(segment), 'rb') as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for record in scan(data, offset, len(data)):
+                    yield record
+            finally:
+                data.close()
+
+    def commit(self, position):
+        """Moves the cursor, and removes the segments left behind"""
+        with self._lock:
+            if position[0] < self._cursor[0]:
+                # the segment was evicted meanwhile
+                return
+            self._cursor = position
+            while self._segments[0] < position[0]:
+                os.remove(self._filename(self._segments.pop(0)))
+            self._save_cursor()
+
+    def replay(self, send, batch_size=10000):
+        """
+        Sends the pending metrics by calls of send, in order.
+
+        send must raise when the metrics cannot be delivered, the replay
+        stops there. Returns the number of replayed metrics.
+        """
+        replayed = 0
+        while True:
+            metrics, position = self.read(batch_size)
+            if not metrics:
+                break
+            try:
+                send(metrics)
+            except Exception as error:
+                logger.warning('Replay of %s metrics failed: %s',
+                               len(metrics), error)
+                self.failed()
+                break
+            self.commit(position)
+            replayed += len(metrics)
+        self.replayed += replayed
+        return replayed
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.flush()
+                self._map.close()
+                self._map = None
+
+    def _filename(self, segment):
+        return os.path.join(self.path, '{:012d}.seg'.format(segment))
+
+    def _create(self, segment):
+        with open(self._filename(segment), 'wb') as file:
+            file.truncate(self.segment_size)
+        self._segments.append(segment)
+
+    def _open(self, segment):
+        with open(self._filename(segment), 'r+b') as file:
+            return mmap.mmap(file.fileno(), self.segment_size)
+
+    def _roll(self):
+        self._map.flush()
+        self._map.close()
+        self._create(self._segments[-1] + 1)
+        self._map = self._open(self._segments[-1])
+        self._offset = 0
+        while len(self._segments) > self.max_segments:
+            segment = self._segments.pop(0)
+            os.remove(self._filename(segment))
+            self.evicted += 1
+            logger.warning('Spool segment %s evicted', segment)
+            if self._cursor[0] <= segment:
+                self._cursor = (self._segments[0], 0)
+                self._save_cursor()
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.path, 'cursor')) as file:
+                segment, offset = [int(v) for v in file.read().split()]
+        except (IOError, OSError, ValueError):
+            return self._segments[0], 0
+        if segment < self._segments[0]:
+            return self._segments[0], 0
+        return segment, offset
+
+    def _save_cursor(self):
+        path = os.path.join(self.path, 'cursor')
+        tmp = '{}.tmp'.format(path)
+        with open(tmp, 'w') as file:
+            file.write('{} {}'.format(*self._cursor))
+        os.rename(tmp, path)
@@ -0,0 +1,197 @@
+"""
+
+    zbx.metrics.statsd
+    ~~~~~~~~~~~~~~~~~~
+
+    Receive statsd lines over UDP, and send their aggregates to zabbix::
+
+        python -m zbx.metrics.statsd --listen 127.0.0.1:8125 \\
+            --server zabbix.example.com \\
+            --template '^(?P<host>[^.]+)\\.(?P<name>.+)$' '{host}' \\
+                       'statsd[{name}]'
+
+    Lines are ``name:value|type`` or ``name:value|type|@rate``, where type
+    is ``c`` for counters, ``g`` for gauges, ``ms`` or ``h`` for timers, in
+    milliseconds, and ``s`` for sets. A gauge value with a sign is added
+    to the gauge. Tags, after ``|#``, are ignored.
+
+    This module requires python 3.5+, it is not imported by zbx.metrics.
+
+"""
+
+__all__ = ['StatsdBridge', 'StatsdProtocol', 'Template', 'main']
+
+import argparse
+import asyncio
+import logging
+import re
+
+from .aggregate import Aggregator
+from .sender import Sender
+from .sharding import parse_endpoint
+
+logger = logging.getLogger(__name__)
+
+
+class Template(object):
+    """
+    Maps the statsd names matching pattern to a zabbix host and key.
+
+    host and key are formatted with the named groups of the match, host
+    may be None for the hostname of the sender.
+    """
+
+    def __init__(self, pattern, host, key):
+        self.pattern = re.compile(pattern)
+        self.host = host
+        self.key = key
+
+    def route(self, name):
+        """Returns (host, key) of name, or None if it does not match"""
+        match = self.pattern.match(name)
+        if match is None:
+            return None
+        groups = match.groupdict()
+        host = self.host.format(**groups) if self.host else None
+        return host, self.key.format(**groups)
+
+
+class StatsdBridge(object):
+    """
+    Parses statsd packets into an Aggregator.
+
+    The routes of names are cached, up to max_routes of them, so templates
+    are matched once per name. Names which match no template are sent
+    as keys of the default host.
+
+    Parameters:
+    aggregator -- Aggregator which sends the values every interval, its
+                  max_keys bounds the memory
+    templates -- Template sequence, the first matching one is used
+    """
+
+    def __init__(self, aggregator, templates=(), max_routes=100000):
+        self.aggregator = aggregator
+        self.templates = list(templates)
+        self.max_routes = max_routes
+        self.packets = 0
+        self.lines = 0
+        self.errors = 0
+        self._routes = {}
+
+    def route(self, name):
+        """Returns (host, key) of a statsd name, given as bytes"""
+        try:
+            return self._routes[name]
+        except KeyError:
+            pass
+        decoded = name.decode('utf-8', 'replace')
+        route = None
+        for template in self.templates:
+            route = template.route(decoded)
+            if route is not None:
+                break
+        if route is None:
+            route = None, decoded
+        if len(self._routes) >= self.max_routes:
+            self._routes.clear()
+        self._routes[name] = route
+        return route
+
+    def feed(self, packet):
+        """Aggregates the lines of a packet"""
+        self.packets += 1
+        aggregator = self.aggregator
+        route = self.route
+        for line in packet.split(b'\n'):
+            if not line:
+                continue
+            self.lines += 1
+            try:
+                name, _, rest = line.partition(b':')
+                fields = rest.split(b'|')
+                value, kind = fields[0], fields[1]
+                rate = 1.
+                if len(fields) > 2 and fields[2][:1] == b'@':
+                    rate = float(fields[2][1:])
+                host, key = route(name)
+                if kind == b'c':
+                    count = int(value) if value.isdigit() else float(value)
+                    if rate != 1.:
+                        count /= rate
+                    aggregator.incr(key, count, host)
+                elif kind == b'ms' or kind == b'h':
+                    aggregator.timing(key, float(value) / 1000., host)
+                elif kind == b'g':
+                    aggregator.gauge(key, float(value), host,
+                                     value[:1] in (b'+', b'-'))
+                elif kind == b's':
+                    aggregator.unique(key, value, host)
+                else:
+                    raise ValueError('Unknown type {!r}'.format(kind))
+            except (ValueError, IndexError, ZeroDivisionError) as error:
+                self.errors += 1
+                logger.debug('Cannot parse %r: %s', line, error)
+
+    async def start(self, host='127.0.0.1', port=8125):
+        """Listens on host and port, returns the asyncio transport"""
+        loop = asyncio.get_event_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: StatsdProtocol(self), local_addr=(host, port))
+        return transport
+
+
+class StatsdProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, bridge):
+        self.bridge = bridge
+
+    def datagram_received(self, data, addr):
+        self.bridge.feed(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m zbx.metrics.statsd',
+                                     description='Bridge statsd to zabbix')
+    parser.add_argument('--listen', default='127.0.0.1:8125',
+                        help='address of the bridge, host:port')
+    parser.add_argument('--server', '-z', default='127.0.0.1')
+    parser.add_argument('--port', '-p', type=int, default=10051)
+    parser.add_argument('--hostname', '-s', default='localhost',
+                        help='host of the names which do not define it')
+    parser.add_argument('--interval', type=float, default=60.)
+    parser.add_argument('--percentiles', default='50,90,99')
+    parser.add_argument('--max-keys', type=int, default=100000)
+    parser.add_argument('--template', nargs=3, action='append', default=[],
+                        metavar=('PATTERN', 'HOST', 'KEY'))
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    sender = Sender(args.server, args.port, hostname=args.hostname)
+    percentiles = [float(p) for p in args.percentiles.split(',') if p]
+    aggregator = Aggregator(sender, args.interval, percentiles,
+                            max_keys=args.max_keys)
+    bridge = StatsdBridge(aggregator, [Template(*template)
+                                       for template in args.template])
+    host, port = parse_endpoint(args.listen, 8125)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    transport = loop.run_until_complete(bridge.start(host, port))
+    aggregator.start()
+    logger.info('Bridging statsd %s:%s to %s:%s', host, port, args.server,
+                args.port)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        transport.close()
+        aggregator.close()
+        sender.close()
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+
+    zbx.metrics.testing
+    ~~~~~~~~~~~~~~~~~~~
+
+    A fake zabbix trapper, for tests and benchmarks.
+
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['FakeTrapper']
+
+import json
+import logging
+import struct
+import threading
+import time
+import zlib
+
+from six.moves import socketserver
+
+from .protocol import FLAG_COMPRESSION, FLAG_PROTOCOL, HEADER, SIGNATURE
+
+logger = logging.getLogger(__name__)
+
+
+class FakeTrapperHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        if self.server.ssl_context is not None:
+            self.request = self.server.ssl_context.wrap_socket(
+                self.request, server_side=True)
+
+    def handle(self):
+        server = self.server
+        header = self.recv(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+        signature, flags, length, reserved = HEADER.unpack(header)
+        payload = self.recv(length)
+        compressed = flags & FLAG_COMPRESSION
+        if compressed:
+            if not server.compression:
+                # like zabbix before 4.0
+                return
+            payload = zlib.decompress(payload)
+        request = json.loads(payload.decode('utf-8'))
+        if request['request'] == 'active checks':
+            with server.lock:
+                server.requests.append(request)
+            return self.respond({
+                'response': 'success',
+                'data': server.active_checks.get(request['host'], []),
+            }, compressed)
+        total = len(request['data'])
+        failed = len([d for d in request['data']
+                      if d['key'] in server.unsupported])
+        failed += int(round((total - failed) * server.failure_ratio))
+        with server.lock:
+            server.requests.append(request)
+            server.packets.append((flags, length))
+            server.values += total
+            server.bytes_received += HEADER.size + length
+
+        if server.latency:
+            time.sleep(server.latency)
+        self.respond({
+            'response': 'success',
+            'info': 'processed: %d; failed: %d; total: %d; '
+                    'seconds spent: 0.000100' % (total - failed, failed,
+                                                 total),
+        }, compressed)
+
+    def respond(self, response, compressed):
+        flags = FLAG_PROTOCOL
+        response = json.dumps(response).encode('utf-8')
+        if compressed:
+            flags |= FLAG_COMPRESSION
+            data = zlib.compress(response)
+            self.request.sendall(HEADER.pack(SIGNATURE, flags, len(data),
+                                             len(response)) + data)
+        else:
+            self.request.sendall(struct.pack('<4sBQ', SIGNATURE, flags,
+                                             len(response)) + response)
+
+    def recv(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+
+class FakeTrapper(socketserver.ThreadingTCPServer):
+    """
+    Answers 'sender data' requests from a background thread.
+
+    Every request is kept into requests, and (flags, length) of its packet
+    into packets.
+
+    Parameters:
+    port -- 0 picks a free port
+    latency -- seconds to wait before answering
+    failure_ratio -- part of the values reported as failed
+    compression -- False closes the connection on compressed packets,
+                   like zabbix before 4.0
+    unsupported -- keys whose values are reported as failed
+    active_checks -- mapping of hosts to the active checks answered to
+                     their 'active checks' requests
+    ssl_context -- server ssl.SSLContext which encrypts the connections
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0., failure_ratio=0.,
+                 compression=True, unsupported=(), active_checks=None,
+                 ssl_context=None):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', port),
+                                                 FakeTrapperHandler)
+        self.latency = latency
+        self.failure_ratio = failure_ratio
+        self.compression = compression
+        self.unsupported = set(unsupported)
+        self.active_checks = active_checks or {}
+        self.ssl_context = ssl_context
+        self.lock = threading.Lock()
+        self.requests = []
+        self.packets = []
+        self.values = 0
+        self.bytes_received = 0
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       args=(0.01,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle_error(self, request, client_address):
+        logger.debug('Request from %s failed', client_address,
+                     exc_info=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def reset(self):
+        with self.lock:
+            self.requests = []
+            self.packets = []
+            self.values = 0
+            self.bytes_received = 0
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,54 @@
+"""
+
+    zbx.metrics.tls
+    ~~~~~~~~~~~~~~~
+
+    Encrypt the connections to zabbix servers and proxies, configured with
+    TLSConnect=cert or TLSConnect=psk.
+
+"""
+
+from __future__ import absolute_import
+
+__all__ = ['tls_context']
+
+import binascii
+import ssl
+
+
+def tls_context(ca_file=None, cert_file=None, key_file=None,
+                check_hostname=False, psk_identity=None, psk=None):
+    """
+    Returns a client ssl.SSLContext for :class:`~zbx.metrics.Sender`.
+
+    Zabbix certificates rarely match the host names, so only the chain is
+    verified unless check_hostname is true. The pre-shared key is the hex
+    string of TLSPSKFile, it requires a python whose ssl supports PSK.
+
+    Parameters:
+    ca_file -- certificates of the authorities, TLSCAFile
+    cert_file -- certificate of the sender, TLSCertFile
+    key_file -- private key of the sender, TLSKeyFile
+    psk_identity -- identity of the pre-shared key, TLSPSKIdentity
+    psk -- pre-shared key, in hex
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if psk is not None:
+        if not hasattr(context, 'set_psk_client_callback'):
+            raise ValueError('TLS PSK is not supported by this python')
+        key = binascii.unhexlify(psk)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+        context.set_ciphers('PSK')
+        context.set_psk_client_callback(lambda hint: (psk_identity, key))
+        return context
+
+    context.check_hostname = check_hostname
+    if ca_file:
+        context.load_verify_locations(ca_file)
+    else:
+        context.load_default_certs()
+    if cert_file:
+        context.load_cert_chain(cert_file, key_file)
+    return context
@@ -72,7 +72,7 @@ def parse_timeperiod(value):
             time, resolution = TIMEPERIOD_PATTERN.search(value).groups()
             time = int(time)
         except:
-            raise ValueError('{value} cannot be parsed as a timeperiod'.format(value))  # NOQA
+            raise ValueError('{!r} cannot be parsed as a timeperiod'.format(value))  # NOQA
     elif isinstance(value, integer_types):
             time, resolution = value, 's'
     else: